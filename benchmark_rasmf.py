@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+Benchmark rasmf on a generated incoming directory tree.
+
+The tree holds a mix of TV season packs, movie releases and junk files in
+nested release directories, with sparse video files so multi-GB sizes cost
+no disk space. The walk, classify, move and clean up phases are timed
+separately and the results are written as JSON so runs of different
+versions can be compared.
+
+    ./benchmark_rasmf.py --files 10000 --output results.json
+
+The start up time of a no-op python -m rasmf run on an empty incoming
+directory is measured as well, and a limit on it can be enforced:
+
+    ./benchmark_rasmf.py --files --startup 20 --startup-limit 0.1
+"""
+
+import argparse
+import collections
+import configparser
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import rasmf
+
+# os functions counted as system calls during each phase
+COUNTED_CALLS = [
+    'stat', 'lstat', 'scandir', 'listdir', 'open', 'mkdir', 'rename',
+    'replace', 'remove', 'unlink', 'rmdir', 'copy_file_range', 'sendfile',
+]
+
+SHOW_WORDS = ['the', 'last', 'night', 'shift', 'ocean', 'and', 'me', 'my',
+              'dog', 'fire', 'house', 'blue', 'city', 'quest', 'lost']
+TAGS = ['720p', '1080p', 'hdtv', 'web-dl', 'x264', 'x265', 'bluray', 'proper']
+GROUPS = ['somedude', 'thatchick', 'release', 'team']
+JUNK = ['release.nfo', 'info.txt', 'cover.jpg', 'checksums.sfv',
+        'www.example.com.url', 'incomplete.mkv.part']
+
+# Modules a no-op run must not import, they are only needed by the options
+# that use them
+HEAVY_MODULES = [
+    'asyncio', 'concurrent.futures', 'ctypes', 'hashlib', 'http.server',
+    'logging.handlers', 'sqlite3', 'cProfile',
+]
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SyscallCounter(object):
+    """
+    Count calls to the os functions in COUNTED_CALLS while active.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.originals = {}
+
+    def __enter__(self):
+        for name in COUNTED_CALLS:
+            if hasattr(os, name):
+                self.originals[name] = getattr(os, name)
+                setattr(os, name, self.counting(name, self.originals[name]))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, original in self.originals.items():
+            setattr(os, name, original)
+
+    def counting(self, name, original):
+        def wrapper(*args, **kwargs):
+            self.counts[name] += 1
+            return original(*args, **kwargs)
+        return wrapper
+
+
+def proc_io():
+    """
+    Returns the read and write system call counts of this process from
+    /proc/self/io, or an empty dict where that is not available.
+    """
+    try:
+        with open('/proc/self/io') as io_file:
+            values = dict(line.split(': ') for line in io_file)
+    except OSError:
+        return {}
+    return {'syscr': int(values['syscr']), 'syscw': int(values['syscw'])}
+
+
+def max_rss_kib():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    if sys.platform == 'darwin':
+        return usage // 1024
+    return usage
+
+
+def write_sparse(path, size):
+    with open(path, 'wb') as fo:
+        fo.truncate(size)
+
+
+def random_title(rng, words=3):
+    return ' '.join(rng.choice(SHOW_WORDS) for _ in range(words))
+
+
+def generate_tree(incoming_dir, files, seed=0, video_size=2 * 1024 ** 3):
+    """
+    Generate about files entries below incoming_dir.
+    Returns a Counter of the kinds of files generated.
+    """
+    rng = random.Random(seed)
+    kinds = collections.Counter()
+    seasons = set()
+
+    while sum(kinds.values()) < files:
+        kind = rng.choice(['tv', 'tv', 'movie', 'junk'])
+        title = random_title(rng)
+
+        if kind == 'tv':
+            season = rng.randint(1, 12)
+            if (title, season) in seasons:
+                continue
+            seasons.add((title, season))
+            release = '{} S{:02d} {} {}-{}'.format(
+                title, season, rng.choice(TAGS), rng.choice(TAGS),
+                rng.choice(GROUPS))
+            release_dir = os.path.join(incoming_dir, release)
+            os.makedirs(os.path.join(release_dir, 'Subs'), exist_ok=True)
+            for episode in range(1, rng.randint(2, 24)):
+                name = '{}.s{:02d}e{:02d}.{}'.format(
+                    title.replace(' ', '.'), season, episode,
+                    rng.choice(TAGS))
+                write_sparse(os.path.join(release_dir, name + '.mkv'),
+                             video_size // 8)
+                write_sparse(os.path.join(release_dir, 'Subs',
+                                          name + '.srt'), 0)
+                kinds['tv'] += 1
+                kinds['junk'] += 1
+
+        elif kind == 'movie':
+            year = rng.randint(1950, 2020)
+            release = '{} ({}) [{}] {}'.format(
+                title, year, rng.choice(TAGS), rng.choice(GROUPS))
+            release_dir = os.path.join(incoming_dir, release)
+            os.makedirs(os.path.join(release_dir, 'Sample'), exist_ok=True)
+            write_sparse(os.path.join(release_dir, release + '.mkv'),
+                         video_size)
+            write_sparse(os.path.join(release_dir, 'Sample',
+                                      'sample.avi'), 1024 ** 2)
+            kinds['movie'] += 1
+
+        else:
+            release = '{} extras'.format(title)
+            os.makedirs(os.path.join(incoming_dir, release), exist_ok=True)
+
+        for name in rng.sample(JUNK, 2):
+            write_sparse(os.path.join(incoming_dir, release, name), 1024)
+            kinds['junk'] += 1
+
+    return kinds
+
+
+def benchmark_config(base_dir, media_dir=None):
+    """
+    Returns the example config with directories below base_dir, and the
+    media directory at media_dir if given.
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(PACKAGE_DIR, 'config_example.ini'))
+    media_dir = media_dir or os.path.join(base_dir, 'media')
+    config['folders']['incoming_dir'] = os.path.join(base_dir, 'incoming')
+    config['folders']['media_dir'] = media_dir
+    config['folders']['movie_dir'] = os.path.join(media_dir, 'movie')
+    config['folders']['tv_dir'] = os.path.join(media_dir, 'tv')
+    config['folders']['log_dir'] = os.path.join(base_dir, 'log')
+    return config
+
+
+def benchmark_settings(base_dir, media_dir=None):
+    """
+    Returns rasmf Settings for benchmark_config().
+    """
+    return rasmf.settings_from_config(benchmark_config(base_dir, media_dir))
+
+
+def startup_dir(base_dir):
+    """
+    Write a config.ini for an empty incoming directory below base_dir, for
+    no-op runs with base_dir as the working directory.
+    """
+    config = benchmark_config(base_dir)
+    for folder in config['folders'].values():
+        os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(base_dir, 'config.ini'), 'w') as config_file:
+        config.write(config_file)
+
+
+def run_python(base_dir, args):
+    """
+    Run python with args in base_dir, with this package importable.
+    Returns the seconds it took and its standard output.
+    """
+    env = dict(os.environ, PYTHONPATH=PACKAGE_DIR)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable] + args, cwd=base_dir, env=env,
+                            check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return time.perf_counter() - start, output
+
+
+def startup_modules(base_dir):
+    """
+    Returns the names of the modules imported by a no-op run in base_dir.
+    """
+    _, output = run_python(base_dir, [
+        '-c', 'import runpy, sys; sys.argv = ["rasmf"]; '
+              'runpy.run_module("rasmf", run_name="__main__"); '
+              'print("\\n".join(sys.modules))'])
+    return set(output.split())
+
+
+def startup_benchmark(base_dir, runs):
+    """
+    Time no-op python -m rasmf runs in base_dir against bare interpreter
+    starts. Returns a dict of the median seconds of each.
+    """
+    startup_dir(base_dir)
+    # A first run writes the bytecode caches
+    run_python(base_dir, ['-m', 'rasmf'])
+    interpreter = [run_python(base_dir, ['-c', 'pass'])[0]
+                   for _ in range(runs)]
+    startup = [run_python(base_dir, ['-m', 'rasmf'])[0]
+               for _ in range(runs)]
+    return {
+        'runs': runs,
+        'interpreter_seconds': statistics.median(interpreter),
+        'seconds': statistics.median(startup),
+        'heavy_modules': sorted(
+            startup_modules(base_dir).intersection(HEAVY_MODULES)),
+    }
+
+
+def timed(results, phase, func, *args):
+    """
+    Run func, recording its time, system calls and memory in results.
+    cumulative_max_rss_kib is the peak RSS of the process so far, including
+    the earlier phases and the tree generation. While tracemalloc is tracing,
+    peak_traced_kib is the peak traced memory during this phase, which
+    includes what the earlier phases still hold, e.g. the plan.
+    """
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    io_before = proc_io()
+    with SyscallCounter() as counter:
+        start = time.perf_counter()
+        value = func(*args)
+        elapsed = time.perf_counter() - start
+    io_after = proc_io()
+
+    results[phase] = {
+        'seconds': elapsed,
+        'cumulative_max_rss_kib': max_rss_kib(),
+        'syscalls': dict(counter.counts),
+    }
+    if tracing:
+        results[phase]['peak_traced_kib'] = (
+            tracemalloc.get_traced_memory()[1] // 1024)
+    for key in io_after:
+        results[phase]['syscalls'][key] = io_after[key] - io_before[key]
+    return value
+
+
+def plan_memory(settings, listing):
+    """
+    Returns the memory held by a plan of listing, in bytes per operation,
+    as traced by tracemalloc.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        plan = []
+        targets = set()
+        for rootdir, dirs, files in listing:
+            rasmf.extend_plan(plan, targets, rasmf.plan_directory(
+                settings, rootdir, files))
+        del targets
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return size / max(len(plan), 1)
+
+
+def run_benchmark(settings, trace_memory=False):
+    """
+    Run the phases of a rasmf sweep over settings.incoming_dir.
+    With trace_memory the phases run under tracemalloc, which records the
+    peak memory of each but slows them down several times.
+    Returns a dict of phase results.
+    """
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            return run_benchmark(settings)
+        finally:
+            tracemalloc.stop()
+
+    results = collections.OrderedDict()
+    tree = rasmf.ScanTree()
+
+    def walk():
+        listing = list(rasmf.scan_incoming(settings.incoming_dir))
+        for rootdir, dirs, files in listing:
+            tree.add(rootdir, dirs, files)
+        return listing
+
+    def classify(listing):
+        plan = []
+        targets = set()
+        for rootdir, dirs, files in listing:
+            rasmf.extend_plan(plan, targets, rasmf.plan_directory(
+                settings, rootdir, files))
+        return plan
+
+    for d in [settings.movie_dir, settings.tv_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    listing = timed(results, 'walk', walk)
+    plan = timed(results, 'classify', classify, listing)
+    # Planning stats the sources, so this is measured before they move
+    bytes_per_operation = plan_memory(settings, listing)
+    clean_up_list = timed(results, 'move', rasmf.execute_plan,
+                          settings, plan, tree)
+    timed(results, 'clean_up', rasmf.clean_up, settings, clean_up_list, tree)
+
+    results['walk']['directories'] = len(listing)
+    results['classify']['operations'] = len(plan)
+    results['classify']['bytes_per_operation'] = bytes_per_operation
+    results['clean_up']['directories'] = len(set(clean_up_list))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark rasmf on a generated incoming tree.')
+    parser.add_argument(
+        '--files', type=int, nargs='*', default=[1000],
+        help='number of files to generate, e.g. 1000 10000 100000')
+    parser.add_argument(
+        '--video-size', type=int, default=2 * 1024 ** 3,
+        help='size in bytes of the sparse movie files')
+    parser.add_argument(
+        '--workers', type=int, default=1, help='rasmf workers setting')
+    parser.add_argument(
+        '--dir', help='directory for the generated trees, default a temp dir')
+    parser.add_argument(
+        '--media-dir',
+        help='media directory, e.g. on another filesystem to copy files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--trace-memory', action='store_true',
+        help='record the peak memory of each phase with tracemalloc, '
+             'which makes the phases several times slower')
+    parser.add_argument(
+        '--startup', type=int, metavar='RUNS', default=0,
+        help='time RUNS no-op runs of python -m rasmf')
+    parser.add_argument(
+        '--startup-limit', type=float, metavar='SECONDS',
+        help='fail when a no-op run takes more than SECONDS longer than '
+             'starting the interpreter')
+    parser.add_argument(
+        '--output', default='benchmark_results.json',
+        help='JSON results file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger('rasmf').setLevel(logging.ERROR)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': [],
+    }
+
+    for files in args.files:
+        base_dir = tempfile.mkdtemp(prefix='rasmf-bench-', dir=args.dir)
+        media_dir = None
+        if args.media_dir:
+            media_dir = tempfile.mkdtemp(prefix='rasmf-bench-',
+                                         dir=args.media_dir)
+        try:
+            settings = benchmark_settings(base_dir, media_dir)._replace(
+                workers=args.workers)
+            start = time.perf_counter()
+            kinds = generate_tree(settings.incoming_dir, files, args.seed,
+                                  args.video_size)
+            generate_seconds = time.perf_counter() - start
+
+            run = {
+                'files': sum(kinds.values()),
+                'kinds': dict(kinds),
+                'workers': args.workers,
+                'generate_seconds': generate_seconds,
+                'phases': run_benchmark(settings, args.trace_memory),
+            }
+        finally:
+            shutil.rmtree(base_dir)
+            if media_dir:
+                shutil.rmtree(media_dir)
+
+        report['runs'].append(run)
+        print('{:>8} files: {}'.format(run['files'], ', '.join(
+            '{} {:.3f}s'.format(phase, values['seconds'])
+            for phase, values in run['phases'].items())))
+
+    failed = False
+    if args.startup:
+        base_dir = tempfile.mkdtemp(prefix='rasmf-bench-', dir=args.dir)
+        try:
+            startup = startup_benchmark(base_dir, args.startup)
+        finally:
+            shutil.rmtree(base_dir)
+        report['startup'] = startup
+        overhead = startup['seconds'] - startup['interpreter_seconds']
+        print('startup: {:.1f}ms, {:.1f}ms over the interpreter{}'.format(
+            startup['seconds'] * 1000, overhead * 1000,
+            ', imports ' + ', '.join(startup['heavy_modules'])
+            if startup['heavy_modules'] else ''))
+        if args.startup_limit is not None:
+            failed = (overhead > args.startup_limit or
+                      bool(startup['heavy_modules']))
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    if failed:
+        sys.exit('startup is over the limit of {}s'.format(
+            args.startup_limit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+Rename filenames of video format files to clean them up by removing whitespace
+and brackets and characters that may cause problems in the shell.
+Then store files in a preferred location.
+Can be used with Kodi(XBMC) before it scrapes the files and adds content to
+library.
+
+See Kodi Wiki for naming for video files
+http://kodi.wiki/view/Naming_video_files/TV_shows
+
+Run it with python -m rasmf. The names defined in the submodules are
+available from the package and are imported on first use, so the command
+line only pays for the modules a run needs.
+"""
+
+import importlib
+
+# Public name => submodule defining it
+EXPORTS = {
+    # rasmf.settings
+    'DUPLICATE_ACTIONS': 'settings',
+    'STORE_STRATEGIES': 'settings',
+    'SCHEDULE_POLICIES': 'settings',
+    'Settings': 'settings',
+    'read_config': 'settings',
+    'parse_extensions': 'settings',
+    'config_choice': 'settings',
+    'config_literal': 'settings',
+    'rename_rules': 'settings',
+    'settings_from_config': 'settings',
+    'read_settings': 'settings',
+    # rasmf.util
+    'pause': 'util',
+    'logging_config': 'util',
+    'lower_splitext': 'util',
+    'traced': 'util',
+    'relative_path': 'util',
+    'format_size': 'util',
+    'fsync_dir': 'util',
+    'error_type': 'util',
+    # rasmf.telemetry
+    'METRICS': 'telemetry',
+    'HISTOGRAM_BUCKETS': 'telemetry',
+    'Metrics': 'telemetry',
+    'metrics': 'telemetry',
+    'write_metrics': 'telemetry',
+    # rasmf.server
+    'MetricsHandler': 'server',
+    'serve_metrics': 'server',
+    # rasmf.classify
+    'Classification': 'classify',
+    'RenameRules': 'classify',
+    'DEFAULT_RENAME_RULES': 'classify',
+    'RELEASE_GROUP_PATTERN': 'classify',
+    'sanitise_string': 'classify',
+    'split_on_year': 'classify',
+    'split_on_season': 'classify',
+    'tv_show_name': 'classify',
+    'tv_show_name_season': 'classify',
+    'tv_show_parts': 'classify',
+    'movie_name': 'classify',
+    'Classifier': 'classify',
+    'classifier': 'classify',
+    'classifier_for': 'classify',
+    'video_type': 'classify',
+    # rasmf.plan
+    'FileStat': 'plan',
+    'MoveOperation': 'plan',
+    'MoveResult': 'plan',
+    'MEDIA_TYPE_LABELS': 'plan',
+    'CLASSIFY_BATCH_SIZE': 'plan',
+    'file_stat': 'plan',
+    'source_stat': 'plan',
+    'classification_target': 'plan',
+    'tv_show_target': 'plan',
+    'movie_target': 'plan',
+    'operation_from_classification': 'plan',
+    'plan_video_file': 'plan',
+    'scan_incoming': 'plan',
+    'indexed_plan_video_file': 'plan',
+    'plan_directory': 'plan',
+    'count_classified': 'plan',
+    'extend_plan': 'plan',
+    'classify_files': 'plan',
+    'pooled_build_plan': 'plan',
+    'build_plan': 'plan',
+    'plan_to_json': 'plan',
+    # rasmf.sidecars
+    'SIDECAR_TAG_PATTERN': 'sidecars',
+    'NON_NAME_PATTERN': 'sidecars',
+    'MAX_SIDECAR_TAGS': 'sidecars',
+    'SidecarGrouper': 'sidecars',
+    'sidecar_grouper': 'sidecars',
+    # rasmf.index
+    'RACY_SECONDS': 'index',
+    'ScanIndex': 'index',
+    'open_scan_index': 'index',
+    'indexed_walk': 'index',
+    # rasmf.library
+    'TRAILING_YEAR_PATTERN': 'library',
+    'NON_ALNUM_PATTERN': 'library',
+    'name_key': 'library',
+    'show_key': 'library',
+    'season_key': 'library',
+    'LibraryIndex': 'library',
+    'open_library': 'library',
+    # rasmf.transfer
+    'PARTIAL_SUFFIX': 'transfer',
+    'COPY_CHUNK_SIZE': 'transfer',
+    'RESUME_CHECK_SIZE': 'transfer',
+    'FICLONE': 'transfer',
+    'UNSUPPORTED_ERRNOS': 'transfer',
+    'video_file': 'transfer',
+    'DirectoryCache': 'transfer',
+    'directory_cache': 'transfer',
+    'make_target_dir': 'transfer',
+    'make_library_dirs': 'transfer',
+    'checked_move': 'transfer',
+    'execute_operation': 'transfer',
+    'copy_chunk': 'transfer',
+    'resume_offset': 'transfer',
+    'copy_file': 'transfer',
+    'transfer_file': 'transfer',
+    'clone_file': 'transfer',
+    'link_file': 'transfer',
+    'already_stored': 'transfer',
+    'store_file': 'transfer',
+    'observe_store': 'transfer',
+    'store_sidecars': 'transfer',
+    'move_operation': 'transfer',
+    'process_tv_show_file': 'transfer',
+    'process_movie_file': 'transfer',
+    # rasmf.dedupe
+    'HASH_BLOCK_SIZE': 'dedupe',
+    'HASH_SAMPLES': 'dedupe',
+    'HASH_SAMPLE_SIZE': 'dedupe',
+    'partial_hash': 'dedupe',
+    'full_hash': 'dedupe',
+    'HashCache': 'dedupe',
+    'open_hash_cache': 'dedupe',
+    'find_duplicate': 'dedupe',
+    'deduplicate': 'dedupe',
+    'dedupe_plan': 'dedupe',
+    # rasmf.execute
+    'device_id': 'execute',
+    'target_devices': 'execute',
+    'move_lanes': 'execute',
+    'fair_order': 'execute',
+    'schedule_plan': 'execute',
+    'move_lane': 'execute',
+    'execute_plan': 'execute',
+    # rasmf.cleanup
+    'ScanTree': 'cleanup',
+    'scan_tree': 'cleanup',
+    'clean_up': 'cleanup',
+    # rasmf.journal
+    'Journal': 'journal',
+    'read_journal': 'journal',
+    'recover_move': 'journal',
+    'recover_journal': 'journal',
+    'lock_journal': 'journal',
+    'open_journal': 'journal',
+    # rasmf.pipeline
+    'ScanEntry': 'pipeline',
+    'ReleaseDone': 'pipeline',
+    'scan_stage': 'pipeline',
+    'directory_entries': 'pipeline',
+    'classify_stage': 'pipeline',
+    'dedupe_stage': 'pipeline',
+    'move_stage': 'pipeline',
+    'clean_up_stage': 'pipeline',
+    'pipeline_stages': 'pipeline',
+    'run_pipeline': 'pipeline',
+    # rasmf.aio
+    'list_directory': 'aio',
+    'async_scan': 'aio',
+    'async_execute_plan': 'aio',
+    'resolve_directories': 'aio',
+    'async_build_plan': 'aio',
+    'async_sweep': 'aio',
+    # rasmf.watcher
+    'IN_MODIFY': 'watcher',
+    'IN_CLOSE_WRITE': 'watcher',
+    'IN_MOVED_FROM': 'watcher',
+    'IN_MOVED_TO': 'watcher',
+    'IN_CREATE': 'watcher',
+    'IN_DELETE': 'watcher',
+    'IN_Q_OVERFLOW': 'watcher',
+    'IN_IGNORED': 'watcher',
+    'IN_ISDIR': 'watcher',
+    'IN_NONBLOCK': 'watcher',
+    'IN_CLOEXEC': 'watcher',
+    'INOTIFY_EVENT': 'watcher',
+    'CACHE_FLUSH_SECONDS': 'watcher',
+    'SettleTracker': 'watcher',
+    'InotifyWatcher': 'watcher',
+    'PollingWatcher': 'watcher',
+    'make_watcher': 'watcher',
+    'stop_watching': 'watcher',
+    'watch': 'watcher',
+    # rasmf.profiling
+    'TimingTrace': 'profiling',
+    # rasmf.cli
+    'log_plan': 'cli',
+    'parse_args': 'cli',
+    'explain': 'cli',
+    'sweep': 'cli',
+    'profile': 'cli',
+    'run': 'cli',
+    'main': 'cli',
+}
+
+__all__ = sorted(EXPORTS)
+
+
+def __getattr__(name):
+    module = EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(
+            "module 'rasmf' has no attribute {!r}".format(name))
+    return getattr(importlib.import_module('rasmf.' + module), name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(EXPORTS))
@@ -0,0 +1,7 @@
+"""
+python -m rasmf
+"""
+
+from rasmf.cli import main
+
+main()
@@ -0,0 +1,207 @@
+"""
+Concurrent sweep with asyncio for incoming directories on network mounts.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+
+from rasmf.cleanup import ScanTree, clean_up
+from rasmf.dedupe import dedupe_plan, open_hash_cache
+from rasmf.execute import move_lane, schedule_plan
+from rasmf.library import open_library
+from rasmf.plan import MEDIA_TYPE_LABELS, extend_plan, plan_directory
+from rasmf.sidecars import sidecar_grouper
+from rasmf.transfer import directory_cache, make_library_dirs, make_target_dir
+
+
+def list_directory(path):
+    """
+    Returns (dirs, files, walk_dirs) for a directory the way os.walk() lists
+    it, where walk_dirs are the dirs that are not symlinks, or None if the
+    directory can not be read.
+    """
+    dirs = []
+    files = []
+    walk_dirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                    continue
+                dirs.append(entry.name)
+                if not entry.is_symlink():
+                    walk_dirs.append(entry.name)
+    except OSError:
+        return None
+    return dirs, files, walk_dirs
+
+
+async def async_scan(incoming_dir, executor=None, limit=None):
+    """
+    List every directory below the incoming directory with the listings in
+    flight at once, bounded by the limit semaphore.
+    Returns the same (rootdir, dirs, files) list as scan_incoming(), bottom
+    up in os.walk() order.
+    """
+    loop = asyncio.get_running_loop()
+    if limit is None:
+        limit = asyncio.Semaphore(1)
+    listings = {}
+
+    async def scan(path):
+        async with limit:
+            listing = await loop.run_in_executor(
+                executor, list_directory, path)
+        if listing is None:
+            return
+        listings[path] = listing
+        await asyncio.gather(*(scan(os.path.join(path, name))
+                               for name in listing[2]))
+
+    await scan(incoming_dir)
+
+    def bottom_up(path):
+        if path not in listings:
+            return
+        dirs, files, walk_dirs = listings[path]
+        for name in walk_dirs:
+            yield from bottom_up(os.path.join(path, name))
+        yield path, dirs, files
+
+    return list(bottom_up(incoming_dir))
+
+
+async def async_execute_plan(settings, plan, tree=None, executor=None,
+                             limit=None, dirs=None, journal=None):
+    """
+    execute_plan() with every makedirs and move handed to the executor.
+    Operations hold a semaphore for their destination root, movie_dir or
+    tv_dir, as well as the global limit, so one slow mount can not take
+    all of the slots.
+    Returns the list of first level directories to clean up.
+    """
+    loop = asyncio.get_running_loop()
+    if limit is None:
+        limit = asyncio.Semaphore(settings.async_limit)
+    destination_limits = {
+        media_type: asyncio.Semaphore(settings.async_destination_limit)
+        for media_type in MEDIA_TYPE_LABELS}
+
+    async def run(media_type, func, *args):
+        async with destination_limits[media_type], limit:
+            return await loop.run_in_executor(executor, func, *args)
+
+    target_dirs = {}
+    for operation in plan:
+        target_dirs.setdefault(os.path.dirname(operation.target),
+                               operation.media_type)
+    await asyncio.gather(*(run(media_type, make_target_dir, target_dir, dirs)
+                           for target_dir, media_type
+                           in sorted(target_dirs.items())
+                           if dirs is None or target_dir not in dirs))
+
+    results = await asyncio.gather(*(run(operation.media_type, move_lane,
+                                         [operation], tree, dirs,
+                                         settings.store_strategy, journal)
+                                     for operation in plan))
+    return [item for clean_up_items in results for item in clean_up_items]
+
+
+def resolve_directories(library, directories):
+    """
+    Returns the operations of each directory resolved in the LibraryIndex,
+    in order.
+    """
+    return [library.resolve_many(operations) for operations in directories]
+
+
+async def async_build_plan(settings, tree=None, executor=None, limit=None,
+                           library=None):
+    """
+    build_plan() over a listing from async_scan().
+    Each directory is classified, and its videos stat'ed, by plan_directory()
+    in the executor, with the listings in flight at once bounded by the
+    limit semaphore. Targets are then resolved in the LibraryIndex, in the
+    executor as it lists library folders, and sidecars grouped in scan
+    order, so the plan is that of build_plan().
+    """
+    loop = asyncio.get_running_loop()
+    if limit is None:
+        limit = asyncio.Semaphore(1)
+    listing = await async_scan(settings.incoming_dir, executor, limit)
+
+    async def plan_listing(rootdir, files):
+        async with limit:
+            return await loop.run_in_executor(
+                executor, plan_directory, settings, rootdir, files)
+
+    directories = await asyncio.gather(*(plan_listing(rootdir, files)
+                                         for rootdir, _, files in listing))
+    if library is not None:
+        directories = await loop.run_in_executor(
+            executor, resolve_directories, library, directories)
+
+    plan = []
+    targets = set()
+    sidecars = sidecar_grouper(settings)
+    for (rootdir, dirs, files), operations in zip(listing, directories):
+        if tree is not None:
+            tree.add(rootdir, dirs, files)
+        if sidecars is not None:
+            operations = sidecars.group(rootdir, files, operations)
+        extend_plan(plan, targets, operations)
+    return plan
+
+
+async def async_sweep(settings, dry_run=False, journal=None):
+    """
+    Scan, plan, move and clean up with the blocking filesystem calls run in
+    a thread pool of async_limit threads, for incoming and library
+    directories on high latency network mounts.
+    Moves and removals are recorded in the Journal if given.
+    Returns the plan.
+    """
+    loop = asyncio.get_running_loop()
+    tree = ScanTree()
+    limit = asyncio.Semaphore(settings.async_limit)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=settings.async_limit)
+    library = None
+    try:
+        library = await loop.run_in_executor(executor, open_library, settings)
+        plan = await loop.run_in_executor(
+            executor, schedule_plan, settings,
+            await async_build_plan(settings, tree, executor, limit, library))
+        if dry_run:
+            return plan
+
+        dirs = await loop.run_in_executor(
+            executor, directory_cache, settings)
+        await loop.run_in_executor(
+            executor, make_library_dirs, settings, dirs)
+
+        moves = plan
+        clean_up_list = []
+        hashes = open_hash_cache(settings)
+        if hashes is not None:
+            try:
+                moves, clean_up_list = await loop.run_in_executor(
+                    executor, dedupe_plan, settings, plan, hashes, tree)
+            finally:
+                hashes.close()
+
+        clean_up_list += await async_execute_plan(
+            settings, moves, tree, executor, limit, dirs, journal)
+        await loop.run_in_executor(
+            executor, clean_up, settings, clean_up_list, tree, journal)
+        return plan
+    finally:
+        if library is not None:
+            await loop.run_in_executor(executor, library.close)
+        executor.shutdown()
@@ -0,0 +1,435 @@
+"""
+Classification of release and file names as TV show episodes or movies.
+"""
+
+import collections
+import functools
+import os
+import re
+
+from rasmf.library import name_key
+from rasmf.util import lower_splitext
+
+
+Classification = collections.namedtuple('Classification', [
+    'media_type',
+    'show',
+    'season',
+    'episode',
+    'year',
+    'extension',
+    'name',
+])
+Classification.__doc__ = """
+The result of classifying a filename.
+media_type is 'tv', 'movie' or None and name is the target filename.
+season is the season as it appears in the target, e.g. S01.
+"""
+
+
+RenameRules = collections.namedtuple('RenameRules', [
+    'separator',
+    'separator_characters',
+    'replacements',
+    'strip_release_group',
+    'quality_tags',
+    'title_case',
+    'show_aliases',
+])
+RenameRules.__doc__ = """
+The rules a Classifier builds target names with, from the [rename] and
+[show_aliases] sections of the config.
+replacements and show_aliases are tuples of (text, replacement) pairs.
+"""
+
+
+DEFAULT_RENAME_RULES = RenameRules(
+    separator='.',
+    separator_characters=" []()'",
+    replacements=(('&', 'and'), ),
+    strip_release_group=False,
+    quality_tags=(),
+    title_case=True,
+    show_aliases=(),
+)
+
+
+# A leading bracketed release group, e.g. '[SubGroup] '
+RELEASE_GROUP_PATTERN = r'^[\[(][^\])]*[\])][-._ ]*'
+
+
+def sanitise_string(fname):
+    """
+    Sanitise a string by removing brackets and using a preferred separator
+    (e.g. period, underscore or space)
+    Currently only returns a string with period as the separator.
+    """
+
+    character_list = [' ', '[', ']', '(', ')', "'", '&', '-.', '..']
+    for character in character_list:
+        if character in fname:
+            if character == '&':
+                fname = fname.replace('&', 'and')
+            else:
+                fname = fname.replace(character, '.')
+    fname = re.sub(r'\.$', r'', fname)  # remove trailing period
+    return fname
+
+
+def split_on_year(fname):
+    """Return the string upto and including a year."""
+    fname = re.sub(r'(^.*[0-9][0-9][0-9][0-9]).*', r'\1', fname)
+    return fname
+
+
+def split_on_season(fname):
+    """Return the string upto and including the season and episode string
+    (e.g. S01E01)
+    """
+    fname = re.sub(r'(^.*[sS][0-9]+[eE][0-9]+).*$', r'\1', fname)
+    return fname
+
+
+def tv_show_name(first_dir, fname):
+    """
+    The TV show name is assumed to be the first part of the string
+    up to [sS][0-9]+ taken from either the filename or the
+    first element of the source directory.
+    The TV show name is returned sanitised and title cased.
+    """
+    # re.sub NOTE: If pattern isn't found, string is returned unchanged
+    first_dir = sanitise_string(first_dir)
+    first_dir = first_dir.title()
+    if re.search(r'^[sS][0-9]+', fname):
+        # If the season is at the beginning of the file
+        # Use the containing directory for the TV show name
+        show_name = re.sub(r'(^.*)[-._][sS][0-9]+', r'\1', first_dir)
+    else:
+        show_name = re.sub(r'(^.*)[-_.][Ss][0-9]+[Ee][0-9]+.*$', r'\1',  fname)
+
+    return show_name
+
+
+def tv_show_name_season(sname, fname):
+    """
+    Returns a string of form Tv.Show.Name.S01
+    """
+    season = re.sub(r'^.*([Ss][0-9]+).*$', r'\1', fname)
+    sname = sname + '-' + season
+    return sname
+
+
+def tv_show_parts(first_relpath, source_filename):
+    """
+    Returns a tuple of the show name, the season folder name and the target
+    filename of a TV show file, e.g.
+    ('Tv.Show.Name', 'Tv.Show.Name-S01', 'Tv.Show.Name-S01E01.avi')
+    This is the reference the Classifier is checked against.
+    """
+    tv_filename, file_extension = lower_splitext(source_filename)
+    tv_filename = sanitise_string(tv_filename)
+    tv_filename = split_on_season(tv_filename)
+    tv_filename = tv_filename.title()
+
+    show_name = tv_show_name(first_relpath, tv_filename)
+
+    show_season = tv_show_name_season(show_name, tv_filename)
+
+    return show_name, show_season, tv_filename + file_extension
+
+
+def movie_name(source_filename, file_extension):
+    """
+    Returns the target filename of a movie file, e.g. Movie.Title.2001.avi
+    This is the reference the Classifier is checked against.
+    """
+    movie_filename = sanitise_string(source_filename)
+    movie_filename = split_on_year(movie_filename)
+    return movie_filename.title() + '.' + file_extension
+
+
+class Classifier(object):
+    """
+    Classify video filenames as TV shows or movies and work out their target
+    names with precompiled patterns, one call per file.
+    The RenameRules, by default DEFAULT_RENAME_RULES, are compiled once into
+    a strip pattern, a replace pattern and a translate table.
+    With the default rules the results are the same as tv_show_parts() and
+    movie_name(), which are still used for the rare names containing a
+    newline as the patterns there rely on '.' and '$' not crossing one.
+    Only the show aliases of other rules apply to those names.
+    """
+
+    tv_pattern = re.compile(r'[sS][0-9]+[eE][0-9]+')
+    year_pattern = re.compile(r'[0-9][0-9][0-9][0-9]')
+    # Applied to the lowercase sanitised name, finds the last S01E01
+    season_episode_pattern = re.compile(r'.*s([0-9]+)e([0-9]+)')
+    # Finds the end of the last year
+    year_end_pattern = re.compile(r'.*[0-9][0-9][0-9][0-9]')
+    leading_season_pattern = re.compile(r'[sS][0-9]')
+
+    def __init__(self, rules=DEFAULT_RENAME_RULES):
+        self.rules = rules
+        self.title_case = rules.title_case
+        self.dir_show_names = {}
+
+        separator = self.separator = rules.separator
+        self.separators = '-_.' + separator
+        separator_class = '[-._' + re.escape(separator) + ']'
+        self.dir_season_pattern = re.compile(
+            r'(^.*)' + separator_class + r'[sS][0-9]+')
+        self.show_name_pattern = re.compile(
+            r'(^.*)' + separator_class + r'[Ss][0-9]+[Ee][0-9]+.*$')
+
+        # Single characters are translated, longer text is replaced first.
+        # Either ignores case as TV names are lowercase by then.
+        table = dict.fromkeys(rules.separator_characters, separator)
+        self.replacements = {}
+        for text, replacement in rules.replacements:
+            if len(text) == 1:
+                table[text.lower()] = table[text.upper()] = replacement
+            elif text:
+                self.replacements[text.lower()] = replacement
+        self.sanitise_table = str.maketrans(table)
+        self.replace_pattern = None
+        if self.replacements:
+            self.replace_pattern = re.compile('|'.join(
+                re.escape(text) for text in sorted(
+                    self.replacements, key=len, reverse=True)),
+                re.IGNORECASE)
+        self.collapse = ('-' + separator, separator + separator)
+
+        strip = []
+        if rules.strip_release_group:
+            strip.append(RELEASE_GROUP_PATTERN)
+        if rules.quality_tags:
+            strip.append(r'[-._ ]?(?<![0-9a-z])(?:' + '|'.join(
+                re.escape(tag) for tag in rules.quality_tags) +
+                r')(?![0-9a-z])')
+        self.strip_pattern = None
+        if strip:
+            self.strip_pattern = re.compile('|'.join(strip), re.IGNORECASE)
+
+        self.show_aliases = {name_key(name): alias
+                             for name, alias in rules.show_aliases}
+
+    def strip(self, fname, trace=None):
+        """
+        Remove the release group and quality tags of the rules from a name.
+        """
+        if self.strip_pattern is not None:
+            fname = self.strip_pattern.sub('', fname)
+            if trace is not None:
+                trace.append(('strip', fname))
+        return fname
+
+    def sanitise(self, fname):
+        """
+        sanitise_string() with the rules, a replace, a translate and two
+        replaces collapsing separators.
+        """
+        if self.replace_pattern is not None:
+            fname = self.replace_pattern.sub(
+                lambda match: self.replacements[match.group().lower()],
+                fname)
+        separator = self.separator
+        fname = fname.translate(self.sanitise_table)
+        fname = fname.replace(self.collapse[0], separator)
+        fname = fname.replace(self.collapse[1], separator)
+        if fname.endswith(separator):
+            fname = fname[:-1]
+        return fname
+
+    def alias(self, show_name, name, trace=None):
+        """
+        Returns the (show, name) of an episode with the show alias of the
+        rules, if any.
+        """
+        alias = self.show_aliases.get(name_key(show_name))
+        if alias is None:
+            return show_name, name
+        if name.startswith(show_name):
+            name = alias + name[len(show_name):]
+        if trace is not None:
+            trace.append(('alias', alias))
+        return alias, name
+
+    def dir_show_name(self, first_relpath):
+        """
+        The show name taken from the first level directory, cached as every
+        file of a season pack shares it.
+        """
+        if first_relpath not in self.dir_show_names:
+            show_name = self.sanitise(self.strip(first_relpath))
+            if self.title_case:
+                show_name = show_name.title()
+            self.dir_show_names[first_relpath] = self.dir_season_pattern.sub(
+                r'\1', show_name)
+        return self.dir_show_names[first_relpath]
+
+    def classify(self, first_relpath, full_filename, trace=None):
+        """
+        Returns the Classification of a file in the first level incoming
+        directory first_relpath.
+        The steps of the rules are appended to trace as (step, name) pairs
+        when given, see explain().
+        """
+        file_extension = os.path.splitext(full_filename)[1]
+        file_extension = file_extension.replace('.', '').lower()
+
+        if self.tv_pattern.search(full_filename):
+            return self.classify_tv(first_relpath, full_filename,
+                                    file_extension, trace)
+        elif self.year_pattern.search(full_filename):
+            return self.classify_movie(full_filename, file_extension, trace)
+        return Classification(None, None, None, None, None, file_extension,
+                              None)
+
+    def explain(self, first_relpath, full_filename):
+        """
+        Returns the Classification of a file and the list of (step, name)
+        pairs the rules went through to name it.
+        """
+        trace = [('input', full_filename)]
+        return self.classify(first_relpath, full_filename, trace), trace
+
+    def classify_many(self, first_relpath, filenames):
+        """
+        Returns the Classification of each filename of a directory listing
+        in the first level incoming directory first_relpath.
+        """
+        return [self.classify(first_relpath, full_filename)
+                for full_filename in filenames]
+
+    def classify_tv(self, first_relpath, full_filename, file_extension,
+                    trace=None):
+        tv_filename, dot_extension = lower_splitext(full_filename)
+        if self.strip_pattern is not None:
+            tv_filename = self.strip(tv_filename, trace)
+        tv_filename = self.sanitise(tv_filename)
+        if trace is not None:
+            trace.append(('sanitise', tv_filename))
+
+        match = self.season_episode_pattern.match(tv_filename)
+        if (match is None or '\n' in full_filename or
+                '\n' in first_relpath):
+            return self.classify_tv_reference(
+                first_relpath, full_filename, file_extension, trace)
+
+        season_start = match.start(1) - 1
+        tv_filename = tv_filename[:match.end()]
+        if trace is not None:
+            trace.append(('season', tv_filename))
+        if self.title_case:
+            tv_filename = tv_filename.title()
+        if len(tv_filename) != match.end():
+            # title() changed the length, e.g. a ligature was expanded
+            return self.classify_tv_reference(
+                first_relpath, full_filename, file_extension, trace)
+        season = tv_filename[season_start:match.end(1)]
+
+        if self.leading_season_pattern.match(tv_filename):
+            # If the season is at the beginning of the file
+            # Use the containing directory for the TV show name
+            show_name = self.dir_show_name(first_relpath)
+        elif (season_start and
+                tv_filename[season_start - 1] in self.separators):
+            show_name = tv_filename[:season_start - 1]
+        else:
+            show_name = self.show_name_pattern.sub(r'\1', tv_filename)
+        if trace is not None:
+            trace.append(('show', show_name))
+
+        if self.show_aliases:
+            show_name, tv_filename = self.alias(show_name, tv_filename, trace)
+        return Classification(
+            media_type='tv',
+            show=show_name,
+            season=season,
+            episode=match.group(2),
+            year=None,
+            extension=file_extension,
+            name=tv_filename + dot_extension)
+
+    def classify_tv_reference(self, first_relpath, full_filename,
+                              file_extension, trace=None):
+        show_name, show_season, tv_filename = tv_show_parts(
+            first_relpath, full_filename)
+        match = self.season_episode_pattern.match(
+            lower_splitext(full_filename)[0])
+        if trace is not None:
+            trace.append(('reference', tv_filename))
+        season = show_season[len(show_name) + 1:]
+        show_name, tv_filename = self.alias(show_name, tv_filename, trace)
+        return Classification(
+            media_type='tv',
+            show=show_name,
+            season=season,
+            episode=match.group(2) if match else None,
+            year=None,
+            extension=file_extension,
+            name=tv_filename)
+
+    def classify_movie(self, full_filename, file_extension, trace=None):
+        if '\n' in full_filename:
+            movie_filename = movie_name(full_filename, file_extension)
+            if trace is not None:
+                trace.append(('reference', movie_filename))
+            year = self.year_end_pattern.match(movie_filename)
+            return Classification(
+                media_type='movie', show=None, season=None, episode=None,
+                year=year.group()[-4:] if year else None,
+                extension=file_extension, name=movie_filename)
+
+        if self.strip_pattern is not None:
+            stem, dot_extension = os.path.splitext(full_filename)
+            full_filename = self.strip(stem, trace) + dot_extension
+        movie_filename = self.sanitise(full_filename)
+        if trace is not None:
+            trace.append(('sanitise', movie_filename))
+        year_end = self.year_end_pattern.match(movie_filename)
+        if year_end is None:
+            # The only year was part of a quality tag
+            return Classification(None, None, None, None, None,
+                                  file_extension, None)
+        year_end = year_end.end()
+        movie_filename = movie_filename[:year_end]
+        if trace is not None:
+            trace.append(('year', movie_filename))
+
+        return Classification(
+            media_type='movie',
+            show=None,
+            season=None,
+            episode=None,
+            year=movie_filename[year_end - 4:year_end],
+            extension=file_extension,
+            name=(movie_filename.title() if self.title_case
+                  else movie_filename) + '.' + file_extension)
+
+
+classifier = Classifier()
+
+
+@functools.lru_cache(maxsize=None)
+def classifier_for(rules):
+    """
+    Returns the Classifier of a RenameRules, compiled once per process.
+    """
+    if rules == DEFAULT_RENAME_RULES:
+        return classifier
+    return Classifier(rules)
+
+
+def video_type(full_filename):
+    """
+    Returns 'tv' or 'movie' for a video filename, or None if it is neither.
+    """
+    # Is it a TV show
+    if Classifier.tv_pattern.search(full_filename):
+        return 'tv'
+    # Is it a Movie
+    # assumes the release year is at the end of the title
+    elif Classifier.year_pattern.search(full_filename):
+        return 'movie'
+    return None
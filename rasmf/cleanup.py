@@ -0,0 +1,176 @@
+"""
+Removal of the emptied release directories from the incoming directory.
+"""
+
+import logging
+import os
+
+from rasmf.telemetry import metrics
+from rasmf.util import error_type, lower_splitext, traced
+
+
+class ScanTree(object):
+    """
+    The directories and files below the incoming directory as found by a
+    scan, updated as files are moved out, so clean_up() can decide what to
+    delete without walking the directories again.
+    """
+
+    def __init__(self):
+        self.directories = {}
+
+    def __contains__(self, path):
+        return os.path.normpath(path) in self.directories
+
+    def add(self, rootdir, dirs, files):
+        self.directories[os.path.normpath(rootdir)] = (list(dirs), set(files))
+
+    def remove_file(self, path):
+        """
+        Forget a file that has been moved out.
+        """
+        rootdir, full_filename = os.path.split(os.path.normpath(path))
+        if rootdir in self.directories:
+            self.directories[rootdir][1].discard(full_filename)
+
+    def forget(self, top):
+        """
+        Drop top and the directories below it from the tree.
+        """
+        top = os.path.normpath(top)
+        if top not in self.directories:
+            return
+        dirs, files = self.directories.pop(top)
+        for name in dirs:
+            self.forget(os.path.join(top, name))
+
+    def walk(self, top):
+        """
+        Yield (rootdir, files) bottom up for top and the directories below.
+        Symlinks to directories are yielded as files of their parent.
+        """
+        top = os.path.normpath(top)
+        if top not in self.directories:
+            return
+        dirs, files = self.directories[top]
+        files = set(files)
+        for name in dirs:
+            path = os.path.join(top, name)
+            if path in self.directories:
+                yield from self.walk(path)
+            elif os.path.islink(path):
+                files.add(name)
+        yield top, files
+
+
+def scan_tree(top, tree=None):
+    """
+    Returns a ScanTree of top and the directories below, read with a single
+    os.scandir pass over each directory.
+    """
+    if tree is None:
+        tree = ScanTree()
+
+    dirs = []
+    files = []
+    try:
+        with os.scandir(top) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+    except OSError:
+        return tree
+
+    tree.add(top, dirs, files)
+    for name in dirs:
+        scan_tree(os.path.join(top, name), tree)
+    return tree
+
+
+@traced
+def clean_up(settings, list_of_dirs, tree=None, journal=None):
+    """
+    This function removes any empty directories or directories with unwanted
+    files left behind.
+    A first level directory is kept if any file left below it has a known
+    extension, or with the sidecars option is a subtitle or sidecar.
+    Otherwise its files and directories are removed bottom up.
+    Sources stored with a strategy that keeps them stay in the ScanTree,
+    so their directories are kept for seeding.
+    The ScanTree of the scan is used when given, else each first level
+    directory is scanned once.
+    With a Journal, directories with unfinished moves out of them are kept
+    and each removal is recorded.
+    """
+    in_dir = settings.incoming_dir
+    known_extensions = (settings.video_extensions |
+                        settings.audio_extensions |
+                        settings.doc_extensions |
+                        settings.other_extensions)
+    if settings.sidecars:
+        # Sidecars not stored with a video are kept rather than deleted
+        known_extensions |= (settings.subtitle_extensions |
+                             settings.sidecar_extensions)
+
+    logger = logging.getLogger('rasmf')
+    logger.debug("list_of_dirs: %s", list_of_dirs)
+
+    # Remove duplicates from list
+    clean_list = sorted(set(list_of_dirs))
+    logger.debug("clean_list: %s", clean_list)
+
+    busy_dirs = journal.busy_dirs() if journal is not None else set()
+
+    for first_level_dir in clean_list:
+        if not first_level_dir:
+            continue
+
+        logger.info("First level directory: %s", first_level_dir)
+        if first_level_dir in busy_dirs:
+            logger.info(" Keeping %s with moves still running",
+                        first_level_dir)
+            continue
+        del_target = os.path.normpath(os.path.join(in_dir, first_level_dir))
+
+        if tree is None or del_target not in tree:
+            entries = list(scan_tree(del_target).walk(del_target))
+        else:
+            entries = list(tree.walk(del_target))
+        if not entries:
+            continue
+
+        known_files = [
+            os.path.join(rootdir, full_filename)
+            for rootdir, files in entries
+            for full_filename in files
+            if lower_splitext(full_filename)[1][1:] in known_extensions]
+        if known_files:
+            # Skip known filetypes that still exist, just in case
+            logger.debug(" Keeping %s for %s", del_target, known_files)
+            continue
+
+        if not any(files for rootdir, files in entries):
+            logger.info(" Empty directory: %s", del_target)
+
+        logger.info(" Removing directory: %s", del_target)
+        entry = None
+        if journal is not None:
+            entry = journal.begin('rmdir', sync=True,
+                                  clean_up_dir=first_level_dir)
+        try:
+            for rootdir, files in entries:
+                for full_filename in files:
+                    os.remove(os.path.join(rootdir, full_filename))
+                os.rmdir(rootdir)
+        except OSError as msg:
+            logger.error("%s: Unable to remove %s", msg, del_target)
+            metrics.inc('rasmf_errors_total', operation='clean_up',
+                        type=error_type(msg))
+            if entry is not None:
+                journal.end(entry, 'abort')
+        else:
+            metrics.inc('rasmf_directories_cleaned_total')
+            if entry is not None:
+                journal.end(entry)
@@ -0,0 +1,253 @@
+"""
+Command line entry point.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+from rasmf.classify import classifier_for
+from rasmf.cleanup import ScanTree, clean_up
+from rasmf.dedupe import dedupe_plan, open_hash_cache
+from rasmf.execute import execute_plan, schedule_plan
+from rasmf.journal import open_journal
+from rasmf.library import open_library
+from rasmf.pipeline import pipeline_stages, run_pipeline, scan_stage
+from rasmf.plan import (MEDIA_TYPE_LABELS, build_plan, classification_target,
+                        plan_to_json)
+from rasmf.settings import read_settings
+from rasmf.telemetry import write_metrics
+from rasmf.transfer import directory_cache, make_library_dirs
+from rasmf.util import logging_config, relative_path
+
+# Watch mode, --async, the scan index, the metrics server and --profile
+# import their modules when used, so a plain sweep starts without loading
+# asyncio, ctypes, sqlite3 or http.server
+
+
+def log_plan(plan):
+    logger = logging.getLogger('rasmf')
+    for operation in plan:
+        logger.info("Plan %s: %s => %s",
+                    MEDIA_TYPE_LABELS[operation.media_type],
+                    operation.source,
+                    operation.target)
+        for source, target in operation.sidecars:
+            logger.info("Plan Sidecar: %s => %s", source, target)
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Rename and store movie and TV show files.')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='plan the moves and log them without touching any file')
+    parser.add_argument(
+        '--plan', metavar='FILE',
+        help='write the plan as JSON to FILE, use - for stdout')
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='keep running and store files as they land')
+    parser.add_argument(
+        '--poll', action='store_true',
+        help='with --watch, poll the incoming directory instead of inotify')
+    parser.add_argument(
+        '--async', dest='use_async', action='store_true',
+        help='run the filesystem calls concurrently for network mounts')
+    parser.add_argument(
+        '--profile', metavar='PREFIX', nargs='?', const='',
+        help='write a cProfile PREFIX.pstats and a per file timing trace '
+             'PREFIX.timings.jsonl, by default in the log directory')
+    parser.add_argument(
+        '--explain', metavar='NAME', nargs='+',
+        help='print how the rename rules name each file NAME below the '
+             'incoming directory and exit, use - to read names from stdin')
+    return parser.parse_args(argv)
+
+
+def explain(settings, names):
+    """
+    Print the steps the rename rules take to name each file, given as a
+    path below the incoming directory, e.g. 'Release.Dir/file.mkv', and
+    its target. A name of - reads the names from stdin, one per line.
+    No file is touched.
+    """
+    classifier = classifier_for(settings.rename_rules)
+    if names == ['-']:
+        names = [line.rstrip('\n') for line in sys.stdin if line.strip()]
+
+    for name in names:
+        rootdir, full_filename = os.path.split(
+            os.path.join(settings.incoming_dir, name))
+        classification, trace = classifier.explain(
+            relative_path(rootdir, settings.incoming_dir), full_filename)
+        if classification.media_type is None:
+            trace.append(('ignored', 'not a TV show or movie'))
+        else:
+            trace.append(('target',
+                          classification_target(settings, classification)))
+        print(name)
+        for step, value in trace:
+            print('  {:<10} {}'.format(step, value))
+
+
+def sweep(settings, args, journal=None):
+    """
+    Store the files in the incoming directory as the command line asks.
+    """
+    if args.watch:
+        from rasmf.watcher import make_watcher, watch
+
+        make_library_dirs(settings)
+        watch(settings, make_watcher(settings, polling=args.poll),
+              journal=journal)
+        return
+
+    if args.use_async:
+        import asyncio
+        from rasmf.aio import async_sweep
+
+        plan = asyncio.run(async_sweep(settings, dry_run=args.dry_run,
+                                       journal=journal))
+        if args.plan == '-':
+            print(plan_to_json(plan))
+        elif args.plan:
+            with open(args.plan, 'w') as plan_file:
+                plan_file.write(plan_to_json(plan))
+        if args.dry_run:
+            log_plan(plan)
+        return
+
+    tree = ScanTree()
+    dirs = directory_cache(settings)
+    index = None
+    if settings.scan_index:
+        from rasmf.index import open_scan_index
+        index = open_scan_index(settings)
+    library = open_library(settings)
+
+    if (settings.workers <= 1 and not args.dry_run and not args.plan and
+            settings.schedule == 'scan' and not settings.renames_first and
+            settings.classify_processes <= 1):
+        # Stream each file from the scan to the library, cleaning up each
+        # release directory as soon as its last file is done
+        make_library_dirs(settings, dirs)
+        hashes = open_hash_cache(settings)
+        try:
+            run_pipeline(scan_stage(settings, index, tree),
+                         pipeline_stages(settings, index, tree, dirs, hashes,
+                                         journal, library))
+        finally:
+            if index is not None:
+                index.close()
+            if hashes is not None:
+                hashes.close()
+            if library is not None:
+                library.close()
+        return
+
+    try:
+        plan = schedule_plan(settings,
+                             build_plan(settings, index, tree, library))
+    finally:
+        if index is not None:
+            index.close()
+        if library is not None:
+            library.close()
+
+    if args.plan == '-':
+        print(plan_to_json(plan))
+    elif args.plan:
+        with open(args.plan, 'w') as plan_file:
+            plan_file.write(plan_to_json(plan))
+
+    if args.dry_run:
+        log_plan(plan)
+        return
+
+    make_library_dirs(settings, dirs)
+
+    clean_up_list = []
+    hashes = open_hash_cache(settings)
+    if hashes is not None:
+        try:
+            plan, clean_up_list = dedupe_plan(settings, plan, hashes, tree)
+        finally:
+            hashes.close()
+
+    clean_up_list += execute_plan(settings, plan, tree, dirs, journal)
+
+    # Last step clean up the incoming directory
+    clean_up(settings, clean_up_list, tree, journal)
+
+
+def profile(settings, args):
+    """
+    run() under cProfile with a TimingTrace installed.
+    """
+    import cProfile
+    from rasmf.profiling import TimingTrace
+
+    logger = logging.getLogger('rasmf')
+    prefix = args.profile or os.path.join(
+        settings.log_dir, time.strftime('rasmf_profile_%Y%m%d-%H%M%S'))
+
+    trace = TimingTrace(prefix + '.timings.jsonl')
+    trace.install()
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, settings, args)
+    finally:
+        trace.close()
+        profiler.dump_stats(prefix + '.pstats')
+        logger.info("Profile written to %s.pstats and %s",
+                    prefix, trace.path)
+
+
+def run(settings, args):
+    """
+    Sweep with the journal, metrics and metrics server of a run.
+    """
+    start = time.monotonic()
+    # Finish what a killed run left behind before scanning
+    journal = None if args.dry_run else open_journal(settings)
+
+    server = None
+    if args.watch and settings.metrics_port:
+        from rasmf.server import serve_metrics
+        server = serve_metrics(settings.metrics_port)
+    try:
+        sweep(settings, args, journal)
+    finally:
+        if journal is not None:
+            journal.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if not args.dry_run:
+            write_metrics(settings, time.monotonic() - start)
+
+
+def main(argv=None):
+    """
+    """
+    args = parse_args(argv)
+    settings = read_settings()
+
+    if args.explain:
+        explain(settings, args.explain)
+        return
+
+    logging_config(
+        log_level=settings.log_level,
+        log_dir=settings.log_dir)
+
+    if args.profile is not None:
+        profile(settings, args)
+    else:
+        run(settings, args)
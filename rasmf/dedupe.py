@@ -0,0 +1,296 @@
+"""
+Detection of files already in the library by content hash.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+
+from rasmf.plan import MoveResult, source_stat
+from rasmf.transfer import PARTIAL_SUFFIX, store_sidecars
+
+
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_SAMPLES = 4
+HASH_SAMPLE_SIZE = 64 * 1024
+
+
+def partial_hash(path):
+    """
+    Returns a hash of the size, head, tail and a few sampled middle blocks
+    of a file, or of the whole file when it is small.
+    """
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fo:
+        size = os.fstat(fo.fileno()).st_size
+        digest.update(str(size).encode())
+        if size <= 2 * HASH_BLOCK_SIZE + HASH_SAMPLES * HASH_SAMPLE_SIZE:
+            blocks = [(0, size)]
+        else:
+            middle = size - 2 * HASH_BLOCK_SIZE
+            blocks = [(0, HASH_BLOCK_SIZE)]
+            blocks.extend(
+                (HASH_BLOCK_SIZE + middle * n // (HASH_SAMPLES + 1),
+                 HASH_SAMPLE_SIZE)
+                for n in range(1, HASH_SAMPLES + 1))
+            blocks.append((size - HASH_BLOCK_SIZE, HASH_BLOCK_SIZE))
+        for offset, count in blocks:
+            digest.update(os.pread(fo.fileno(), count, offset))
+    return digest.hexdigest()
+
+
+def full_hash(path):
+    """
+    Returns a hash of the whole content of a file.
+    """
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fo:
+        for block in iter(functools.partial(fo.read, HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class HashCache(object):
+    """
+    Persistent cache of library file hashes kept in an SQLite file.
+    Hashes are keyed on the file inode, size and mtime, so files already in
+    the library are only hashed once.
+    The sizes of the files of each library directory looked at are kept for
+    the run, see same_size().
+    The cache is loaded into memory when opened, can be shared between
+    threads and is written back by flush() and close().
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY, ino INTEGER, size INTEGER,
+                mtime_ns INTEGER, partial TEXT, full TEXT)
+        """)
+
+        self.hashes = {}
+        for row in self.connection.execute(
+                "SELECT path, ino, size, mtime_ns, partial, full FROM hashes"):
+            self.hashes[row[0]] = (row[1:4], row[4], row[5])
+
+        self.dirty = set()
+        # Directory => (mtime_ns, name => (inode, size), size => [name])
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def same_size(self, directory, size):
+        """
+        Returns the paths of the files of a library directory with the given
+        size, as last seen. Raises OSError if the directory can not be read.
+        The directory is listed again when its mtime changes, or while it is
+        racily clean, but only entries that are new or have a new inode are
+        stat'ed, so each library file is stat'ed about once per run.
+        """
+        from rasmf.index import RACY_SECONDS
+
+        mtime_ns = os.stat(directory).st_mtime_ns
+        with self.lock:
+            cached = self.sizes.get(directory)
+        if cached is None or cached[0] != mtime_ns:
+            known = cached[1] if cached is not None else {}
+            files = {}
+            names = {}
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(PARTIAL_SUFFIX):
+                        continue
+                    found = known.get(entry.name)
+                    if found is None or found[0] != entry.inode():
+                        try:
+                            if not entry.is_file():
+                                continue
+                            found = (entry.inode(), entry.stat().st_size)
+                        except OSError:
+                            continue
+                    files[entry.name] = found
+                    names.setdefault(found[1], []).append(entry.name)
+            if mtime_ns >= time.time_ns() - RACY_SECONDS * 1000000000:
+                # Entries added within the same mtime tick would be missed
+                mtime_ns = None
+            cached = (mtime_ns, files, names)
+            with self.lock:
+                self.sizes[directory] = cached
+        return [os.path.join(directory, name)
+                for name in cached[2].get(size, [])]
+
+    def hash(self, path, stat, full=False):
+        """
+        Returns the partial or full hash of a library file, given its stat.
+        """
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        field = 2 if full else 1
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached is None or cached[0] != key:
+            cached = (key, None, None)
+
+        if cached[field] is None:
+            value = full_hash(path) if full else partial_hash(path)
+            cached = cached[:field] + (value, ) + cached[field + 1:]
+            with self.lock:
+                self.hashes[path] = cached
+                self.dirty.add(path)
+        return cached[field]
+
+    def flush(self):
+        """
+        Write the hashes added since the last flush.
+        """
+        with self.lock:
+            rows = [(path, ) + self.hashes[path][0] + self.hashes[path][1:]
+                    for path in self.dirty]
+            self.dirty = set()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                rows)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def open_hash_cache(settings):
+    """
+    Open the HashCache kept in the log directory, or returns None when
+    duplicates are moved like any other file.
+    """
+    if settings.duplicates == 'move':
+        return None
+    return HashCache(os.path.join(settings.log_dir, 'rasmf_hashes.sqlite'))
+
+
+def find_duplicate(operation, hashes, full=False):
+    """
+    Returns the path of a file in the target directory with the same
+    content as the source of a MoveOperation, or None.
+    The target and any other file of the same size are compared on size,
+    then partial hash, then full hash as well when full is set. Only the
+    files of the same size in HashCache.same_size() are stat'ed.
+    """
+    target_dir = os.path.dirname(operation.target)
+    source = source_stat(operation)
+    if source is None:
+        return None
+    try:
+        paths = hashes.same_size(target_dir, source.size)
+    except OSError:
+        return None
+
+    candidates = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if stat.st_size == source.size:
+            candidates.append((path, stat))
+
+    # The target itself first
+    candidates.sort(key=lambda candidate: candidate[0] != operation.target)
+
+    source_hashes = {}
+    for path, stat in candidates:
+        if (stat.st_dev, stat.st_ino) == (source.device, source.inode):
+            return path
+        try:
+            if 'partial' not in source_hashes:
+                source_hashes['partial'] = partial_hash(operation.source)
+            if hashes.hash(path, stat) != source_hashes['partial']:
+                continue
+            if full:
+                if 'full' not in source_hashes:
+                    source_hashes['full'] = full_hash(operation.source)
+                if hashes.hash(path, stat, full=True) != source_hashes['full']:
+                    continue
+        except OSError:
+            continue
+        return path
+    return None
+
+
+def deduplicate(settings, operation, hashes, tree=None):
+    """
+    Skip or hardlink the source of a MoveOperation that is already in the
+    library, according to the duplicates setting.
+    Returns a MoveResult, or None when the file is not a duplicate and
+    should be moved.
+    With hardlink the target is linked to the library copy and, with the
+    move store strategy, the source removed, so the result is that of the
+    store without copying any data. Sidecars are stored as usual.
+    A sampled hash match is only enough to skip a file, which changes
+    nothing on disk. Linking over the source needs the full hash to match.
+    A target holding other content is replaced by the move with a warning.
+    """
+    logger = logging.getLogger('rasmf')
+
+    full = (settings.duplicates_full_hash or
+            settings.duplicates == 'hardlink')
+    duplicate = find_duplicate(operation, hashes, full)
+    if duplicate is None:
+        if os.path.lexists(operation.target):
+            logger.warning("Not a duplicate, replacing %s with %s",
+                           operation.target, operation.source)
+        return None
+
+    if settings.duplicates == 'skip':
+        logger.info("Duplicate of %s, skipped: %s",
+                    duplicate, operation.source)
+        return MoveResult(operation, False)
+
+    if duplicate != operation.target and os.path.lexists(operation.target):
+        # A different file holds the target name, move over it as before
+        logger.warning("Duplicate of %s, replacing %s with %s", duplicate,
+                       operation.target, operation.source)
+        return None
+
+    moved = settings.store_strategy == 'move'
+    try:
+        if duplicate != operation.target:
+            os.link(duplicate, operation.target)
+        if moved:
+            os.remove(operation.source)
+    except OSError as msg:
+        logger.error("%s: Unable to link %s to %s",
+                     msg, duplicate, operation.target)
+        return MoveResult(operation, False)
+
+    logger.info("Duplicate of %s, linked: %s", duplicate, operation.target)
+    stored = store_sidecars(operation, settings.store_strategy)
+    if moved and tree is not None:
+        tree.remove_file(operation.source)
+        for source, _ in stored:
+            tree.remove_file(source)
+    return MoveResult(operation, moved)
+
+
+def dedupe_plan(settings, plan, hashes, tree=None):
+    """
+    Handle the duplicates in a plan.
+    Returns the operations still to move and the first level directories to
+    clean up for the duplicates that were linked.
+    """
+    remaining = []
+    clean_up_list = []
+    for operation in plan:
+        result = deduplicate(settings, operation, hashes, tree)
+        if result is None:
+            remaining.append(operation)
+        elif result.moved and operation.clean_up_dir:
+            clean_up_list.append(operation.clean_up_dir)
+    return remaining, clean_up_list
@@ -0,0 +1,185 @@
+"""
+Scheduling and concurrent execution of a plan.
+"""
+
+import collections
+import functools
+import logging
+import os
+
+from rasmf.plan import source_stat
+from rasmf.transfer import checked_move, make_target_dir
+
+
+def device_id(path, cache):
+    """
+    Returns the device id of path, caching the result by path, or None if
+    path can not be read.
+    """
+    if path not in cache:
+        try:
+            cache[path] = os.stat(path).st_dev
+        except OSError:
+            cache[path] = None
+    return cache[path]
+
+
+def target_devices(settings, plan):
+    """
+    Returns the target device of each operation of a plan, or None for a
+    rename within the device of its source.
+    The source device is taken from the FileStat of the operation when
+    known. When either device can not be read, e.g. as the library folders
+    are not created yet on a first run, the operation counts as a copy to
+    the device of its library root.
+    """
+    target_roots = {'tv': settings.tv_dir, 'movie': settings.movie_dir}
+    devices = {}
+    found = []
+    for operation in plan:
+        if operation.stat is not None:
+            source_device = operation.stat.device
+        else:
+            source_device = device_id(
+                os.path.dirname(operation.source), devices)
+        target_root = target_roots[operation.media_type]
+        target_device = device_id(target_root, devices)
+        if target_device is None:
+            target_device = target_root
+        found.append(None if source_device == target_device
+                     else target_device)
+    return found
+
+
+def move_lanes(settings, plan):
+    """
+    Group the operations of a plan into lanes.
+    Copies across devices are grouped into one lane per target device so that
+    they run one after another, while same device renames each get their own
+    lane as they are cheap metadata operations.
+    Copy lanes are returned first so the long running copies start early,
+    or last with renames_first.
+    """
+    copy_lanes = collections.OrderedDict()
+    rename_lanes = []
+
+    for operation, target_device in zip(plan, target_devices(settings, plan)):
+        if target_device is None:
+            rename_lanes.append([operation])
+        else:
+            copy_lanes.setdefault(target_device, []).append(operation)
+
+    if settings.renames_first:
+        return rename_lanes + list(copy_lanes.values())
+    return list(copy_lanes.values()) + rename_lanes
+
+
+def fair_order(plan):
+    """
+    Returns the operations of a plan taking one file of each TV show in
+    turn, with each movie as a show of its own.
+    """
+    shows = collections.OrderedDict()
+    for operation in plan:
+        if operation.media_type == 'tv':
+            show = os.path.dirname(os.path.dirname(operation.target))
+        else:
+            show = operation.target
+        shows.setdefault(show, []).append(operation)
+
+    queues = list(shows.values())
+    ordered = []
+    for turn in range(max([len(queue) for queue in queues], default=0)):
+        ordered.extend(queue[turn] for queue in queues if turn < len(queue))
+    return ordered
+
+
+def schedule_plan(settings, plan):
+    """
+    Returns the operations of a plan in the order of the schedule policy:
+    the scan order, smallest-first or oldest-first by source file,
+    tv-first, or fair between shows.
+    With renames_first, same device renames go before copies, so files
+    that are quick to store are not held up by a long copy.
+    Ties keep the scan order. Sizes and ages are those of the FileStat
+    taken when planning.
+    """
+    if settings.schedule in ('smallest-first', 'oldest-first'):
+        keys = {}
+        for operation in plan:
+            stat = source_stat(operation)
+            if stat is None:
+                # Fails straight away when moved
+                keys[operation.source] = 0
+            elif settings.schedule == 'smallest-first':
+                keys[operation.source] = stat.size
+            else:
+                keys[operation.source] = stat.mtime_ns
+        plan = sorted(plan, key=lambda operation: keys[operation.source])
+    elif settings.schedule == 'tv-first':
+        plan = sorted(plan, key=lambda operation: operation.media_type != 'tv')
+    elif settings.schedule == 'fair':
+        plan = fair_order(plan)
+
+    if settings.renames_first:
+        devices = target_devices(settings, plan)
+        plan = ([operation for operation, device in zip(plan, devices)
+                 if device is None] +
+                [operation for operation, device in zip(plan, devices)
+                 if device is not None])
+    return plan
+
+
+def move_lane(lane, tree=None, dirs=None, strategy='move', journal=None):
+    """
+    Store the files of one lane in order, returning the first level
+    directories to clean up.
+    Moved files are removed from the ScanTree if given. Files stored with a
+    strategy that keeps the source leave nothing to clean up.
+    """
+    clean_up_items = []
+    for operation in lane:
+        clean_up_item = checked_move(operation, dirs, strategy, journal,
+                                     tree)
+        if strategy != 'move':
+            continue
+        if clean_up_item:
+            clean_up_items.append(clean_up_item)
+    return clean_up_items
+
+
+def execute_plan(settings, plan, tree=None, dirs=None, journal=None):
+    """
+    Apply the operations of a plan.
+    All target directories are created up front, then the files are moved.
+    With more than one worker the lanes from move_lanes() run concurrently in
+    a bounded thread pool.
+    Moved files are removed from the ScanTree if given, target
+    directories are checked through the DirectoryCache if given and moves
+    are recorded in the Journal if given.
+    Returns the list of first level directories to clean up.
+    """
+    logger = logging.getLogger('rasmf')
+
+    for target_dir in sorted(set(os.path.dirname(operation.target)
+                                 for operation in plan)):
+        make_target_dir(target_dir, dirs)
+
+    if settings.workers <= 1:
+        return move_lane(plan, tree, dirs, settings.store_strategy, journal)
+
+    import concurrent.futures
+
+    lanes = move_lanes(settings, plan)
+    logger.debug("%d lanes over %d workers", len(lanes), settings.workers)
+
+    clean_up_list = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.workers) as executor:
+        for clean_up_items in executor.map(
+                functools.partial(move_lane, tree=tree, dirs=dirs,
+                                  strategy=settings.store_strategy,
+                                  journal=journal),
+                lanes):
+            clean_up_list.extend(clean_up_items)
+    return clean_up_list
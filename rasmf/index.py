@@ -0,0 +1,196 @@
+"""
+SQLite index of the incoming directory, to skip unchanged directories
+and classifications between runs.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from rasmf.plan import MoveOperation
+
+
+# Directories modified less than this long before the index was opened are
+# listed again next time, as an entry added within the same mtime tick as
+# the listing would not change the mtime
+RACY_SECONDS = 2
+
+
+class ScanIndex(object):
+    """
+    Persistent index of the incoming directory kept in an SQLite file.
+    Directory listings are keyed on the directory mtime and classification
+    results on the file inode, size and mtime, so repeated sweeps only list
+    changed directories and only classify new or changed video files.
+    Listings of racily clean directories, modified within RACY_SECONDS of
+    opening the index, are not kept, as git does for its index.
+    The index is loaded into memory when opened and written back by close().
+    """
+
+    version = 3
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.racy_ns = time.time_ns() - RACY_SECONDS * 1000000000
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER,
+                subdirs TEXT, files TEXT);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, ino INTEGER, size INTEGER,
+                mtime_ns INTEGER, operation TEXT);
+        """)
+
+        # Classifications depend on the settings, start afresh if they change
+        fingerprint = json.dumps([
+            self.version,
+            settings.incoming_dir,
+            settings.movie_dir,
+            settings.tv_dir,
+            sorted(settings.video_extensions),
+            repr(settings.rename_rules),
+        ])
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            with self.connection:
+                self.connection.execute("DELETE FROM directories")
+                self.connection.execute("DELETE FROM files")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)",
+                    (fingerprint, ))
+
+        self.directories = {}
+        for path, mtime_ns, subdirs, files in self.connection.execute(
+                "SELECT path, mtime_ns, subdirs, files FROM directories"):
+            self.directories[path] = (
+                mtime_ns, json.loads(subdirs), json.loads(files))
+
+        self.files = {}
+        for path, ino, size, mtime_ns, operation in self.connection.execute(
+                "SELECT path, ino, size, mtime_ns, operation FROM files"):
+            self.files[path] = ((ino, size, mtime_ns), operation)
+
+        self.seen_directories = set()
+        self.seen_files = set()
+        self.dirty_directories = set()
+        self.dirty_files = set()
+
+    def listing(self, dirpath, mtime_ns):
+        """
+        Returns the cached (subdirs, files) of a directory, or None if the
+        directory is unknown or its mtime has changed.
+        """
+        self.seen_directories.add(dirpath)
+        cached = self.directories.get(dirpath)
+        if cached and cached[0] == mtime_ns:
+            return cached[1], cached[2]
+        return None
+
+    def set_listing(self, dirpath, mtime_ns, subdirs, files):
+        self.seen_directories.add(dirpath)
+        if mtime_ns >= self.racy_ns:
+            return
+        self.directories[dirpath] = (mtime_ns, subdirs, files)
+        self.dirty_directories.add(dirpath)
+
+    def classification(self, path, key):
+        """
+        Returns a tuple of (found, operation) for a file, where key is the
+        (inode, size, mtime_ns) of the file.
+        The operation may be None for a file that is not a TV show or movie.
+        Its sidecars and FileStat are not cached.
+        """
+        self.seen_files.add(path)
+        cached = self.files.get(path)
+        if cached and cached[0] == key:
+            if cached[1] is None:
+                return True, None
+            operation = MoveOperation(*json.loads(cached[1]))
+            return True, operation._replace(
+                clean_up_dir=sys.intern(operation.clean_up_dir))
+        return False, None
+
+    def set_classification(self, path, key, operation):
+        self.seen_files.add(path)
+        if operation is not None:
+            operation = json.dumps(list(operation[:4]))
+        self.files[path] = (key, operation)
+        self.dirty_files.add(path)
+
+    def close(self):
+        """
+        Write changed entries, drop entries not seen during the sweep and
+        close the index.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM directories WHERE path = ?",
+                [(path, ) for path in self.directories
+                 if path not in self.seen_directories])
+            self.connection.executemany(
+                "DELETE FROM files WHERE path = ?",
+                [(path, ) for path in self.files
+                 if path not in self.seen_files])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                [(path,
+                  self.directories[path][0],
+                  json.dumps(self.directories[path][1]),
+                  json.dumps(self.directories[path][2]))
+                 for path in self.dirty_directories])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                [(path, ) + self.files[path][0] + (self.files[path][1], )
+                 for path in self.dirty_files])
+        self.connection.close()
+
+
+def open_scan_index(settings):
+    """
+    Open the ScanIndex kept in the log directory.
+    """
+    return ScanIndex(os.path.join(settings.log_dir, 'rasmf_index.sqlite'),
+                     settings)
+
+
+def indexed_walk(rootdir, index):
+    """
+    Yield (rootdir, dirs, files) bottom up like os.walk(topdown=False),
+    taking the listing of directories whose mtime is unchanged from the
+    index.
+    A directory mtime only changes when entries are added to or removed from
+    that directory, so subdirectories are still checked with a single stat.
+    """
+    try:
+        mtime_ns = os.stat(rootdir).st_mtime_ns
+    except OSError:
+        return
+
+    listing = index.listing(rootdir, mtime_ns)
+    if listing is None:
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(rootdir) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # os.walk does not descend into symlinked directories
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+        except OSError:
+            return
+        index.set_listing(rootdir, mtime_ns, subdirs, files)
+    else:
+        subdirs, files = listing
+
+    for name in subdirs:
+        yield from indexed_walk(os.path.join(rootdir, name), index)
+    yield rootdir, subdirs, files
@@ -0,0 +1,235 @@
+"""
+Journal of moves and removals, replayed after a crash.
+"""
+
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+
+from rasmf.cleanup import clean_up
+from rasmf.telemetry import metrics
+from rasmf.util import error_type
+
+
+class Journal(object):
+    """
+    Append-only journal of the moves and directory removals of a run, kept
+    in log_dir so that a run killed part way through can be finished or
+    rolled back by recover_journal() on the next start.
+    Each entry is recorded as intent, progress once a copied target is
+    complete, then commit or abort, as one JSON line per record.
+    Records are fsynced in batches of batch_size. Losing the last batch is
+    safe as every move ends in an atomic rename the next sweep can see, so
+    only directory removals are synced before they start.
+    lock_fd is the descriptor from lock_journal(), released by close().
+    Safe to share between threads.
+    """
+
+    def __init__(self, path, batch_size=64, lock_fd=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.lock_fd = lock_fd
+        self.fo = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.unsynced = 0
+        self.open_entries = {}
+
+    def write(self, record, sync=False):
+        with self.lock:
+            self.fo.write(json.dumps(record) + '\n')
+            self.unsynced += 1
+            if sync or self.unsynced >= self.batch_size:
+                self.fo.flush()
+                os.fsync(self.fo.fileno())
+                self.unsynced = 0
+
+    def begin(self, kind, sync=False, **fields):
+        """
+        Record the intent of a move or rmdir entry, returning its id.
+        """
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.open_entries[entry_id] = dict(fields, kind=kind)
+        self.write(dict(fields, id=entry_id, kind=kind, state='intent'),
+                   sync)
+        return entry_id
+
+    def progress(self, entry_id):
+        self.write({'id': entry_id, 'state': 'progress'})
+
+    def end(self, entry_id, state='commit'):
+        """
+        Record that an entry was committed, or aborted with nothing changed.
+        """
+        with self.lock:
+            self.open_entries.pop(entry_id, None)
+        self.write({'id': entry_id, 'state': state})
+
+    def busy_dirs(self):
+        """
+        Returns the first level directories with unfinished moves.
+        """
+        with self.lock:
+            return set(entry['clean_up_dir']
+                       for entry in self.open_entries.values()
+                       if entry['kind'] == 'move')
+
+    def close(self):
+        """
+        Sync the journal and close it, emptying it if every entry ended,
+        then release its lock.
+        """
+        with self.lock:
+            self.fo.flush()
+            if not self.open_entries:
+                os.ftruncate(self.fo.fileno(), 0)
+            os.fsync(self.fo.fileno())
+            self.fo.close()
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+
+def lock_journal(path):
+    """
+    Returns a file descriptor of the journal holding an exclusive flock()
+    on it, or None if another run holds the lock.
+    The lock lasts until the descriptor is closed. Where flock() is not
+    available or not supported by the filesystem the descriptor is returned
+    without it.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        import fcntl
+    except ImportError:
+        return fd
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    except OSError as msg:
+        logging.getLogger('rasmf').warning(
+            "%s: Unable to lock %s", msg, path)
+    return fd
+
+
+def read_journal(path):
+    """
+    Returns the entries of a journal that never ended, in order, each as a
+    dict of its fields and last state.
+    """
+    entries = collections.OrderedDict()
+    try:
+        with open(path, encoding='utf-8') as fo:
+            for line in fo:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A record torn by the crash
+                    continue
+                entries.setdefault(record['id'], {}).update(record)
+    except FileNotFoundError:
+        return []
+    return [entry for entry in entries.values()
+            if 'kind' in entry and entry['state'] not in ('commit', 'abort')]
+
+
+def recover_move(entry):
+    """
+    Finish or roll back a move entry left unfinished by a killed run.
+    """
+    logger = logging.getLogger('rasmf')
+    source = entry['source']
+    target = entry['target']
+
+    try:
+        source_size = os.stat(source).st_size
+    except OSError:
+        source_size = None
+    try:
+        target_size = os.stat(target).st_size
+    except OSError:
+        target_size = None
+
+    if target_size is None:
+        if source_size is None:
+            logger.error("Recovery: lost %s, %s does not exist either",
+                         source, target)
+        else:
+            logger.warning("Recovery: rolled back move of %s to %s, "
+                           "a partial copy is resumed by the next sweep",
+                           source, target)
+    elif source_size is None:
+        logger.info("Recovery: move of %s to %s had finished",
+                    source, target)
+    elif (entry['state'] == 'progress' and entry['strategy'] == 'move' and
+            source_size == target_size):
+        # The copy was complete, only removing the source was left
+        os.remove(source)
+        logger.warning("Recovery: finished move of %s to %s",
+                       source, target)
+    else:
+        logger.warning("Recovery: rolled back move of %s to %s",
+                       source, target)
+
+
+def recover_journal(settings, path):
+    """
+    Finish or roll back the entries a killed run left unfinished in a
+    journal, then empty it.
+    Moves are recovered first, so the directory removals that are replayed
+    with clean_up() see where their files ended up.
+    Returns the number of entries recovered.
+    """
+    logger = logging.getLogger('rasmf')
+
+    entries = read_journal(path)
+    clean_up_dirs = []
+    for entry in entries:
+        if entry['kind'] == 'move':
+            try:
+                recover_move(entry)
+            except OSError as msg:
+                metrics.inc('rasmf_errors_total', operation='recovery',
+                            type=error_type(msg))
+                logger.error("%s: Recovery of %s failed",
+                             msg, entry['source'])
+        elif entry['kind'] == 'rmdir':
+            clean_up_dirs.append(entry['clean_up_dir'])
+    if clean_up_dirs:
+        clean_up(settings, clean_up_dirs)
+
+    if os.path.exists(path):
+        with open(path, 'w'):
+            pass
+    return len(entries)
+
+
+def open_journal(settings):
+    """
+    Lock and recover the journal kept in the log directory and open it for
+    this run, or returns None when the journal is turned off.
+    Exits when another run, e.g. an earlier sweep started by cron that is
+    still copying, holds the journal, as recovering it would undo that
+    run's moves.
+    """
+    if not settings.journal:
+        return None
+    path = os.path.join(settings.log_dir, 'rasmf_journal.jsonl')
+    lock_fd = lock_journal(path)
+    if lock_fd is None:
+        logging.getLogger('rasmf').warning(
+            "Another run is using %s, exiting", path)
+        sys.exit(0)
+    try:
+        recover_journal(settings, path)
+        return Journal(path, settings.journal_batch, lock_fd)
+    except BaseException:
+        os.close(lock_fd)
+        raise
@@ -0,0 +1,228 @@
+"""
+Index of the shows, seasons and movies already in the library, so new files
+join the existing folders whatever the case or year of their names.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+
+from rasmf.telemetry import metrics
+
+
+# Separators, brackets and a trailing year, e.g. '.2019' or ' (2019)'
+TRAILING_YEAR_PATTERN = re.compile(r'[-._ ([]*(19|20)[0-9][0-9][)\]]*$')
+NON_ALNUM_PATTERN = re.compile(r'[^0-9a-z]+')
+
+
+def name_key(name):
+    """
+    Returns the key of a file name, lowercase letters and digits only, so
+    'Big.Movie.2012.mkv' and 'big movie 2012.mkv' share a key.
+    """
+    return NON_ALNUM_PATTERN.sub('', name.lower())
+
+
+def show_key(name):
+    """
+    Returns the key of a show folder, the name_key() without a trailing year,
+    so 'Me.And.My.Dog', 'Me.and.My.Dog' and 'Me.And.My.Dog.2019' share a key.
+    """
+    return name_key(TRAILING_YEAR_PATTERN.sub('', name))
+
+
+def season_key(name):
+    """
+    Returns the key of a season folder, its season, e.g. 's01' for
+    'Show.Name-S01'.
+    """
+    return name.rsplit('-', 1)[-1].lower()
+
+
+class LibraryIndex(object):
+    """
+    Persistent index of the show, season and movie names in tv_dir and
+    movie_dir, kept in an SQLite file.
+    The listing of each library directory is keyed on the directory mtime
+    and only read again when that changes, the first time the directory is
+    looked at in a run, or after a flush(). resolve() maps the target of a
+    MoveOperation onto the existing folders and files with dictionary
+    lookups.
+    Safe to share between threads, including the SQLite connection which is
+    only used when opening, flushing and closing.
+    """
+
+    def __init__(self, path, settings):
+        import sqlite3
+
+        self.path = path
+        self.settings = settings
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, entries TEXT)""")
+
+        self.directories = {}
+        for path, mtime_ns, entries in self.connection.execute(
+                "SELECT path, mtime_ns, entries FROM directories"):
+            self.directories[path] = (mtime_ns, json.loads(entries))
+
+        # Key => name of the entries of each directory looked at since the
+        # last flush
+        self.keys = {}
+        # Targets added by resolve() since the last flush
+        self.planned = set()
+        self.dirty = set()
+        self.missing = set()
+        self.lock = threading.Lock()
+
+    def entries(self, path, key):
+        """
+        Returns a dict of key(name) to name for the entries of a library
+        directory, empty if it does not exist. Where two entries share a key
+        the first in sorted order wins.
+        """
+        if path in self.keys:
+            return self.keys[path]
+
+        names = []
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            self.missing.add(path)
+        else:
+            cached = self.directories.get(path)
+            if cached and cached[0] == mtime_ns:
+                names = cached[1]
+            else:
+                try:
+                    names = sorted(os.listdir(path))
+                except OSError:
+                    pass
+                self.directories[path] = (mtime_ns, names)
+                self.dirty.add(path)
+
+        keys = {}
+        for name in names:
+            keys.setdefault(key(name), name)
+        self.keys[path] = keys
+        return keys
+
+    def resolve(self, operation):
+        """
+        Returns operation with its target renamed to the existing show and
+        season folders and file of the same key, and records the names of
+        new ones for the later operations of the run.
+        A target that is already in the library is counted as a collision.
+        The operation is then dropped with a warning, or with a duplicates
+        setting other than move returned for the dedupe stage to handle,
+        so library files are not replaced unnoticed.
+        Returns None for a dropped operation.
+        """
+        if operation.media_type == 'tv':
+            top = self.settings.tv_dir
+        else:
+            top = self.settings.movie_dir
+        parts = os.path.relpath(operation.target, top).split(os.sep)
+        if parts[0] == os.pardir:
+            return operation
+
+        with self.lock:
+            if operation.media_type == 'tv' and len(parts) == 3:
+                target = self.resolve_tv(*parts)
+            elif operation.media_type == 'movie' and len(parts) == 1:
+                target = self.resolve_file(top, parts[0])
+            else:
+                return operation
+            in_library = target not in self.planned
+
+        logger = logging.getLogger('rasmf')
+        if in_library:
+            metrics.inc('rasmf_library_collisions_total')
+            if self.settings.duplicates == 'move':
+                logger.warning("Already in library, skipping %s => %s",
+                               operation.source, target)
+                return None
+            logger.debug("Already in library: %s", target)
+        elif target != operation.target:
+            logger.debug("Library has %s for %s", target, operation.target)
+        return operation._replace(target=target)
+
+    def resolve_many(self, operations):
+        """
+        Returns the resolve()d operations, without those dropped.
+        """
+        resolved = [self.resolve(operation) for operation in operations]
+        return [operation for operation in resolved if operation is not None]
+
+    def resolve_tv(self, show, season, filename):
+        tv_dir = self.settings.tv_dir
+        shows = self.entries(tv_dir, show_key)
+        show_name = shows.setdefault(show_key(show), show)
+
+        # The season folder and file names start with the show name
+        if season.startswith(show):
+            season = show_name + season[len(show):]
+        if filename.startswith(show):
+            filename = show_name + filename[len(show):]
+
+        show_dir = os.path.join(tv_dir, show_name)
+        seasons = self.entries(show_dir, season_key)
+        season_name = seasons.setdefault(season_key(season), season)
+        return self.resolve_file(os.path.join(show_dir, season_name),
+                                 filename)
+
+    def resolve_file(self, directory, filename):
+        files = self.entries(directory, name_key)
+        key = name_key(filename)
+        if key not in files:
+            files[key] = filename
+            path = os.path.join(directory, filename)
+            self.planned.add(path)
+            return path
+
+        return os.path.join(directory, files[key])
+
+    def flush(self):
+        """
+        Write changed listings and drop those of directories that are gone.
+        The keys of each directory are forgotten, so the next resolve()
+        checks its mtime again and sees entries added by other programs.
+        Call it between operations, as their planned targets are forgotten
+        as well.
+        """
+        with self.lock:
+            missing = [(path, ) for path in self.missing]
+            rows = [(path,
+                     self.directories[path][0],
+                     json.dumps(self.directories[path][1]))
+                    for path in self.dirty]
+            self.missing = set()
+            self.dirty = set()
+            self.keys = {}
+            self.planned = set()
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM directories WHERE path = ?", missing)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", rows)
+
+    def close(self):
+        """
+        flush() and close the index.
+        """
+        self.flush()
+        self.connection.close()
+
+
+def open_library(settings):
+    """
+    Open the LibraryIndex kept in the log directory, or returns None when
+    the library_index option is off.
+    """
+    if not settings.library_index:
+        return None
+    return LibraryIndex(
+        os.path.join(settings.log_dir, 'rasmf_library.sqlite'), settings)
@@ -0,0 +1,187 @@
+"""
+Streaming pipeline from the scan to the library, one file at a time.
+"""
+
+import collections
+import functools
+import os
+
+from rasmf.cleanup import clean_up
+from rasmf.dedupe import deduplicate
+from rasmf.plan import (MoveOperation, MoveResult, extend_plan, plan_directory,
+                        scan_incoming)
+from rasmf.sidecars import sidecar_grouper
+from rasmf.transfer import execute_operation
+from rasmf.util import relative_path
+
+
+ScanEntry = collections.namedtuple('ScanEntry', [
+    'rootdir',
+    'name',
+    'first_dir',
+])
+ScanEntry.__doc__ = """
+A file found by scan_stage() in rootdir, below the first level incoming
+directory first_dir.
+"""
+
+
+ReleaseDone = collections.namedtuple('ReleaseDone', ['first_dir'])
+ReleaseDone.__doc__ = """
+Marker passed down the pipeline once every file below the first level
+incoming directory first_dir has been yielded.
+"""
+
+
+def scan_stage(settings, index=None, tree=None):
+    """
+    Pipeline stage yielding a ScanEntry for each file below the incoming
+    directory, and a ReleaseDone after the last file of each first level
+    directory. The directories scanned are recorded in the ScanTree if given.
+    """
+    in_dir = os.path.normpath(settings.incoming_dir)
+
+    for rootdir, dirs, files in scan_incoming(settings.incoming_dir, index):
+        if tree is not None:
+            tree.add(rootdir, dirs, files)
+
+        first_dir = relative_path(rootdir, settings.incoming_dir)
+        for full_filename in files:
+            yield ScanEntry(rootdir, full_filename, first_dir)
+
+        # The walk is bottom up so a first level directory comes after
+        # everything below it
+        if first_dir and os.path.dirname(os.path.normpath(rootdir)) == in_dir:
+            yield ReleaseDone(first_dir)
+
+
+def directory_entries(items):
+    """
+    Yield a list of the consecutive ScanEntries of each directory, passing
+    the other items on.
+    """
+    batch = []
+    for item in items:
+        if isinstance(item, ScanEntry):
+            if batch and item.rootdir != batch[0].rootdir:
+                yield batch
+                batch = []
+            batch.append(item)
+            continue
+        if batch:
+            yield batch
+            batch = []
+        yield item
+    if batch:
+        yield batch
+
+
+def classify_stage(settings, items, index=None, library=None):
+    """
+    Pipeline stage turning each ScanEntry of a video file into a
+    MoveOperation. Other entries are dropped, markers are passed on.
+    Operations whose target collides with an earlier one are dropped.
+    Targets are resolved in the LibraryIndex if given.
+    With the sidecars option the entries of each directory are classified
+    together, so its sidecar files are grouped with their videos.
+    """
+    targets = set()
+    sidecars = sidecar_grouper(settings)
+    if sidecars is not None:
+        items = directory_entries(items)
+    for item in items:
+        if isinstance(item, ScanEntry):
+            item = [item]
+        elif not isinstance(item, list):
+            yield item
+            continue
+
+        operations = plan_directory(settings, item[0].rootdir,
+                                    [entry.name for entry in item],
+                                    index, library, sidecars)
+        plan = []
+        extend_plan(plan, targets, operations)
+        yield from plan
+
+
+def dedupe_stage(settings, items, hashes, tree=None):
+    """
+    Pipeline stage turning each MoveOperation whose source is already in
+    the library into a MoveResult, see deduplicate().
+    """
+    for item in items:
+        if isinstance(item, MoveOperation):
+            result = deduplicate(settings, item, hashes, tree)
+            if result is not None:
+                item = result
+        yield item
+
+
+def move_stage(items, tree=None, dirs=None, strategy='move', journal=None):
+    """
+    Pipeline stage storing the file of each MoveOperation, yielding a
+    MoveResult. Moved files are removed from the ScanTree if given.
+    A file stored with a strategy that keeps the source is not moved.
+    """
+    for item in items:
+        if not isinstance(item, MoveOperation):
+            yield item
+            continue
+
+        stored = execute_operation(item, dirs, strategy, journal,
+                                   tree) is not None
+        yield MoveResult(item, stored and strategy == 'move')
+
+
+def clean_up_stage(settings, items, tree=None, journal=None):
+    """
+    Pipeline stage cleaning up each first level directory as soon as its
+    ReleaseDone arrives, if any of its files were moved.
+    Everything is passed on.
+    """
+    moved_dirs = set()
+    for item in items:
+        if isinstance(item, MoveResult) and item.moved:
+            moved_dirs.add(item.operation.clean_up_dir)
+
+        elif isinstance(item, ReleaseDone):
+            if item.first_dir in moved_dirs:
+                moved_dirs.discard(item.first_dir)
+                clean_up(settings, [item.first_dir], tree, journal)
+            if tree is not None:
+                tree.forget(os.path.join(settings.incoming_dir,
+                                         item.first_dir))
+
+        yield item
+
+
+def pipeline_stages(settings, index=None, tree=None, dirs=None,
+                    hashes=None, journal=None, library=None):
+    """
+    Returns the default stages after scan_stage() for a sweep, as callables
+    taking and returning an iterable of items.
+    Duplicates are looked for when given a HashCache.
+    """
+    stages = [functools.partial(classify_stage, settings, index=index,
+                                library=library)]
+    if hashes is not None:
+        stages.append(functools.partial(dedupe_stage, settings,
+                                        hashes=hashes, tree=tree))
+    stages.extend([
+        functools.partial(move_stage, tree=tree, dirs=dirs,
+                          strategy=settings.store_strategy, journal=journal),
+        functools.partial(clean_up_stage, settings, tree=tree,
+                          journal=journal),
+    ])
+    return stages
+
+
+def run_pipeline(items, stages):
+    """
+    Chain the stages onto items and consume the result.
+    Items are processed one at a time, so memory use does not grow with the
+    size of the incoming directory.
+    """
+    for stage in stages:
+        items = stage(items)
+    collections.deque(items, maxlen=0)
@@ -0,0 +1,415 @@
+"""
+Planning of the moves from the incoming directory into the library.
+"""
+
+import collections
+import functools
+import json
+import logging
+import os
+
+from rasmf.classify import classifier_for
+from rasmf.sidecars import sidecar_grouper
+from rasmf.telemetry import metrics
+from rasmf.util import relative_path
+
+
+FileStat = collections.namedtuple('FileStat', [
+    'size',
+    'mtime_ns',
+    'device',
+    'inode',
+])
+FileStat.__doc__ = """
+The stat of a source file taken when it is planned.
+"""
+
+
+MoveOperation = collections.namedtuple('MoveOperation', [
+    'media_type',
+    'source',
+    'target',
+    'clean_up_dir',
+    'sidecars',
+    'stat',
+], defaults=[(), None])
+MoveOperation.__doc__ = """
+A planned move of a source file to its target path in the library.
+clean_up_dir is the first level incoming directory holding the source.
+sidecars is a tuple of (source, target) pairs of the subtitle and other
+sidecar files stored along with it.
+stat is the FileStat of the source from the scan, so scheduling and
+storing the file do not stat it again, or None if it is not known.
+"""
+
+
+MoveResult = collections.namedtuple('MoveResult', ['operation', 'moved'])
+MoveResult.__doc__ = """
+The outcome of a MoveOperation in move_stage().
+"""
+
+
+MEDIA_TYPE_LABELS = {'tv': 'TV', 'movie': 'Movie'}
+
+
+# Video files sent to a classify process at a time
+CLASSIFY_BATCH_SIZE = 2048
+
+
+def file_stat(path):
+    """
+    Returns the FileStat of a file, or None if it can not be read.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return FileStat(stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino)
+
+
+def source_stat(operation):
+    """
+    Returns the FileStat of the source of a MoveOperation, as planned or
+    else read now, or None if the source is gone.
+    """
+    if operation.stat is not None:
+        return operation.stat
+    return file_stat(operation.source)
+
+
+def classification_target(settings, classification):
+    """
+    Returns the target path in the library of a Classification.
+    """
+    if classification.media_type == 'tv':
+        return os.path.join(
+            settings.tv_dir,
+            classification.show,
+            classification.show + '-' + classification.season,
+            classification.name)
+    return os.path.join(settings.movie_dir, classification.name)
+
+
+def tv_show_target(settings, source_dir, source_filename):
+    """
+    Returns the target path of a TV show file in the TV directory,
+    e.g. tv_dir/Tv.Show.Name/Tv.Show.Name-S01/Tv.Show.Name-S01E01.avi
+    """
+    first_relpath = relative_path(source_dir, settings.incoming_dir)
+    file_extension = os.path.splitext(source_filename)[1]
+    file_extension = file_extension.replace('.', '').lower()
+    classification = classifier_for(settings.rename_rules).classify_tv(
+        first_relpath, source_filename, file_extension)
+    return classification_target(settings, classification)
+
+
+def movie_target(settings, source_filename, file_extension):
+    """
+    Returns the target path of a movie file in the movie directory,
+    e.g. movie_dir/Movie.Title.2001.avi
+    """
+    classifier = classifier_for(settings.rename_rules)
+    return classification_target(
+        settings, classifier.classify_movie(source_filename, file_extension))
+
+
+def operation_from_classification(settings, rootdir, full_filename,
+                                  classification, clean_up_dir=None,
+                                  stat=None):
+    """
+    Returns the MoveOperation storing a classified file, or None if the file
+    is neither a TV show nor a movie.
+    clean_up_dir is the relative_path() of rootdir and stat the FileStat of
+    the file when already known, the file is stat'ed otherwise.
+    """
+    if classification.media_type is None:
+        return None
+
+    if clean_up_dir is None:
+        clean_up_dir = relative_path(rootdir, settings.incoming_dir)
+    source = os.path.join(rootdir, full_filename)
+    if stat is None:
+        stat = file_stat(source)
+    return MoveOperation(
+        media_type=classification.media_type,
+        source=source,
+        target=classification_target(settings, classification),
+        clean_up_dir=clean_up_dir,
+        stat=stat)
+
+
+def plan_video_file(settings, rootdir, full_filename, file_extension,
+                    stat=None):
+    """
+    Determine if the video file is a TV show or movie and return the
+    MoveOperation that would store it, or None.
+    No files are touched.
+    """
+    logger = logging.getLogger('rasmf')
+
+    classification = classifier_for(settings.rename_rules).classify(
+        relative_path(rootdir, settings.incoming_dir), full_filename)
+    if classification.media_type:
+        logger.debug("%s: %s",
+                     MEDIA_TYPE_LABELS[classification.media_type],
+                     full_filename)
+
+    return operation_from_classification(
+        settings, rootdir, full_filename, classification, stat=stat)
+
+
+def scan_incoming(incoming_dir, index=None):
+    """
+    Yield (rootdir, dirs, files) for each directory below the incoming
+    directory, bottom up. The ScanIndex is used when given.
+    """
+    if index is None:
+        yield from os.walk(incoming_dir, topdown=False)
+    else:
+        from rasmf.index import indexed_walk
+        yield from indexed_walk(incoming_dir, index)
+
+
+def indexed_plan_video_file(settings, rootdir, full_filename, file_extension,
+                            index):
+    """
+    plan_video_file() with the classification cached in the ScanIndex.
+    """
+    path = os.path.join(rootdir, full_filename)
+    stat = file_stat(path)
+    if stat is None:
+        return None
+
+    key = (stat.inode, stat.size, stat.mtime_ns)
+    found, operation = index.classification(path, key)
+    if not found:
+        operation = plan_video_file(
+            settings, rootdir, full_filename, file_extension, stat)
+        index.set_classification(path, key, operation)
+    elif operation is not None:
+        operation = operation._replace(stat=stat)
+    return operation
+
+
+def plan_directory(settings, rootdir, files, index=None, library=None,
+                   sidecars=None):
+    """
+    Returns the MoveOperations for the video files in one directory listing.
+    The ScanIndex is used to look up cached classifications when given, and
+    the targets are resolved in the LibraryIndex when given.
+    The sidecar files of the listing are grouped with their videos by the
+    SidecarGrouper when given.
+    """
+    metrics.inc('rasmf_files_scanned_total', len(files))
+    video_files = []
+    for full_filename in files:
+        # get lowercase file extension
+        file_extension = os.path.splitext(full_filename)[1]
+        file_extension = file_extension.replace('.', '').lower()
+
+        if file_extension in settings.video_extensions:
+            video_files.append((full_filename, file_extension))
+
+    if not video_files:
+        operations = []
+    elif index is None:
+        first_relpath = relative_path(rootdir, settings.incoming_dir)
+        classifications = classifier_for(settings.rename_rules).classify_many(
+            first_relpath,
+            [full_filename for full_filename, _ in video_files])
+        operations = [
+            operation_from_classification(
+                settings, rootdir, full_filename, classification,
+                first_relpath)
+            for (full_filename, _), classification in zip(
+                video_files, classifications)]
+    else:
+        operations = [
+            indexed_plan_video_file(
+                settings, rootdir, full_filename, file_extension, index)
+            for full_filename, file_extension in video_files]
+
+    operations = count_classified(operations)
+    if library is not None:
+        operations = library.resolve_many(operations)
+    if sidecars is not None:
+        operations = sidecars.group(rootdir, files, operations)
+    return operations
+
+
+def count_classified(operations):
+    """
+    Count the classification of each video file, where an operation of None
+    is a file that is neither a TV show nor a movie.
+    Returns the operations that are not None.
+    """
+    planned = [operation for operation in operations if operation is not None]
+    for operation in planned:
+        metrics.inc('rasmf_files_classified_total',
+                    media_type=operation.media_type)
+    if len(planned) < len(operations):
+        metrics.inc('rasmf_files_classified_total',
+                    len(operations) - len(planned), media_type='ignored')
+    return planned
+
+
+def extend_plan(plan, targets, operations):
+    """
+    Append operations to a plan, dropping those whose target is already in
+    the set of planned targets.
+    """
+    logger = logging.getLogger('rasmf')
+
+    for operation in operations:
+        if operation.target in targets:
+            logger.warning("Target collision, skipping %s => %s",
+                           operation.source, operation.target)
+            continue
+
+        targets.add(operation.target)
+        plan.append(operation)
+
+
+def classify_files(settings, batch):
+    """
+    Returns the (media_type, target) of each (rootdir, filename) of a batch,
+    or None for a file that is neither a TV show nor a movie.
+    Runs in the classify processes, so the results are kept small.
+    """
+    classifier = classifier_for(settings.rename_rules)
+    results = []
+    for rootdir, full_filename in batch:
+        classification = classifier.classify(
+            relative_path(rootdir, settings.incoming_dir), full_filename)
+        if classification.media_type is None:
+            results.append(None)
+        else:
+            results.append((classification.media_type,
+                            classification_target(settings, classification)))
+    return results
+
+
+def pooled_build_plan(settings, index=None, tree=None, library=None):
+    """
+    build_plan() with the video files classified in batches of
+    CLASSIFY_BATCH_SIZE by classify_processes worker processes.
+    The results are taken in scan order, so the plan is the same as with
+    one process. Classifications cached in the ScanIndex are looked up here
+    and only the other files are sent to the workers.
+    """
+    videos = []
+    listings = []
+    for rootdir, dirs, files in scan_incoming(settings.incoming_dir, index):
+        if tree is not None:
+            tree.add(rootdir, dirs, files)
+        metrics.inc('rasmf_files_scanned_total', len(files))
+        start = len(videos)
+        for full_filename in files:
+            # get lowercase file extension
+            file_extension = os.path.splitext(full_filename)[1]
+            file_extension = file_extension.replace('.', '').lower()
+            if file_extension in settings.video_extensions:
+                videos.append((rootdir, full_filename))
+        listings.append((rootdir, files, start, len(videos)))
+
+    operations = [None] * len(videos)
+    stats = [None] * len(videos)
+    todo = []
+    index_keys = {}
+    for position, (rootdir, full_filename) in enumerate(videos):
+        path = os.path.join(rootdir, full_filename)
+        stat = stats[position] = file_stat(path)
+        if index is not None:
+            if stat is None:
+                continue
+            key = (stat.inode, stat.size, stat.mtime_ns)
+            found, operation = index.classification(path, key)
+            if found:
+                if operation is not None:
+                    operations[position] = operation._replace(stat=stat)
+                continue
+            index_keys[position] = (path, key)
+        todo.append(position)
+
+    batches = [[videos[position]
+                for position in todo[start:start + CLASSIFY_BATCH_SIZE]]
+               for start in range(0, len(todo), CLASSIFY_BATCH_SIZE)]
+    classify = functools.partial(classify_files, settings)
+    executor = None
+    if len(batches) > 1:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings.classify_processes)
+    try:
+        results = (executor.map(classify, batches) if executor is not None
+                   else map(classify, batches))
+        positions = iter(todo)
+        for batch_results in results:
+            for result in batch_results:
+                position = next(positions)
+                rootdir, full_filename = videos[position]
+                if result is not None:
+                    operations[position] = MoveOperation(
+                        media_type=result[0],
+                        source=os.path.join(rootdir, full_filename),
+                        target=result[1],
+                        clean_up_dir=relative_path(rootdir,
+                                                   settings.incoming_dir),
+                        stat=stats[position])
+                if position in index_keys:
+                    index.set_classification(*index_keys[position],
+                                             operations[position])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    count_classified(operations)
+    sidecars = sidecar_grouper(settings)
+    plan = []
+    targets = set()
+    for rootdir, files, start, end in listings:
+        directory = [operation for operation in operations[start:end]
+                     if operation is not None]
+        if library is not None:
+            directory = library.resolve_many(directory)
+        if sidecars is not None:
+            directory = sidecars.group(rootdir, files, directory)
+        extend_plan(plan, targets, directory)
+    return plan
+
+
+def build_plan(settings, index=None, tree=None, library=None):
+    """
+    Scan the incoming directory and return the list of MoveOperations needed
+    to store the video files found, without touching any file.
+    Operations whose target collides with an earlier operation are dropped.
+    The directories and files scanned are recorded in the ScanTree if given.
+    Targets are resolved in the LibraryIndex if given. With the sidecars
+    option the sidecar files of each directory are grouped with its videos.
+    """
+    if settings.classify_processes > 1:
+        return pooled_build_plan(settings, index, tree, library)
+
+    plan = []
+    targets = set()
+    sidecars = sidecar_grouper(settings)
+    for rootdir, dirs, files in scan_incoming(settings.incoming_dir, index):
+        if tree is not None:
+            tree.add(rootdir, dirs, files)
+
+        extend_plan(plan, targets,
+                    plan_directory(settings, rootdir, files, index, library,
+                                   sidecars))
+
+    return plan
+
+
+def plan_to_json(plan):
+    """
+    Returns the plan as a JSON string, a list of operation objects.
+    The FileStat of the sources is left out.
+    """
+    return json.dumps([
+        {field: value for field, value in operation._asdict().items()
+         if field != 'stat'}
+        for operation in plan], indent=2)
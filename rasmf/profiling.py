@@ -0,0 +1,110 @@
+"""
+Profiling of a run with cProfile and a per file timing trace.
+"""
+
+import functools
+import importlib
+import json
+import sys
+import threading
+import time
+
+from rasmf.plan import MoveOperation
+
+
+class TimingTrace(object):
+    """
+    Trace of how long each phase of a run took for each file or directory,
+    written as JSON lines for finding the slow paths of a sweep.
+    install() replaces the phase functions of the package with timing
+    wrappers, so there is no overhead at all unless a trace is installed.
+    """
+
+    # (phase, function, index of the argument naming the file or directory)
+    phases = [
+        ('scan', 'scan_incoming', None),
+        ('scan', 'list_directory', 0),
+        ('classify', 'plan_directory', 1),
+        ('makedirs', 'make_target_dir', 0),
+        ('move', 'move_operation', 0),
+        ('cleanup', 'clean_up', 1),
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.fo = open(path, 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.originals = []
+
+    def record(self, phase, path, start, seconds):
+        if isinstance(path, MoveOperation):
+            path = path.source
+        elif not isinstance(path, str):
+            path = sorted(set(path))
+        line = json.dumps({
+            'phase': phase,
+            'path': path,
+            'start': start,
+            'seconds': seconds,
+            'thread': threading.current_thread().name,
+        })
+        with self.lock:
+            self.fo.write(line + '\n')
+
+    def timed(self, phase, func, arg):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(phase, args[arg], start,
+                            time.perf_counter() - start)
+        return wrapper
+
+    def timed_walk(self, phase, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            items = func(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                self.record(phase, item[0], start,
+                            time.perf_counter() - start)
+                yield item
+        return wrapper
+
+    def install(self):
+        """
+        Replace the phase functions in every loaded rasmf module, since each
+        module imports the functions it calls by name.
+        """
+        import rasmf
+
+        for module_name in sorted(set(rasmf.EXPORTS.values())):
+            importlib.import_module('rasmf.' + module_name)
+        modules = [module for name, module in sorted(sys.modules.items())
+                   if name.startswith('rasmf.')]
+
+        for phase, name, arg in self.phases:
+            func = getattr(importlib.import_module(
+                'rasmf.' + rasmf.EXPORTS[name]), name)
+            if arg is None:
+                wrapper = self.timed_walk(phase, func)
+            else:
+                wrapper = self.timed(phase, func, arg)
+            for module in modules:
+                if vars(module).get(name) is func:
+                    self.originals.append((module, name, func))
+                    setattr(module, name, wrapper)
+
+    def close(self):
+        """
+        Restore the phase functions and close the trace.
+        """
+        for module, name, func in self.originals:
+            setattr(module, name, func)
+        self.fo.close()
@@ -0,0 +1,38 @@
+"""
+HTTP endpoint serving the run metrics to Prometheus in watch mode.
+"""
+
+import http.server
+import logging
+import threading
+
+from rasmf.telemetry import metrics
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every GET with the current metrics.
+    """
+
+    def do_GET(self):
+        body = metrics.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('rasmf').debug("Metrics: " + format, *args)
+
+
+def serve_metrics(port):
+    """
+    Serve the metrics on localhost from a background thread.
+    Returns the server, shutdown() stops it.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port),
+                                             MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
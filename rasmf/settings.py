@@ -0,0 +1,239 @@
+"""
+Settings of a run, parsed once from the config file.
+"""
+
+import ast
+import collections
+import configparser
+import logging
+import os
+import re
+import sys
+
+from rasmf.classify import DEFAULT_RENAME_RULES, RenameRules
+
+
+DUPLICATE_ACTIONS = ('move', 'skip', 'hardlink')
+STORE_STRATEGIES = ('move', 'hardlink', 'reflink', 'symlink', 'copy')
+
+
+SCHEDULE_POLICIES = ('scan', 'smallest-first', 'oldest-first', 'tv-first',
+                     'fair')
+
+
+Settings = collections.namedtuple('Settings', [
+    'incoming_dir',
+    'media_dir',
+    'movie_dir',
+    'tv_dir',
+    'log_dir',
+    'video_extensions',
+    'subtitle_extensions',
+    'audio_extensions',
+    'doc_extensions',
+    'other_extensions',
+    'sidecar_extensions',
+    'log_level',
+    'workers',
+    'scan_index',
+    'settle_seconds',
+    'async_limit',
+    'async_destination_limit',
+    'warm_dir_cache',
+    'duplicates',
+    'duplicates_full_hash',
+    'store_strategy',
+    'journal',
+    'journal_batch',
+    'metrics_file',
+    'metrics_port',
+    'schedule',
+    'renames_first',
+    'library_index',
+    'classify_processes',
+    'sidecars',
+    'rename_rules',
+])
+Settings.__doc__ = """
+Immutable settings parsed once from the config file.
+Extension lists are frozensets of lowercase extensions without the period.
+"""
+
+
+def read_config(config_fn='config.ini', example_config_fn='config_example.ini'):
+    """
+    Read the config.ini file otherwise pass a different config filename.
+    Expects user to create a config file based off the template config.
+    """
+    logger = logging.getLogger('rasmf')
+
+    if not os.path.exists(config_fn):
+        logger.error('%s Does not exist', config_fn)
+        logger.warning('Copying %s ==> %s', example_config_fn, config_fn)
+        import shutil
+        shutil.copy(example_config_fn, config_fn)
+        logger.warning('NOTE: You must modify %s before re-running.', config_fn)
+        logger.warning('Exiting.....')
+        sys.exit(1)
+
+    config = configparser.ConfigParser()
+
+    config.read(config_fn)
+    return config
+
+
+def parse_extensions(value):
+    """
+    Parse an extension list from the config, e.g. "['avi', 'mkv']", into a
+    frozenset of lowercase extensions without the leading period.
+    A plain comma separated list (avi, mkv) is accepted as well.
+    """
+    return frozenset(
+        extension.lstrip('.').lower()
+        for extension in re.findall(r'[^\s\[\]\'",]+', value)
+        if extension.lstrip('.'))
+
+
+def config_choice(config, option, choices, fallback):
+    """
+    Returns the lowercase value of an option that must be one of choices.
+    """
+    value = config.get('options', option, fallback=fallback).strip().lower()
+    if value not in choices:
+        raise ValueError("{} must be one of {}, not {!r}".format(
+            option, ', '.join(choices), value))
+    return value
+
+
+def config_literal(config, option, fallback):
+    """
+    Returns the value of a [rename] option written as a Python literal, e.g.
+    ['720p', '1080p'], or as plain text when it is not one.
+    """
+    value = config.get('rename', option, fallback=None)
+    if value is None:
+        return fallback
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def rename_rules(config):
+    """
+    Parse the [rename] and [show_aliases] sections of a config into
+    RenameRules, with DEFAULT_RENAME_RULES for anything left out.
+    """
+    defaults = DEFAULT_RENAME_RULES
+
+    separator = config_literal(config, 'separator', defaults.separator)
+    if not isinstance(separator, str) or len(separator) != 1:
+        raise ValueError(
+            "separator must be a single character, not {!r}".format(
+                separator))
+
+    separator_characters = config_literal(
+        config, 'separator_characters', defaults.separator_characters)
+    if not isinstance(separator_characters, (str, list, tuple)) or not all(
+            isinstance(character, str) and len(character) == 1
+            for character in separator_characters):
+        raise ValueError(
+            "separator_characters must be a list of single characters, "
+            "not {!r}".format(separator_characters))
+
+    replacements = config_literal(
+        config, 'replacements', dict(defaults.replacements))
+    if not isinstance(replacements, dict) or not all(
+            isinstance(text, str) and isinstance(replacement, str)
+            for text, replacement in replacements.items()):
+        raise ValueError(
+            "replacements must be a dict of text to replacement, "
+            "not {!r}".format(replacements))
+
+    quality_tags = config_literal(
+        config, 'quality_tags', defaults.quality_tags)
+    if not isinstance(quality_tags, (list, tuple)) or not all(
+            isinstance(tag, str) and tag for tag in quality_tags):
+        raise ValueError(
+            "quality_tags must be a list of tags, not {!r}".format(
+                quality_tags))
+
+    show_aliases = ()
+    if config.has_section('show_aliases'):
+        show_aliases = tuple(config.items('show_aliases'))
+
+    return RenameRules(
+        separator=separator,
+        separator_characters=''.join(separator_characters),
+        replacements=tuple(replacements.items()),
+        strip_release_group=config.getboolean(
+            'rename', 'strip_release_group',
+            fallback=defaults.strip_release_group),
+        quality_tags=tuple(quality_tags),
+        title_case=config.getboolean(
+            'rename', 'title_case', fallback=defaults.title_case),
+        show_aliases=show_aliases,
+    )
+
+
+def settings_from_config(config):
+    """
+    Build the immutable Settings from a parsed config.
+    """
+    folders = config['folders']
+    extensions = config['file_extensions']
+
+    return Settings(
+        incoming_dir=folders['incoming_dir'],
+        media_dir=folders['media_dir'],
+        movie_dir=folders['movie_dir'],
+        tv_dir=folders['tv_dir'],
+        log_dir=folders['log_dir'],
+        video_extensions=parse_extensions(extensions.get('video', '')),
+        subtitle_extensions=parse_extensions(extensions.get('subtitles', '')),
+        audio_extensions=parse_extensions(extensions.get('audio', '')),
+        doc_extensions=parse_extensions(extensions.get('doc', '')),
+        other_extensions=parse_extensions(extensions.get('other', '')),
+        sidecar_extensions=parse_extensions(extensions.get('sidecar', '')),
+        log_level=config.get('options', 'log_level', fallback='INFO'),
+        workers=max(1, config.getint('options', 'workers', fallback=1)),
+        scan_index=config.getboolean('options', 'scan_index', fallback=False),
+        settle_seconds=config.getfloat(
+            'options', 'settle_seconds', fallback=30.0),
+        async_limit=max(1, config.getint(
+            'options', 'async_limit', fallback=16)),
+        async_destination_limit=max(1, config.getint(
+            'options', 'async_destination_limit', fallback=4)),
+        warm_dir_cache=config.getboolean(
+            'options', 'warm_dir_cache', fallback=False),
+        duplicates=config_choice(
+            config, 'duplicates', DUPLICATE_ACTIONS, 'move'),
+        duplicates_full_hash=config.getboolean(
+            'options', 'duplicates_full_hash', fallback=False),
+        store_strategy=config_choice(
+            config, 'store_strategy', STORE_STRATEGIES, 'move'),
+        journal=config.getboolean('options', 'journal', fallback=True),
+        journal_batch=max(1, config.getint(
+            'options', 'journal_batch', fallback=64)),
+        metrics_file=config.get(
+            'options', 'metrics_file', fallback='rasmf.prom'),
+        metrics_port=config.getint('options', 'metrics_port', fallback=0),
+        schedule=config_choice(config, 'schedule', SCHEDULE_POLICIES, 'scan'),
+        renames_first=config.getboolean(
+            'options', 'renames_first', fallback=False),
+        library_index=config.getboolean(
+            'options', 'library_index', fallback=False),
+        classify_processes=max(1, config.getint(
+            'options', 'classify_processes', fallback=1)),
+        sidecars=config.getboolean('options', 'sidecars', fallback=False),
+        rename_rules=rename_rules(config),
+    )
+
+
+def read_settings(config_fn='config.ini',
+                  example_config_fn='config_example.ini'):
+    """
+    Read and parse the config file once, returning the Settings used for the
+    whole run.
+    """
+    return settings_from_config(read_config(config_fn, example_config_fn))
@@ -0,0 +1,144 @@
+"""
+Grouping of subtitle and other sidecar files with the video they belong to,
+so they are stored next to it under its new name.
+"""
+
+import os
+import re
+
+from rasmf.util import lower_splitext
+
+
+# A language or flag part of a sidecar name, e.g. '.en', '.pt-BR' or '.forced'
+SIDECAR_TAG_PATTERN = re.compile(
+    r'[a-z]{2,3}([-_][a-z]{2,4})?|forced|sdh|hi|cc|default', re.IGNORECASE)
+NON_NAME_PATTERN = re.compile(r'[^0-9A-Za-z-]+')
+
+# Most language and flag parts stripped from a sidecar name to find its video
+MAX_SIDECAR_TAGS = 3
+
+
+class SidecarGrouper(object):
+    """
+    Groups the sidecar files of each directory listing of a bottom up walk
+    with the MoveOperations of its videos, see group().
+    Sidecars in a directory without videos below a release directory, e.g.
+    Subs, are held until the listing of the directory above it.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.extensions = (settings.subtitle_extensions |
+                           settings.sidecar_extensions)
+        self.in_dir = os.path.normpath(settings.incoming_dir)
+        # Directory => [(rootdir, filename)] of the sidecars held for it
+        self.pending = {}
+
+    def group(self, rootdir, files, operations, video_count=None):
+        """
+        Returns the operations of the videos in a directory listing with
+        their sidecars attached.
+        video_count is the number of videos in the listing when only some of
+        them are given operations, as in watch mode.
+        A sidecar belongs to the video of the same name, to the video whose
+        name it starts with followed by language or flag parts, e.g.
+        'Movie.en.forced.srt', or else to the only video of a release
+        directory. Its target is the target of the video with those parts
+        kept, so 'movie.en.srt' becomes 'Some.Movie.2010.en.srt'.
+        """
+        rootdir = os.path.normpath(rootdir)
+        found = self.pending.pop(rootdir, [])
+        found.extend((rootdir, full_filename) for full_filename in files
+                     if lower_splitext(full_filename)[1][1:] in
+                     self.extensions)
+        if not found:
+            return operations
+
+        if not operations:
+            parent = os.path.dirname(rootdir)
+            if rootdir != self.in_dir and parent != self.in_dir:
+                self.pending.setdefault(parent, []).extend(found)
+            return operations
+
+        videos = {}
+        for position, operation in enumerate(operations):
+            stem = os.path.splitext(os.path.basename(operation.source))[0]
+            videos.setdefault(stem.lower(), position)
+
+        # The only video of a release directory takes the sidecars left
+        only_video = None
+        if video_count is None:
+            video_count = len(operations)
+        if video_count == 1 and len(operations) == 1 and (
+                rootdir != self.in_dir):
+            only_video = 0
+
+        matched = [[] for _ in operations]
+        unmatched = []
+        for sidecar_dir, full_filename in found:
+            stem, extension = os.path.splitext(full_filename)
+            position, suffix = self.match(videos, stem)
+            if position is not None:
+                matched[position].append(
+                    (sidecar_dir, full_filename, suffix, extension))
+            elif only_video is not None:
+                unmatched.append((sidecar_dir, full_filename, stem, extension))
+
+        # A sidecar of an extension of its own takes the name of the video,
+        # others keep their name as a suffix, e.g. 'Movie.2010.English.srt'
+        extensions = [extension.lower() for _, _, _, extension in unmatched]
+        for sidecar_dir, full_filename, stem, extension in unmatched:
+            suffix = ''
+            if extensions.count(extension.lower()) > 1:
+                suffix = '.' + NON_NAME_PATTERN.sub('.', stem).strip('.')
+            matched[only_video].append(
+                (sidecar_dir, full_filename, suffix, extension))
+
+        grouped = []
+        for operation, sidecars in zip(operations, matched):
+            if sidecars:
+                operation = operation._replace(
+                    sidecars=self.targets(operation, sidecars))
+            grouped.append(operation)
+        return grouped
+
+    def match(self, videos, stem):
+        """
+        Returns the (position, suffix) of the video named by the stem of a
+        sidecar, or (None, None).
+        """
+        head = stem
+        for _ in range(MAX_SIDECAR_TAGS + 1):
+            position = videos.get(head.lower())
+            if position is not None:
+                return position, stem[len(head):]
+            head, dot, tag = head.rpartition('.')
+            if not dot or not SIDECAR_TAG_PATTERN.fullmatch(tag):
+                break
+        return None, None
+
+    def targets(self, operation, sidecars):
+        """
+        Returns the (source, target) pairs of the sidecars of an operation,
+        dropping any whose target is taken by an earlier one.
+        """
+        target_stem = os.path.splitext(operation.target)[0]
+        pairs = []
+        targets = set()
+        for sidecar_dir, full_filename, suffix, extension in sidecars:
+            target = target_stem + suffix + extension.lower()
+            if target in targets:
+                continue
+            targets.add(target)
+            pairs.append((os.path.join(sidecar_dir, full_filename), target))
+        return tuple(pairs)
+
+
+def sidecar_grouper(settings):
+    """
+    Returns a SidecarGrouper for a scan, or None when the sidecars option
+    is off.
+    """
+    if not settings.sidecars:
+        return None
+    return SidecarGrouper(settings)
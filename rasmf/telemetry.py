@@ -0,0 +1,141 @@
+"""
+Run metrics in the Prometheus text exposition format.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+# Name: (type, help) of the metrics in the order they are exposed
+METRICS = collections.OrderedDict([
+    ('rasmf_files_scanned_total',
+     ('counter', 'Files found in the incoming directory.')),
+    ('rasmf_files_classified_total',
+     ('counter', 'Video files classified, by media type.')),
+    ('rasmf_library_collisions_total',
+     ('counter', 'Video files whose target is already in the library.')),
+    ('rasmf_files_stored_total',
+     ('counter', 'Files stored in the library, by destination.')),
+    ('rasmf_sidecars_stored_total',
+     ('counter', 'Subtitle and other sidecar files stored with their video.')),
+    ('rasmf_bytes_moved_total',
+     ('counter', 'Bytes stored in the library, by destination.')),
+    ('rasmf_move_seconds',
+     ('histogram', 'Time taken to store a file, by destination.')),
+    ('rasmf_move_bytes_per_second',
+     ('histogram', 'Throughput of storing a file, by destination.')),
+    ('rasmf_directories_cleaned_total',
+     ('counter', 'Release directories removed from the incoming directory.')),
+    ('rasmf_errors_total',
+     ('counter', 'Errors, by operation and error type.')),
+    ('rasmf_run_seconds',
+     ('gauge', 'Duration of the last run.')),
+    ('rasmf_last_run_timestamp_seconds',
+     ('gauge', 'Time the last run finished.')),
+])
+
+
+HISTOGRAM_BUCKETS = {
+    'rasmf_move_seconds': (
+        0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+    'rasmf_move_bytes_per_second': tuple(
+        megabytes * 1024 ** 2 for megabytes in (1, 10, 25, 50, 100, 250,
+                                                500, 1000)),
+}
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms of the METRICS, with labels, rendered
+    in the Prometheus text exposition format.
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = HISTOGRAM_BUCKETS[name]
+        with self.lock:
+            counts, total = self.histograms.get(
+                key, ([0] * (len(buckets) + 1), 0))
+            for n, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[n] += 1
+            counts[-1] += 1
+            self.histograms[key] = (counts, total + value)
+
+    def exposition(self):
+        """
+        Returns the metrics as text for a textfile collector or a scrape.
+        """
+        def sample(name, labels, value):
+            if labels:
+                name += '{' + ','.join(
+                    '{}={}'.format(label, json.dumps(str(label_value),
+                                                ensure_ascii=False))
+                    for label, label_value in labels) + '}'
+            if isinstance(value, float):
+                value = repr(value)
+            return '{} {}'.format(name, value)
+
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            samples = []
+            for (key_name, labels), value in values:
+                if key_name == name:
+                    samples.append(sample(name, labels, value))
+            for (key_name, labels), (counts, total) in histograms:
+                if key_name != name:
+                    continue
+                bounds = [repr(float(bound))
+                          for bound in HISTOGRAM_BUCKETS[name]] + ['+Inf']
+                for bound, count in zip(bounds, counts):
+                    samples.append(sample(name + '_bucket',
+                                          labels + (('le', bound), ), count))
+                samples.append(sample(name + '_sum', labels, float(total)))
+                samples.append(sample(name + '_count', labels, counts[-1]))
+            if samples:
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                lines.extend(samples)
+        return ''.join(line + '\n' for line in lines)
+
+
+metrics = Metrics()
+
+
+def write_metrics(settings, run_seconds):
+    """
+    Write the metrics of a run to metrics_file in the log directory, for
+    the node_exporter textfile collector. The file is replaced atomically
+    so a scrape never sees half of it.
+    """
+    if not settings.metrics_file:
+        return
+    metrics.set('rasmf_run_seconds', run_seconds)
+    metrics.set('rasmf_last_run_timestamp_seconds', time.time())
+
+    path = os.path.join(settings.log_dir, settings.metrics_file)
+    with open(path + '.tmp', 'w') as metrics_file:
+        metrics_file.write(metrics.exposition())
+    os.replace(path + '.tmp', path)
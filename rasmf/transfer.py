@@ -0,0 +1,555 @@
+"""
+Storing files in the library by rename, copy or link.
+"""
+
+import errno
+import functools
+import logging
+import os
+import threading
+import time
+
+from rasmf.plan import (MEDIA_TYPE_LABELS, MoveOperation, count_classified,
+                        movie_target, plan_video_file, tv_show_target)
+from rasmf.telemetry import metrics
+from rasmf.util import (error_type, format_size, fsync_dir, relative_path,
+                        traced)
+
+
+# Cross device copies are written to target + PARTIAL_SUFFIX first
+PARTIAL_SUFFIX = '.rasmf-part'
+
+
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+RESUME_CHECK_SIZE = 1024 * 1024
+
+
+# ioctl(2) cloning a whole file on Btrfs, XFS and other CoW filesystems
+FICLONE = 0x40049409
+
+
+# Errors meaning a link or clone is not possible between two paths
+UNSUPPORTED_ERRNOS = frozenset([
+    errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTSUP,
+    errno.EINVAL, errno.ENOTTY, errno.ENOSYS])
+
+
+def video_file(settings, rootdir, full_filename, file_extension, dirs=None):
+    """
+    Determine if the video file is a TV show or movie by applying some regexs
+    and store it.
+    Returns the first level directory to clean up, or None.
+    """
+    metrics.inc('rasmf_files_scanned_total')
+    operation = plan_video_file(
+        settings, rootdir, full_filename, file_extension)
+    if count_classified([operation]):
+        return execute_operation(operation, dirs, settings.store_strategy)
+    return None
+
+
+class DirectoryCache(object):
+    """
+    The directories known to exist during a run, so the episodes of a season
+    pack check for and create their target directory once between them.
+    A directory is forgotten when a move into it fails, in case it was
+    removed behind our back. Safe to share between threads.
+    """
+
+    def __init__(self):
+        self.known = set()
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        return os.path.normpath(path) in self.known
+
+    def add(self, path):
+        """
+        Record that path and so all of its parents exist.
+        """
+        path = os.path.normpath(path)
+        with self.lock:
+            while path and path not in self.known:
+                self.known.add(path)
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+                path = parent
+
+    def discard(self, path):
+        with self.lock:
+            self.known.discard(os.path.normpath(path))
+
+    def warm(self, top, depth=2):
+        """
+        Add top and the directories below it down to depth levels, e.g. the
+        show and season directories of tv_dir, from one listing of each
+        directory above the last level.
+        """
+        level = [top]
+        for _ in range(depth):
+            next_level = []
+            for path in level:
+                try:
+                    with os.scandir(path) as entries:
+                        subdirs = [entry.path for entry in entries
+                                   if entry.is_dir()]
+                except OSError:
+                    continue
+                for subdir in subdirs:
+                    self.add(subdir)
+                self.add(path)
+                next_level.extend(subdirs)
+            level = next_level
+
+    def ensure(self, path):
+        """
+        Create the directory unless it is already known to exist.
+        """
+        if path in self:
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        self.add(path)
+
+
+def directory_cache(settings):
+    """
+    Returns the DirectoryCache for a run, warmed from tv_dir when the
+    warm_dir_cache option is set.
+    """
+    dirs = DirectoryCache()
+    if settings.warm_dir_cache:
+        dirs.warm(settings.tv_dir)
+    return dirs
+
+
+def make_target_dir(target_dir, dirs=None):
+    """
+    Create the target directory if needed, through the DirectoryCache if
+    given.
+    """
+    if dirs is not None:
+        dirs.ensure(target_dir)
+    elif not os.path.exists(target_dir):
+        os.makedirs(target_dir, exist_ok=True)
+
+
+def make_library_dirs(settings, dirs=None):
+    """
+    Create the movie and tv folders should they not exist.
+    """
+    for d in [settings.movie_dir, settings.tv_dir]:
+        make_target_dir(d, dirs)
+
+
+def checked_move(operation, dirs=None, strategy='move', journal=None,
+                 tree=None):
+    """
+    move_operation(), forgetting the target directory in the DirectoryCache
+    if the move fails.
+    """
+    clean_up_item = move_operation(operation, strategy, journal, tree)
+    if clean_up_item is None and dirs is not None:
+        dirs.discard(os.path.dirname(operation.target))
+    return clean_up_item
+
+
+def execute_operation(operation, dirs=None, strategy='move', journal=None,
+                      tree=None):
+    """
+    Create the target directory if needed and store the file.
+    """
+    make_target_dir(os.path.dirname(operation.target), dirs)
+
+    return checked_move(operation, dirs, strategy, journal, tree)
+
+
+def copy_chunk(source_fd, target_fd, offset, count, methods):
+    """
+    Copy count bytes at offset from source_fd to target_fd, returning the
+    number of bytes copied.
+    methods is the list of copy methods still to try, in order of preference;
+    a method the kernel or filesystem does not support is removed from it.
+    """
+    while methods:
+        method = methods[0]
+        try:
+            if method == 'copy_file_range':
+                return os.copy_file_range(
+                    source_fd, target_fd, count, offset, offset)
+            elif method == 'sendfile':
+                os.lseek(target_fd, offset, os.SEEK_SET)
+                return os.sendfile(target_fd, source_fd, offset, count)
+            else:
+                data = os.pread(source_fd, count, offset)
+                os.lseek(target_fd, offset, os.SEEK_SET)
+                return os.write(target_fd, data)
+        except OSError as err:
+            if (method == 'read' or err.errno not in (
+                    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                    errno.ENOTSUP)):
+                raise
+            methods.pop(0)
+    return 0
+
+
+def resume_offset(source_fd, partial_fd, size):
+    """
+    Returns the offset to resume a partial copy from.
+    The last block of the partial copy is compared to the source and the
+    copy restarts from the beginning if they differ.
+    """
+    offset = os.fstat(partial_fd).st_size
+    if offset > size:
+        return 0
+    block = min(offset, RESUME_CHECK_SIZE)
+    if block and (os.pread(partial_fd, block, offset - block) !=
+                  os.pread(source_fd, block, offset - block)):
+        return 0
+    return offset
+
+
+def copy_file(source, target, keep_source=False):
+    """
+    Copy source into target + PARTIAL_SUFFIX using zero copy system calls
+    where available, resuming an interrupted copy, then fsync and rename it
+    into place and remove the source unless keep_source is set.
+    """
+    logger = logging.getLogger('rasmf')
+
+    partial = target + PARTIAL_SUFFIX
+    methods = [method for method in ['copy_file_range', 'sendfile']
+               if hasattr(os, method)] + ['read']
+
+    start = time.monotonic()
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        size = os.fstat(source_fd).st_size
+        partial_fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            offset = resume_offset(source_fd, partial_fd, size)
+            os.ftruncate(partial_fd, offset)
+            if offset:
+                logger.info("Resuming copy of %s at %s",
+                            source, format_size(offset))
+            resumed = offset
+
+            while offset < size:
+                copied = copy_chunk(
+                    source_fd, partial_fd, offset,
+                    min(COPY_CHUNK_SIZE, size - offset), methods)
+                if not copied:
+                    raise OSError(errno.EIO, "Short copy of {} at {}".format(
+                        source, offset))
+                offset += copied
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Copied %s of %s (%.0f%%)",
+                                 format_size(offset), format_size(size),
+                                 100.0 * offset / size)
+
+            os.fsync(partial_fd)
+        finally:
+            os.close(partial_fd)
+    finally:
+        os.close(source_fd)
+
+    import shutil
+
+    shutil.copystat(source, partial)
+    os.rename(partial, target)
+    fsync_dir(os.path.dirname(target))
+    if not keep_source:
+        os.remove(source)
+
+    elapsed = max(time.monotonic() - start, 1e-6)
+    logger.info("Copied %s in %.1fs (%s/s) with %s",
+                format_size(size - resumed), elapsed,
+                format_size((size - resumed) / elapsed), methods[0])
+
+
+def transfer_file(source, target, copied=None, target_device=None,
+                  source_device=None):
+    """
+    Move source to target.
+    Within a filesystem this is a single atomic os.rename, across filesystems
+    the file is copied with copy_file() and copied, if given, is called once
+    the target is complete and before the source is removed.
+    target_device is the st_dev of the target directory and source_device
+    that of the source when already known.
+    """
+    if target_device is None:
+        target_device = os.stat(os.path.dirname(target) or os.curdir).st_dev
+    if source_device is None:
+        source_device = os.stat(source).st_dev
+    if source_device == target_device:
+        try:
+            os.rename(source, target)
+            return
+        except OSError as err:
+            # The same device can still be two mounts, e.g. a bind mount
+            if err.errno != errno.EXDEV:
+                raise
+    copy_file(source, target, keep_source=True)
+    if copied is not None:
+        copied()
+    os.remove(source)
+
+
+def clone_file(source, target):
+    """
+    Make target a copy on write clone of source with the FICLONE ioctl.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.ENOSYS, "FICLONE is not available")
+
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        target_fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.ioctl(target_fd, FICLONE, source_fd)
+            os.ftruncate(target_fd, os.fstat(source_fd).st_size)
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+    import shutil
+
+    shutil.copystat(source, target)
+
+
+def link_file(source, target, strategy):
+    """
+    Hardlink, symlink or reflink source to target + PARTIAL_SUFFIX, then
+    rename it into place, replacing the target like a move would.
+    """
+    partial = target + PARTIAL_SUFFIX
+    if strategy == 'reflink':
+        # Keeps an interrupted copy in partial if cloning is not possible
+        clone_file(source, partial)
+    else:
+        if strategy == 'hardlink':
+            make_link = os.link
+        else:
+            source = os.path.abspath(source)
+            make_link = os.symlink
+        try:
+            make_link(source, partial)
+        except FileExistsError:
+            os.remove(partial)
+            make_link(source, partial)
+    os.rename(partial, target)
+    fsync_dir(os.path.dirname(target))
+
+
+def already_stored(source, target, strategy):
+    """
+    Returns True if target already holds source as stored by a strategy that
+    keeps the source, so a file still seeding is not stored again each run.
+    """
+    try:
+        if strategy == 'symlink':
+            return (os.path.islink(target) and
+                    os.readlink(target) == os.path.abspath(source))
+        source_stat = os.stat(source)
+        target_stat = os.stat(target)
+    except OSError:
+        return False
+    if os.path.samestat(source_stat, target_stat):
+        return True
+    # Copies and clones keep the size and mtime of the source
+    return (strategy in ('copy', 'reflink') and
+            target_stat.st_size == source_stat.st_size and
+            target_stat.st_mtime_ns == source_stat.st_mtime_ns)
+
+
+def store_file(source, target, strategy='move', copied=None,
+               target_device=None, source_device=None):
+    """
+    Store source at target with one of STORE_STRATEGIES.
+    Every strategy but move keeps the source, for files that are still
+    seeding. Links and clones fall back to a copy when they are not
+    supported between the source and target, e.g. across filesystems.
+    Moves call copied and take target_device and source_device, if given,
+    as transfer_file() does.
+    Returns the strategy used, or None if the target already held the file.
+    """
+    logger = logging.getLogger('rasmf')
+
+    if strategy == 'move':
+        transfer_file(source, target, copied, target_device, source_device)
+        return strategy
+
+    if already_stored(source, target, strategy):
+        return None
+
+    if strategy != 'copy':
+        try:
+            link_file(source, target, strategy)
+            return strategy
+        except OSError as err:
+            if err.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            logger.debug("Unable to %s %s, copying instead: %s",
+                         strategy, source, err)
+
+    copy_file(source, target, keep_source=True)
+    return 'copy'
+
+
+def observe_store(destination, size, elapsed):
+    """
+    Record the size, time and throughput of storing a file.
+    """
+    metrics.inc('rasmf_files_stored_total', destination=destination)
+    metrics.inc('rasmf_bytes_moved_total', size, destination=destination)
+    metrics.observe('rasmf_move_seconds', elapsed, destination=destination)
+    metrics.observe('rasmf_move_bytes_per_second',
+                    size / max(elapsed, 1e-6), destination=destination)
+
+
+def store_sidecars(operation, strategy='move', journal=None):
+    """
+    Store the sidecar files of a MoveOperation next to its target, recording
+    each in the Journal if given.
+    The target directory is looked at once for the whole group, so with the
+    move strategy the sidecars on its filesystem are renamed one after the
+    other without further checks.
+    A sidecar that can not be stored is logged and left in place.
+    Returns the (source, target) pairs of the sidecars stored.
+    """
+    logger = logging.getLogger('rasmf')
+
+    target_device = None
+    if strategy == 'move' and operation.sidecars:
+        try:
+            target_device = os.stat(os.path.dirname(operation.target)).st_dev
+        except OSError:
+            pass
+
+    stored = []
+    for source, target in operation.sidecars:
+        entry = None
+        if journal is not None:
+            entry = journal.begin('move', source=source, target=target,
+                                  strategy=strategy,
+                                  clean_up_dir=operation.clean_up_dir)
+        try:
+            used = store_file(source, target, strategy,
+                              target_device=target_device)
+        except OSError as msg:
+            if entry is not None:
+                journal.end(entry, 'abort')
+            metrics.inc('rasmf_errors_total', operation='move',
+                        type=error_type(msg))
+            logger.error("%s: Unable to move %s to %s", msg, source, target)
+            continue
+        if entry is not None:
+            journal.end(entry)
+        stored.append((source, target))
+        if used is not None:
+            metrics.inc('rasmf_sidecars_stored_total')
+            logger.info("Sidecar: %s", target)
+    return stored
+
+
+def move_operation(operation, strategy='move', journal=None, tree=None):
+    """
+    Store the source file of a MoveOperation at its target, by default
+    moving it, recording it in the Journal if given.
+    Its sidecars follow once the file is stored, see store_sidecars().
+    Moved files are removed from the ScanTree if given. The size and device
+    of the source are taken from its FileStat when known.
+    Returns the first level directory to clean up, or None on failure.
+    """
+    logger = logging.getLogger('rasmf')
+
+    entry = copied = None
+    if journal is not None:
+        entry = journal.begin('move', source=operation.source,
+                              target=operation.target, strategy=strategy,
+                              clean_up_dir=operation.clean_up_dir)
+        copied = functools.partial(journal.progress, entry)
+
+    try:
+        start = time.monotonic()
+        if operation.stat is not None:
+            size, source_device = operation.stat.size, operation.stat.device
+        else:
+            stat = os.stat(operation.source)
+            size, source_device = stat.st_size, stat.st_dev
+        used = store_file(operation.source, operation.target, strategy,
+                          copied, source_device=source_device)
+        if entry is not None:
+            journal.end(entry)
+        if used is not None:
+            observe_store(operation.media_type, size,
+                          time.monotonic() - start)
+        if used is None:
+            logger.debug("Already stored: %s", operation.target)
+        elif used == strategy:
+            logger.info("%s: %s",
+                        MEDIA_TYPE_LABELS[operation.media_type],
+                        operation.target)
+        else:
+            logger.info("%s (%s): %s",
+                        MEDIA_TYPE_LABELS[operation.media_type],
+                        used,
+                        operation.target)
+    except OSError as msg:
+        if entry is not None:
+            journal.end(entry, 'abort')
+        metrics.inc('rasmf_errors_total', operation='move',
+                    type=error_type(msg))
+        logger.error("%s: Unable to move %s to %s",
+                     msg,
+                     operation.source,
+                     operation.target)
+        return None
+
+    stored = store_sidecars(operation, strategy, journal)
+    if tree is not None and strategy == 'move':
+        tree.remove_file(operation.source)
+        for source, _ in stored:
+            tree.remove_file(source)
+    return operation.clean_up_dir
+
+
+@traced
+def process_tv_show_file(settings, source_dir, source_filename, dirs=None,
+                         library=None):
+    """
+    Store a single TV show file, in the existing show and season folders of
+    the LibraryIndex if given.
+    """
+    operation = MoveOperation(
+        media_type='tv',
+        source=os.path.join(source_dir, source_filename),
+        target=tv_show_target(settings, source_dir, source_filename),
+        clean_up_dir=relative_path(source_dir, settings.incoming_dir))
+    if library is not None:
+        operation = library.resolve(operation)
+        if operation is None:
+            return None
+    return execute_operation(operation, dirs, settings.store_strategy)
+
+
+@traced
+def process_movie_file(settings, source_dir, source_filename,
+                       file_extension, dirs=None, library=None):
+    """
+    Store a single movie file, under its existing name in the LibraryIndex
+    if given.
+    """
+    operation = MoveOperation(
+        media_type='movie',
+        source=os.path.join(source_dir, source_filename),
+        target=movie_target(settings, source_filename, file_extension),
+        clean_up_dir=relative_path(source_dir, settings.incoming_dir))
+    if library is not None:
+        operation = library.resolve(operation)
+        if operation is None:
+            return None
+    return execute_operation(operation, dirs, settings.store_strategy)
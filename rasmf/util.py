@@ -0,0 +1,157 @@
+"""
+Logging setup and small helpers shared by the other modules.
+"""
+
+import errno
+import functools
+import logging
+import os
+import sys
+
+
+def pause():
+    input("Press any key to continue")
+
+
+class DeferredFileHandler(logging.Handler):
+    """
+    Timed rotating file handler that is only opened, and logging.handlers
+    only imported, when the first record is written.
+    """
+
+    def __init__(self, filename):
+        super().__init__()
+        self.filename = filename
+        self.handler = None
+
+    def emit(self, record):
+        if self.handler is None:
+            import logging.handlers
+            self.handler = logging.handlers.TimedRotatingFileHandler(
+                self.filename, when='midnight')
+            self.handler.setFormatter(self.formatter)
+        self.handler.emit(record)
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+        super().close()
+
+
+def logging_config(log_level='INFO', log_dir=None):
+    """
+    Configure logging, setup a file handler and a console handler.
+    """
+    if not log_dir:
+        log_dir = os.path.join(os.path.expanduser('~'), 'log')
+    logfile = os.path.join(log_dir, 'rasmf.log')
+
+    if not os.path.isdir(log_dir):
+        os.mkdir(log_dir)
+
+    # Set the logger based on namespace and minimum log level
+    logger = logging.getLogger('rasmf')
+    logger.setLevel(logging.getLevelName(log_level))
+
+    # FileHandler with Timed Rotating logs and set it's minimum log level
+    file_handler = DeferredFileHandler(logfile)
+    file_handler.setLevel(logging.getLevelName(log_level))
+
+    # Create console handler with a higher log level
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+
+    # Create file handler formatter
+    file_formatter = logging.Formatter('%(asctime)s:%(levelname)s: %(message)s')
+    file_handler.setFormatter(file_formatter)
+
+    # Create console handler formatter
+    console_formatter = logging.Formatter('%(levelname)s: %(message)s')
+    console_handler.setFormatter(console_formatter)
+
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+
+
+def lower_splitext(filename):
+    """
+    Returns a tuple of filename and extension in lowercase.
+    """
+    return os.path.splitext(filename.lower())
+
+
+def traced(func):
+    """
+    Decorator logging a banner with the function name on each call when the
+    log level is DEBUG. The name is taken once when decorating instead of
+    inspecting the stack, so the cost at other log levels is one level check.
+    """
+    logger = logging.getLogger('rasmf')
+    banner = "{0} {1} {0}".format('=' * 20, func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(banner)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def relative_path(full_path, base_path):
+    """
+    Returns the first directory of the path relative to source directory.
+    An empty string is returned if there is no relative path.
+    Used for deleting directories that held the incoming files.
+    The result is interned, so the MoveOperations of the files of a release
+    share one string. Paths below base_path as os.walk() builds them are
+    split without the relpath() call.
+    """
+    prefix = base_path.rstrip(os.sep) + os.sep
+    if full_path.startswith(prefix):
+        relpath = full_path[len(prefix):]
+        if relpath and os.path.normpath(relpath) == relpath:
+            return sys.intern(relpath.split(os.sep, 1)[0])
+
+    relpath = os.path.relpath(full_path, start=base_path)
+    if relpath == '.':
+        return ''
+    else:
+        path_list = relpath.split(os.sep)
+        return sys.intern(path_list[0])
+
+
+def format_size(size):
+    """
+    Returns a human readable size, e.g. 1.5 GiB
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+    return "{:.1f} {}".format(size, unit)
+
+
+def fsync_dir(path):
+    """
+    Flush a directory entry change to disk, where the platform allows it.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def error_type(err):
+    """
+    Returns the errno name of an OSError, e.g. ENOSPC, or its class name.
+    """
+    return errno.errorcode.get(getattr(err, 'errno', None),
+                               type(err).__name__)
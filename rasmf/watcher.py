@@ -0,0 +1,381 @@
+"""
+Watch mode, storing files as they land in the incoming directory.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import signal
+import struct
+import time
+
+from rasmf.cleanup import clean_up
+from rasmf.dedupe import deduplicate, open_hash_cache
+from rasmf.library import open_library
+from rasmf.plan import count_classified, plan_video_file
+from rasmf.sidecars import SidecarGrouper
+from rasmf.telemetry import metrics
+from rasmf.transfer import directory_cache, execute_operation
+from rasmf.util import lower_splitext, relative_path
+
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# Seconds between writes of the hash cache and library index in watch mode
+CACHE_FLUSH_SECONDS = 300
+
+
+class SettleTracker(object):
+    """
+    Track files that are still being written.
+    A file has settled once its size has not changed for settle_seconds.
+    """
+
+    def __init__(self, settle_seconds, clock=time.monotonic):
+        self.settle_seconds = settle_seconds
+        self.clock = clock
+        self.pending = {}
+
+    def touch(self, path):
+        """
+        Record that a file has changed, without touching the disk.
+        """
+        self.pending[path] = (None, self.clock())
+
+    def discard(self, path):
+        self.pending.pop(path, None)
+
+    def settled(self):
+        """
+        Returns and stops tracking the files that have settled.
+        """
+        now = self.clock()
+        ready = []
+        for path, (size, since) in list(self.pending.items()):
+            try:
+                current_size = os.stat(path).st_size
+            except OSError:
+                del self.pending[path]
+                continue
+            if current_size != size:
+                self.pending[path] = (current_size, now)
+            elif now - since >= self.settle_seconds:
+                del self.pending[path]
+                ready.append(path)
+        return ready
+
+
+class InotifyWatcher(object):
+    """
+    Watch the incoming directory tree with inotify.
+    Files are ready once they are closed after writing or moved in, or
+    otherwise once their size has settled.
+    """
+
+    mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE)
+
+    def __init__(self, incoming_dir, settle_seconds):
+        self.incoming_dir = incoming_dir
+        self.tracker = SettleTracker(settle_seconds)
+        self.ready = []
+        self.watches = {}
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def start(self):
+        self.add_tree(self.incoming_dir)
+
+    def add_tree(self, top):
+        """
+        Watch every directory below top and track the files already there.
+        """
+        logger = logging.getLogger('rasmf')
+
+        for rootdir, dirs, files in os.walk(top):
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(rootdir), self.mask)
+            if wd < 0:
+                logger.warning("Unable to watch %s: %s",
+                               rootdir, os.strerror(ctypes.get_errno()))
+                continue
+            self.watches[wd] = rootdir
+            for full_filename in files:
+                self.tracker.touch(os.path.join(rootdir, full_filename))
+
+    def pending(self):
+        return list(self.tracker.pending)
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds for events, returning the ready files.
+        """
+        if select.select([self.fd], [], [], timeout)[0]:
+            self.read_events()
+        ready = self.ready + self.tracker.settled()
+        self.ready = []
+        return ready
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, look at the whole tree again
+                self.add_tree(self.incoming_dir)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.tracker.discard(path)
+                self.ready.append(path)
+            elif mask & (IN_CREATE | IN_MODIFY):
+                self.tracker.touch(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.tracker.discard(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Watch the incoming directory tree by walking it every poll.
+    Files are ready once their size has settled.
+    """
+
+    def __init__(self, incoming_dir, settle_seconds):
+        self.incoming_dir = incoming_dir
+        self.tracker = SettleTracker(settle_seconds)
+        self.snapshot = {}
+
+    def start(self):
+        self.scan()
+
+    def scan(self):
+        current = {}
+        for rootdir, dirs, files in os.walk(self.incoming_dir):
+            for full_filename in files:
+                path = os.path.join(rootdir, full_filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                current[path] = (stat.st_size, stat.st_mtime_ns)
+                if self.snapshot.get(path) != current[path]:
+                    self.tracker.touch(path)
+
+        for path in set(self.snapshot) - set(current):
+            self.tracker.discard(path)
+        self.snapshot = current
+
+    def pending(self):
+        return list(self.tracker.pending)
+
+    def poll(self, timeout):
+        time.sleep(timeout)
+        self.scan()
+        return self.tracker.settled()
+
+    def close(self):
+        pass
+
+
+def make_watcher(settings, polling=False):
+    """
+    Returns an InotifyWatcher, or a PollingWatcher when inotify is not
+    available or polling is requested.
+    """
+    logger = logging.getLogger('rasmf')
+
+    if not polling:
+        try:
+            return InotifyWatcher(settings.incoming_dir,
+                                  settings.settle_seconds)
+        except (AttributeError, OSError, TypeError) as msg:
+            logger.warning("inotify unavailable, polling instead: %s", msg)
+    return PollingWatcher(settings.incoming_dir, settings.settle_seconds)
+
+
+def watched_sidecars(settings, operation, pending=(), stored=0):
+    """
+    Returns the operation of a settled video with the sidecars of its
+    directory attached, as a scan would group them. Directories below a
+    release directory are listed for e.g. Subs, and files still being
+    written, in pending, are left out.
+    stored is the number of videos already stored from the directory, which
+    still count towards its videos.
+    """
+    grouper = SidecarGrouper(settings)
+    rootdir = os.path.dirname(operation.source)
+    try:
+        if os.path.normpath(rootdir) == grouper.in_dir:
+            listings = [(rootdir, [], os.listdir(rootdir))]
+        else:
+            listings = list(os.walk(rootdir, topdown=False))
+    except OSError:
+        return operation
+
+    for dirpath, _, files in listings:
+        files = [full_filename for full_filename in files
+                 if os.path.join(dirpath, full_filename) not in pending]
+        if dirpath != rootdir:
+            grouper.group(dirpath, files, [])
+            continue
+        video_count = stored + sum(
+            1 for full_filename in files
+            if lower_splitext(full_filename)[1][1:] in
+            settings.video_extensions)
+        return grouper.group(dirpath, files, [operation], video_count)[0]
+    return operation
+
+
+def stop_watching(signum, frame):
+    """
+    SIGTERM handler of watch(), raising SystemExit so the caches are closed
+    and the metrics written on the way out.
+    """
+    logging.getLogger('rasmf').info("Received signal %d", signum)
+    raise SystemExit()
+
+
+def watch(settings, watcher, poll_seconds=1.0, max_polls=None,
+          journal=None, flush_seconds=CACHE_FLUSH_SECONDS):
+    """
+    Store video files as they land in the incoming directory, along with
+    their sidecars with the sidecars option.
+    First level directories are cleaned up once none of their files are
+    still being written.
+    Moves and removals are recorded in the Journal if given.
+    The hash cache and library index are written every flush_seconds, and
+    the library listings looked at again, as the session can run for days.
+    """
+    logger = logging.getLogger('rasmf')
+    logger.info("Watching %s", settings.incoming_dir)
+
+    try:
+        previous_sigterm = signal.signal(signal.SIGTERM, stop_watching)
+    except ValueError:
+        # Handlers can only be set from the main thread
+        previous_sigterm = None
+
+    dirs = directory_cache(settings)
+    hashes = open_hash_cache(settings)
+    library = open_library(settings)
+    watcher.start()
+    dirty_dirs = set()
+    # Directory => videos stored from it, for grouping sidecars
+    stored_videos = collections.Counter()
+    flush_at = time.monotonic() + flush_seconds
+    polls = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            for path in watcher.poll(poll_seconds):
+                rootdir, full_filename = os.path.split(path)
+                # get lowercase file extension
+                file_extension = os.path.splitext(full_filename)[1]
+                file_extension = file_extension.replace('.', '').lower()
+
+                metrics.inc('rasmf_files_scanned_total')
+                if file_extension not in settings.video_extensions:
+                    continue
+
+                operation = plan_video_file(
+                    settings, rootdir, full_filename, file_extension)
+                if not count_classified([operation]):
+                    continue
+                if library is not None:
+                    operation = library.resolve(operation)
+                    if operation is None:
+                        continue
+                if settings.sidecars:
+                    operation = watched_sidecars(
+                        settings, operation, set(watcher.pending()),
+                        stored_videos[rootdir])
+                    stored_videos[rootdir] += 1
+
+                result = None
+                if hashes is not None:
+                    result = deduplicate(settings, operation, hashes)
+                if result is None:
+                    clean_up_item = execute_operation(
+                        operation, dirs, settings.store_strategy, journal)
+                    if settings.store_strategy != 'move':
+                        clean_up_item = None
+                elif result.moved:
+                    clean_up_item = operation.clean_up_dir
+                else:
+                    clean_up_item = None
+                if clean_up_item:
+                    dirty_dirs.add(clean_up_item)
+
+            if dirty_dirs:
+                busy_dirs = set(
+                    relative_path(os.path.dirname(path), settings.incoming_dir)
+                    for path in watcher.pending())
+                ready_dirs = dirty_dirs - busy_dirs
+                if ready_dirs:
+                    clean_up(settings, ready_dirs, journal=journal)
+                    dirty_dirs -= ready_dirs
+                    for rootdir in list(stored_videos):
+                        if relative_path(rootdir, settings.incoming_dir) in (
+                                ready_dirs):
+                            del stored_videos[rootdir]
+
+            if time.monotonic() >= flush_at:
+                if hashes is not None:
+                    hashes.flush()
+                if library is not None:
+                    library.flush()
+                flush_at = time.monotonic() + flush_seconds
+    except KeyboardInterrupt:
+        logger.info("Stopped watching %s", settings.incoming_dir)
+    finally:
+        watcher.close()
+        if hashes is not None:
+            hashes.close()
+        if library is not None:
+            library.close()
+        if previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, previous_sigterm)
@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 
+import asyncio
+import collections
+import concurrent.futures
+import errno
 import unittest
 import os
 import shutil
 import platform
 import logging
 import inspect
+import io
+import json
 import re
+import signal
+import threading
+import time
+import urllib.request
+from unittest import mock
 
+import benchmark_rasmf
 import rasmf
 
 
@@ -50,6 +62,8 @@ class TestRASMF(unittest.TestCase):
         with open(self.test_config_fn, 'w') as configfile:
             self.config.write(configfile)
 
+        self.settings = rasmf.read_settings(self.test_config_fn)
+
         # Make sure the test dir is clean
         if os.path.exists(base_dir):
             shutil.rmtree(base_dir)
@@ -57,6 +71,37 @@ class TestRASMF(unittest.TestCase):
         for folder in self.config['folders'].keys():
             os.makedirs(self.config['folders'][folder])
 
+    def test_read_settings(self):
+        self.assertEqual(self.settings.incoming_dir, self.in_dir)
+        self.assertEqual(self.settings.tv_dir, self.tv_dir)
+        self.assertEqual(
+            self.settings.video_extensions,
+            frozenset(['avi', 'divx', 'wmv', 'mp4', 'mkv', 'mpg', 'm4v']))
+        self.assertEqual(self.settings.subtitle_extensions,
+                         frozenset(['srt', 'sub']))
+        self.assertEqual(self.settings.log_level, 'INFO')
+
+    def test_parse_extensions(self):
+        test_data = [
+            "['avi', 'divx', 'MKV']",
+            'avi, .divx, mkv',
+            '[]',
+            '',
+        ]
+
+        observed = []
+        expected = [
+            frozenset(['avi', 'divx', 'mkv']),
+            frozenset(['avi', 'divx', 'mkv']),
+            frozenset(),
+            frozenset(),
+        ]
+
+        for value in test_data:
+            observed.append(rasmf.parse_extensions(value))
+
+        self.assertEqual(observed, expected)
+
     def test_sanitise_string_movie(self):
         """
         Test Sanitisation of a movie filename.
@@ -197,6 +242,22 @@ class TestRASMF(unittest.TestCase):
         expected.sort()
         self.assertEqual(observed, expected)
 
+        # Paths that are not plainly below the directory take relpath()
+        for source_dir, base_dir in [
+                (os.path.join(dl_dir, 'Show', '..', 'Movie'), dl_dir),
+                (os.path.join(dl_dir, 'Show', 'Season 1'), dl_dir + os.sep),
+                (os.path.join(dl_dir, '.', 'Show'), dl_dir),
+                (self.media_dir, dl_dir)]:
+            self.assertEqual(
+                rasmf.relative_path(source_dir, base_dir),
+                os.path.relpath(source_dir, base_dir).split(os.sep)[0])
+
+        # The files of a release share one string
+        self.assertIs(
+            rasmf.relative_path(os.path.join(dl_dir, 'Show' + 'One'), dl_dir),
+            rasmf.relative_path(os.path.join(dl_dir, 'ShowOne', 'Subs'),
+                                dl_dir))
+
     def test_tv_show_name(self):
         test_data = [
             ('', 'Spaces.Are.Here.S01E01'),
@@ -242,6 +303,114 @@ class TestRASMF(unittest.TestCase):
         expected.sort()
         self.assertEqual(observed, expected)
 
+    def test_classifier_matches_reference(self):
+        first_dirs = [
+            '',
+            'Spaces Are Here S01',
+            'Periods.And.A.Season.Number-S01',
+            'Space And Square Brackets S05E08 AND Square[brackets]',
+            'Just.A.Season-S03',
+            'More Than one dir deep',
+        ]
+        filenames = [
+            'barbaric string of junk_2011-dvdrip.xvid-somedude[www.example.com]',
+            'the.title.2006.phatdisc.eng-thatchick(www.example.com)',
+            """my.test.movie (2001) file.has[bracket's & parnthesis]""",
+            '2015.more.title.as.string-1984.some.other.junk',
+            'space as seperator - s01e03 this is fun[xyz]',
+            'underscores_are_the_go_s01e05_this_is_fun[_]',
+            's01e01.this.string.will.be.ignored',
+            'a.violent.tv.show.s05e08.hdtv.x264-someone',
+            'square.brackets.s01e03-[someguy]',
+            'parenthesis.s01e04-(someguy)',
+            'me & my dog-S01E02-halfbaked',
+            """some..other-.stuff'S05E01-and more stuff""",
+            'My Favourite Tv Show-S01E01',
+            'S03E03',
+            'noname',
+        ]
+
+        # The rules of the example config are the defaults
+        self.assertEqual(self.settings.rename_rules,
+                         rasmf.DEFAULT_RENAME_RULES)
+        classifier = rasmf.classifier_for(self.settings.rename_rules)
+        for first_dir in first_dirs:
+            for filename in filenames:
+                for extension in ['.avi', '.MKV']:
+                    full_filename = filename + extension
+                    observed = classifier.classify(first_dir, full_filename)
+                    media_type = rasmf.video_type(full_filename)
+                    self.assertEqual(observed.media_type, media_type)
+
+                    if media_type == 'tv':
+                        show, show_season, name = rasmf.tv_show_parts(
+                            first_dir, full_filename)
+                        self.assertEqual(observed.show, show)
+                        self.assertEqual(
+                            observed.show + '-' + observed.season,
+                            show_season)
+                        self.assertEqual(observed.name, name)
+                    elif media_type == 'movie':
+                        self.assertEqual(
+                            observed.name,
+                            rasmf.movie_name(full_filename,
+                                             extension[1:].lower()))
+
+        observed = classifier.classify_many('Just.A.Season-S03', [
+            'S03E03.avi', 'the.title.2006.phatdisc.mkv', 'noname.avi'])
+        self.assertEqual(observed, [
+            rasmf.Classification('tv', 'Just.A.Season', 'S03', '03', None,
+                                 'avi', 'S03E03.avi'),
+            rasmf.Classification('movie', None, None, None, '2006', 'mkv',
+                                 'The.Title.2006.mkv'),
+            rasmf.Classification(None, None, None, None, None, 'avi', None),
+        ])
+
+    def test_rename_rules(self):
+        self.config['rename']['separator'] = "' '"
+        self.config['rename']['separator_characters'] = "['.', '_']"
+        self.config['rename']['replacements'] = "{'&': 'and', '+': ' plus '}"
+        self.config['rename']['strip_release_group'] = 'yes'
+        self.config['rename']['quality_tags'] = "['720p', '1080p', 'x264']"
+        self.config['show_aliases']['me and my dog'] = 'Me And My Dog (US)'
+        with open(self.test_config_fn, 'w') as configfile:
+            self.config.write(configfile)
+        settings = rasmf.read_settings(self.test_config_fn)
+
+        classifier = rasmf.classifier_for(settings.rename_rules)
+        self.assertIs(rasmf.classifier_for(settings.rename_rules), classifier)
+        observed = classifier.classify_many('', [
+            '[Grp] me & my dog.S01E02.720p.mkv',
+            'some_movie+more.2010.1080p.x264.avi',
+            'no.year.1080p.avi',
+        ])
+        self.assertEqual(observed, [
+            rasmf.Classification('tv', 'Me And My Dog (US)', 'S01', '02',
+                                 None, 'mkv', 'Me And My Dog (US) S01E02.mkv'),
+            rasmf.Classification('movie', None, None, None, '2010', 'avi',
+                                 'Some Movie Plus More 2010.avi'),
+            rasmf.Classification(None, None, None, None, None, 'avi', None),
+        ])
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            rasmf.explain(settings, ['Me.And.My.Dog-S01/S01E03.mkv'])
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            'Me.And.My.Dog-S01/S01E03.mkv',
+            '  input      S01E03.mkv',
+            '  strip      s01e03',
+            '  sanitise   s01e03',
+            '  season     s01e03',
+            '  show       Me And My Dog',
+            '  alias      Me And My Dog (US)',
+            '  target     ' + os.path.join(
+                self.tv_dir, 'Me And My Dog (US)', 'Me And My Dog (US)-S01',
+                'S01E03.mkv'),
+        ])
+
+        self.config['rename']['separator'] = '--'
+        with self.assertRaises(ValueError):
+            rasmf.rename_rules(self.config)
+
     def test_process_tv_show_file(self):
         test_data = [
             (os.path.join(self.in_dir, 'My.Favourite.Tv.Show-S01'),
@@ -290,11 +459,11 @@ class TestRASMF(unittest.TestCase):
                 file_extension = os.path.splitext(full_filename)[1]
                 file_extension = file_extension.replace('.', '').lower()
 
-                if file_extension in self.config['file_extensions']['video']:
+                if file_extension in self.settings.video_extensions:
                     # Is it a TV show
                     if re.search(r'[sS][0-9]+[eE][0-9]+', full_filename):
                         rasmf.process_tv_show_file(
-                            rootdir, full_filename, self.tv_dir)
+                            self.settings, rootdir, full_filename)
 
         # Observe which files are stored in the tv media dir
         for root, dirs, files in os.walk(self.tv_dir, topdown=False):
@@ -305,6 +474,1025 @@ class TestRASMF(unittest.TestCase):
         expected.sort()
         self.assertEqual(observed, expected)
 
+    def make_incoming_files(self, test_data):
+        """
+        Create files in the incoming directory from (dir, filename) tuples.
+        """
+        for path_1, filename in test_data:
+            rootdir = os.path.join(self.in_dir, path_1)
+            os.makedirs(rootdir, exist_ok=True)
+            with open(os.path.join(rootdir, filename), 'w') as fo:
+                fo.write(filename)
+
+    def test_build_plan(self):
+        test_data = [
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01.Repack', 'Show One-S01E01.mkv'),
+            ('Some.Movie.2010.Release', 'some movie 2010 release.avi'),
+            ('Some.Movie.2010.Release', 'some movie 2010 release.nfo'),
+            ('', 'not a video.txt'),
+        ]
+        self.make_incoming_files(test_data)
+
+        plan = rasmf.build_plan(self.settings)
+
+        # The second episode collides with the first one and is dropped
+        self.assertEqual(len(plan), 2)
+        self.assertEqual(
+            sorted(operation.target for operation in plan),
+            [os.path.join(self.movie_dir, 'Some.Movie.2010.avi'),
+             os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01',
+                          'Show.One-S01E01.mkv')])
+
+        # Planning does not touch any file
+        self.assertFalse(os.listdir(self.tv_dir))
+        self.assertFalse(os.listdir(self.movie_dir))
+
+        observed = json.loads(rasmf.plan_to_json(plan))
+        self.assertEqual(
+            sorted(operation['media_type'] for operation in observed),
+            ['movie', 'tv'])
+
+    def test_build_plan_scan_index(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            (os.path.join('Some.Movie.2010', 'sample'), 'sample 2010.avi'),
+            ('', 'partial.mkv.part'),
+        ])
+
+        index = rasmf.open_scan_index(self.settings)
+        first_plan = rasmf.build_plan(self.settings, index)
+        index.close()
+
+        # Nothing changed, so nothing is classified again
+        with mock.patch('rasmf.plan.plan_video_file') as plan_video_file:
+            index = rasmf.open_scan_index(self.settings)
+            second_plan = rasmf.build_plan(self.settings, index)
+            index.close()
+        self.assertFalse(plan_video_file.called)
+        self.assertEqual(second_plan, first_plan)
+
+        # Only the new file is classified
+        self.make_incoming_files([('Show.One-S01', 'Show One-S01E02.mkv')])
+        with mock.patch('rasmf.plan.plan_video_file',
+                        wraps=rasmf.plan_video_file) as plan_video_file:
+            index = rasmf.open_scan_index(self.settings)
+            third_plan = rasmf.build_plan(self.settings, index)
+            index.close()
+        self.assertEqual(plan_video_file.call_count, 1)
+        self.assertEqual(len(third_plan), len(first_plan) + 1)
+        self.assertEqual(sorted(third_plan),
+                         sorted(rasmf.build_plan(self.settings)))
+
+        # A change to the rename rules classifies everything again
+        settings = self.settings._replace(
+            rename_rules=self.settings.rename_rules._replace(separator='_'))
+        index = rasmf.open_scan_index(settings)
+        fourth_plan = rasmf.build_plan(settings, index)
+        index.close()
+        self.assertEqual(fourth_plan, rasmf.build_plan(settings))
+        self.assertIn(os.path.join(self.tv_dir, 'Show_One', 'Show_One-S01',
+                                   'Show_One-S01E01.mkv'),
+                      [operation.target for operation in fourth_plan])
+
+    def test_scan_index_racy(self):
+        self.make_incoming_files([('Show.One-S01', 'Show One-S01E01.mkv')])
+        show_dir = os.path.join(self.in_dir, 'Show.One-S01')
+        os.utime(show_dir, (1000, 1000))
+
+        def listed():
+            with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+                index = rasmf.open_scan_index(self.settings)
+                list(rasmf.indexed_walk(self.in_dir, index))
+                index.close()
+            return sorted(call[0][0] for call in scandir.call_args_list)
+
+        self.assertEqual(listed(), [self.in_dir, show_dir])
+        # The incoming directory changed just now, so it is listed again
+        self.assertEqual(listed(), [self.in_dir])
+
+    def test_execute_plan_parallel(self):
+        settings = self.settings._replace(workers=4)
+        test_data = [
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01', 'Show One-S01E02.mkv'),
+            ('Some.Movie.2010.Release', 'some movie 2010 release.avi'),
+            ('', 'Show Two-S02E01.mkv'),
+        ]
+
+        expected_files = [
+            os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01',
+                         'Show.One-S01E01.mkv'),
+            os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01',
+                         'Show.One-S01E02.mkv'),
+            os.path.join(self.tv_dir, 'Show.Two', 'Show.Two-S02',
+                         'Show.Two-S02E01.mkv'),
+            os.path.join(self.movie_dir, 'Some.Movie.2010.avi'),
+        ]
+
+        self.make_incoming_files(test_data)
+        plan = rasmf.build_plan(settings)
+        self.assertEqual([operation.stat for operation in plan],
+                         [rasmf.file_stat(operation.source)
+                          for operation in plan])
+
+        # The sources are not stat'ed again once planned
+        settings = settings._replace(schedule='smallest-first',
+                                     renames_first=True)
+        with mock.patch('os.stat', wraps=os.stat) as stat:
+            clean_up_list = rasmf.execute_plan(
+                settings, rasmf.schedule_plan(settings, plan))
+        sources = set(operation.source for operation in plan)
+        self.assertFalse([call for call in stat.call_args_list
+                          if call[0][0] in sources])
+
+        observed_files = []
+        for root, dirs, files in os.walk(self.media_dir):
+            for f in files:
+                observed_files.append(os.path.join(root, f))
+
+        self.assertEqual(sorted(observed_files), sorted(expected_files))
+        self.assertEqual(
+            sorted(clean_up_list),
+            ['Show.One-S01', 'Show.One-S01', 'Some.Movie.2010.Release'])
+
+    def test_copy_file_resume(self):
+        source = os.path.join(self.in_dir, 'Big.Movie.2012.mkv')
+        target = os.path.join(self.movie_dir, 'Big.Movie.2012.mkv')
+        data = os.urandom(300 * 1024)
+        with open(source, 'wb') as fo:
+            fo.write(data)
+
+        # An interrupted copy is resumed
+        with open(target + rasmf.PARTIAL_SUFFIX, 'wb') as fo:
+            fo.write(data[:100 * 1024])
+        with mock.patch('rasmf.transfer.COPY_CHUNK_SIZE', 64 * 1024):
+            rasmf.copy_file(source, target)
+
+        with open(target, 'rb') as fo:
+            self.assertEqual(fo.read(), data)
+        self.assertFalse(os.path.exists(source))
+        self.assertFalse(os.path.exists(target + rasmf.PARTIAL_SUFFIX))
+
+    def test_copy_file_fallback(self):
+        source = os.path.join(self.in_dir, 'Big.Movie.2012.mkv')
+        target = os.path.join(self.movie_dir, 'Big.Movie.2012.mkv')
+        data = os.urandom(200 * 1024)
+        with open(source, 'wb') as fo:
+            fo.write(data)
+
+        # A partial copy that does not match the source is started again
+        with open(target + rasmf.PARTIAL_SUFFIX, 'wb') as fo:
+            fo.write(b'x' * 1024)
+
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        with mock.patch.object(os, 'copy_file_range', unsupported,
+                               create=True), \
+                mock.patch.object(os, 'sendfile', unsupported, create=True):
+            rasmf.copy_file(source, target)
+
+        with open(target, 'rb') as fo:
+            self.assertEqual(fo.read(), data)
+        self.assertFalse(os.path.exists(source))
+
+    def test_run_pipeline(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            (os.path.join('Show.One-S01', 'Subs'), 'show.one.srt'),
+            ('Some.Movie.2010.Release', 'some movie 2010 release.avi'),
+            ('Some.Movie.2010.Release', 'some movie 2010 release.pdf'),
+            ('', 'Show Two-S02E01.mkv'),
+        ])
+
+        # A stage of our own sees each release directory after its clean up
+        released = {}
+
+        def check_release_stage(items):
+            for item in items:
+                if isinstance(item, rasmf.ReleaseDone):
+                    released[item.first_dir] = os.path.exists(
+                        os.path.join(self.in_dir, item.first_dir))
+                yield item
+
+        tree = rasmf.ScanTree()
+        rasmf.run_pipeline(
+            rasmf.scan_stage(self.settings, tree=tree),
+            rasmf.pipeline_stages(self.settings, tree=tree) +
+            [check_release_stage])
+
+        self.assertEqual(released, {
+            'Show.One-S01': False,
+            'Some.Movie.2010.Release': True,
+        })
+        # Release directories are dropped from the tree once done
+        self.assertEqual(list(tree.directories),
+                         [os.path.normpath(self.in_dir)])
+
+        observed_files = []
+        for root, dirs, files in os.walk(self.media_dir):
+            for f in files:
+                observed_files.append(os.path.join(root, f))
+        self.assertEqual(sorted(observed_files), [
+            os.path.join(self.movie_dir, 'Some.Movie.2010.avi'),
+            os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01',
+                         'Show.One-S01E01.mkv'),
+            os.path.join(self.tv_dir, 'Show.Two', 'Show.Two-S02',
+                         'Show.Two-S02E01.mkv'),
+        ])
+
+    def test_directory_cache(self):
+        episodes = ['Show One-S01E0{}.mkv'.format(n) for n in range(1, 5)]
+        self.make_incoming_files([('Show.One-S01', e) for e in episodes])
+        source_dir = os.path.join(self.in_dir, 'Show.One-S01')
+        season_dir = os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01')
+
+        dirs = rasmf.DirectoryCache()
+        rasmf.process_tv_show_file(self.settings, source_dir, episodes[0],
+                                   dirs=dirs)
+        self.assertIn(season_dir, dirs)
+        self.assertIn(self.tv_dir, dirs)
+
+        # Later episodes of the season cost no directory checks
+        with mock.patch('os.makedirs') as makedirs, \
+                mock.patch('os.path.isdir') as isdir:
+            for episode in episodes[1:]:
+                rasmf.process_tv_show_file(self.settings, source_dir,
+                                           episode, dirs=dirs)
+        makedirs.assert_not_called()
+        isdir.assert_not_called()
+        self.assertEqual(len(os.listdir(season_dir)), 4)
+
+        # A failed move forgets the directory
+        shutil.rmtree(season_dir)
+        self.make_incoming_files([('Show.One-S01', episodes[0])])
+        self.assertIsNone(rasmf.process_tv_show_file(
+            self.settings, source_dir, episodes[0], dirs=dirs))
+        self.assertNotIn(season_dir, dirs)
+        rasmf.process_tv_show_file(self.settings, source_dir, episodes[0],
+                                   dirs=dirs)
+        self.assertEqual(os.listdir(season_dir), ['Show.One-S01E01.mkv'])
+
+        # Warming from tv_dir finds the show and season directories
+        warm = rasmf.directory_cache(
+            self.settings._replace(warm_dir_cache=True))
+        self.assertIn(season_dir, warm)
+        self.assertIn(os.path.join(self.tv_dir, 'Show.One'), warm)
+
+    def test_store_file(self):
+        self.make_incoming_files([('', name) for name in 'abcd'])
+        os.makedirs(self.media_dir, exist_ok=True)
+        for name in 'abcd':
+            with open(os.path.join(self.in_dir, name), 'w') as fo:
+                fo.write(name)
+
+        def store(name, strategy):
+            return rasmf.store_file(os.path.join(self.in_dir, name),
+                                    os.path.join(self.media_dir, name),
+                                    strategy)
+
+        self.assertEqual(store('a', 'hardlink'), 'hardlink')
+        self.assertTrue(os.path.samefile(os.path.join(self.in_dir, 'a'),
+                                         os.path.join(self.media_dir, 'a')))
+        self.assertEqual(store('b', 'symlink'), 'symlink')
+        self.assertEqual(os.readlink(os.path.join(self.media_dir, 'b')),
+                         os.path.join(self.in_dir, 'b'))
+        self.assertIn(store('c', 'reflink'), ['reflink', 'copy'])
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, '')):
+            self.assertEqual(store('d', 'hardlink'), 'copy')
+
+        # The sources are kept and not stored again
+        self.assertEqual(sorted(os.listdir(self.in_dir)), list('abcd'))
+        for name, strategy in [('a', 'hardlink'), ('b', 'symlink'),
+                               ('c', 'reflink'), ('d', 'copy')]:
+            with open(os.path.join(self.media_dir, name)) as fo:
+                self.assertEqual(fo.read(), name)
+            self.assertIsNone(store(name, strategy))
+
+    def test_run_pipeline_hardlink(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01', 'show.one.nfo'),
+        ])
+        settings = self.settings._replace(store_strategy='hardlink')
+        rasmf.run_pipeline(rasmf.scan_stage(settings),
+                           rasmf.pipeline_stages(settings))
+
+        # The release is kept for seeding
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.in_dir, 'Show.One-S01'))),
+            ['Show One-S01E01.mkv', 'show.one.nfo'])
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.in_dir, 'Show.One-S01', 'Show One-S01E01.mkv'),
+            os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01',
+                         'Show.One-S01E01.mkv')))
+
+    def test_journal_recovery(self):
+        self.make_incoming_files([
+            ('Copied.Movie.2001', 'copied movie 2001.mkv'),
+            ('Partial.Movie.2002', 'partial movie 2002.mkv'),
+            ('Junk.Release', 'junk.nfo'),
+            ('Moved.Movie.2003', 'moved movie 2003.nfo'),
+        ])
+        os.makedirs(self.movie_dir, exist_ok=True)
+        copied = os.path.join(self.in_dir, 'Copied.Movie.2001',
+                              'copied movie 2001.mkv')
+        partial = os.path.join(self.in_dir, 'Partial.Movie.2002',
+                               'partial movie 2002.mkv')
+        shutil.copy(copied,
+                    os.path.join(self.movie_dir, 'Copied.Movie.2001.mkv'))
+        with open(os.path.join(self.movie_dir, 'Partial.Movie.2002.mkv' +
+                               rasmf.PARTIAL_SUFFIX), 'w'):
+            pass
+
+        # A run killed after the copy, during a copy and during a removal
+        path = os.path.join(self.in_dir, 'journal.jsonl')
+        journal = rasmf.Journal(path, batch_size=2)
+        for source in [copied, partial]:
+            journal.begin(
+                'move', source=source, strategy='move',
+                target=os.path.join(self.movie_dir, os.path.basename(
+                    os.path.dirname(source)) + '.mkv'),
+                clean_up_dir=os.path.basename(os.path.dirname(source)))
+        journal.progress(1)
+        self.assertEqual(journal.busy_dirs(),
+                         {'Copied.Movie.2001', 'Partial.Movie.2002'})
+        journal.begin('rmdir', sync=True, clean_up_dir='Junk.Release')
+        done = journal.begin('rmdir', clean_up_dir='Moved.Movie.2003')
+        journal.end(done)
+        journal.fo.close()
+
+        self.assertEqual(len(rasmf.read_journal(path)), 3)
+        self.assertEqual(rasmf.recover_journal(self.settings, path), 3)
+
+        self.assertFalse(os.path.exists(copied))
+        self.assertTrue(os.path.exists(partial))
+        self.assertEqual(sorted(os.listdir(self.in_dir)), [
+            'Copied.Movie.2001', 'Moved.Movie.2003', 'Partial.Movie.2002',
+            'journal.jsonl'])
+        self.assertEqual(os.path.getsize(path), 0)
+
+    def test_journal_lock(self):
+        settings = self.settings._replace(log_dir=self.in_dir)
+        journal = rasmf.open_journal(settings)
+        entry = journal.begin('move', sync=True, source='a', target='b',
+                              strategy='move', clean_up_dir='')
+        journal.progress(entry)
+        journal.fo.flush()
+
+        # A second run leaves the journal of the live run alone
+        with self.assertRaises(SystemExit):
+            rasmf.open_journal(settings)
+        self.assertEqual(len(rasmf.read_journal(journal.path)), 1)
+
+        journal.end(entry)
+        journal.close()
+        rasmf.open_journal(settings).close()
+
+    def test_journal_batches(self):
+        self.make_incoming_files([])
+        path = os.path.join(self.in_dir, 'journal.jsonl')
+        journal = rasmf.Journal(path, batch_size=4)
+        with mock.patch('os.fsync') as fsync:
+            for n in range(3):
+                journal.end(journal.begin('move', clean_up_dir=''))
+            self.assertEqual(fsync.call_count, 1)
+            journal.begin('rmdir', sync=True, clean_up_dir='')
+            self.assertEqual(fsync.call_count, 2)
+            journal.close()
+        # An unfinished entry keeps the journal for the next start
+        self.assertEqual(len(rasmf.read_journal(path)), 1)
+
+    def test_metrics(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01', 'show.one.nfo'),
+            ('Some.Movie.2010', 'some movie 2010.avi'),
+            ('', 'home video.mkv'),
+        ])
+        metrics = rasmf.metrics
+        with mock.patch.object(metrics, 'values', {}), \
+                mock.patch.object(metrics, 'histograms', {}):
+            rasmf.run_pipeline(rasmf.scan_stage(self.settings),
+                               rasmf.pipeline_stages(self.settings))
+            rasmf.write_metrics(self.settings, 1.5)
+
+            server = rasmf.serve_metrics(0)
+            try:
+                url = 'http://127.0.0.1:{}/metrics'.format(
+                    server.server_address[1])
+                with urllib.request.urlopen(url) as response:
+                    served = response.read().decode('utf-8')
+            finally:
+                server.shutdown()
+                server.server_close()
+            current = metrics.exposition()
+
+        with open(os.path.join(self.settings.log_dir,
+                               self.settings.metrics_file)) as fo:
+            exposition = fo.read()
+        self.assertEqual(served, current)
+        self.assertEqual(exposition, served)
+
+        samples = dict(line.rsplit(' ', 1)
+                       for line in exposition.splitlines()
+                       if not line.startswith('#'))
+        self.assertEqual(samples['rasmf_files_scanned_total'], '4')
+        for media_type in ['tv', 'movie', 'ignored']:
+            self.assertEqual(samples['rasmf_files_classified_total'
+                                     '{media_type="%s"}' % media_type], '1')
+        self.assertEqual(samples['rasmf_bytes_moved_total'
+                                 '{destination="tv"}'],
+                         str(len('Show One-S01E01.mkv')))
+        self.assertEqual(samples['rasmf_move_seconds_count'
+                                 '{destination="movie"}'], '1')
+        self.assertEqual(samples['rasmf_directories_cleaned_total'], '2')
+        self.assertEqual(samples['rasmf_run_seconds'], '1.5')
+        self.assertIn('# TYPE rasmf_move_seconds histogram', exposition)
+
+    def test_startup(self):
+        # A no-op run on an empty incoming directory leaves the modules of
+        # the options it does not use unimported
+        base_dir = os.path.join(os.path.dirname(self.in_dir), 'startup')
+        benchmark_rasmf.startup_dir(base_dir)
+        modules = benchmark_rasmf.startup_modules(base_dir)
+        self.assertIn('rasmf.cli', modules)
+        self.assertEqual(
+            modules.intersection(benchmark_rasmf.HEAVY_MODULES), set())
+        self.assertNotIn('rasmf.watcher', modules)
+
+        with self.assertRaises(AttributeError):
+            rasmf.no_such_function
+
+    def test_timing_trace(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Some.Movie.2010', 'some movie 2010.avi'),
+        ])
+        move_operation = rasmf.move_operation
+        path = os.path.join(self.in_dir, 'timings.jsonl')
+
+        trace = rasmf.TimingTrace(path)
+        trace.install()
+        self.assertIsNot(rasmf.move_operation, move_operation)
+        try:
+            rasmf.run_pipeline(rasmf.scan_stage(self.settings),
+                               rasmf.pipeline_stages(self.settings))
+        finally:
+            trace.close()
+        self.assertIs(rasmf.move_operation, move_operation)
+
+        with open(path) as fo:
+            records = [json.loads(line) for line in fo]
+        phases = collections.defaultdict(list)
+        for record in records:
+            phases[record['phase']].append(record['path'])
+        self.assertEqual(sorted(phases['move']), [
+            os.path.join(self.in_dir, 'Show.One-S01', 'Show One-S01E01.mkv'),
+            os.path.join(self.in_dir, 'Some.Movie.2010',
+                         'some movie 2010.avi'),
+        ])
+        self.assertEqual(sorted(phases['cleanup']),
+                         [['Show.One-S01'], ['Some.Movie.2010']])
+        self.assertEqual(set(phases), {'scan', 'classify', 'makedirs',
+                                       'move', 'cleanup'})
+        self.assertEqual(rasmf.parse_args(['--profile']).profile, '')
+        self.assertIsNone(rasmf.parse_args([]).profile)
+
+    def test_schedule_plan(self):
+        files = [
+            ('Show.One-S01', 'Show One-S01E01.mkv', 30),
+            ('Show.One-S01', 'Show One-S01E02.mkv', 20),
+            ('Big.Movie.2010', 'big movie 2010.mkv', 90),
+            ('Show.Two-S01', 'Show Two-S01E01.mkv', 10),
+        ]
+        self.make_incoming_files([(d, f) for d, f, size in files])
+        for age, (d, f, size) in enumerate(files):
+            path = os.path.join(self.in_dir, d, f)
+            with open(path, 'wb') as fo:
+                fo.truncate(size)
+            os.utime(path, (1000 - age, 1000 - age))
+        plan = []
+        rasmf.extend_plan(plan, set(), [
+            operation for d, f, size in files
+            for operation in rasmf.plan_directory(
+                self.settings, os.path.join(self.in_dir, d), [f])])
+
+        def order(**options):
+            settings = self.settings._replace(**options)
+            return [os.path.basename(operation.source)
+                    for operation in rasmf.schedule_plan(settings, plan)]
+
+        names = [f for d, f, size in files]
+        self.assertEqual(order(), names)
+        self.assertEqual(order(schedule='smallest-first'),
+                         [names[3], names[1], names[0], names[2]])
+        self.assertEqual(order(schedule='oldest-first'), names[::-1])
+        self.assertEqual(order(schedule='tv-first'),
+                         [names[0], names[1], names[3], names[2]])
+        self.assertEqual(order(schedule='fair'),
+                         [names[0], names[2], names[3], names[1]])
+
+        # The movie is a copy to another device
+        with mock.patch('rasmf.execute.target_devices',
+                        side_effect=lambda settings, plan: [
+                            1 if operation.media_type == 'movie' else None
+                            for operation in plan]):
+            self.assertEqual(order(schedule='fair', renames_first=True),
+                             [names[0], names[3], names[1], names[2]])
+            lanes = rasmf.move_lanes(
+                self.settings._replace(renames_first=True), plan)
+        self.assertEqual([len(lane) for lane in lanes], [1, 1, 1, 1])
+        self.assertEqual(lanes[-1][0].media_type, 'movie')
+
+        # Library folders that do not exist yet and sources that are gone
+        # count as copies rather than failing
+        missing = os.path.join(self.media_dir, 'missing')
+        settings = self.settings._replace(
+            tv_dir=os.path.join(missing, 'tv'),
+            movie_dir=os.path.join(missing, 'movie'), renames_first=True)
+        gone = [operation._replace(stat=None,
+                                   source=os.path.join(missing, 'a.mkv'))
+                for operation in plan]
+        self.assertEqual(rasmf.target_devices(settings, gone),
+                         [settings.tv_dir, settings.tv_dir,
+                          settings.movie_dir, settings.tv_dir])
+        self.assertEqual(rasmf.schedule_plan(settings, plan), plan)
+
+    def test_dedupe(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01', 'Show One-S01E02.mkv'),
+            ('Show.One-S01', 'Show One-S01E03.mkv'),
+        ])
+        source_dir = os.path.join(self.in_dir, 'Show.One-S01')
+        season_dir = os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01')
+        os.makedirs(season_dir)
+
+        def write(path, data):
+            with open(path, 'wb') as fo:
+                fo.write(data)
+
+        # E01 is already in the library, E02 under another name, E03 only
+        # matches on size
+        write(os.path.join(source_dir, 'Show One-S01E01.mkv'), b'one')
+        write(os.path.join(season_dir, 'Show.One-S01E01.mkv'), b'one')
+        write(os.path.join(source_dir, 'Show One-S01E02.mkv'), b'two')
+        write(os.path.join(season_dir, 'Show.One-S01E02.proper.mkv'), b'two')
+        write(os.path.join(source_dir, 'Show One-S01E03.mkv'), b'333')
+        plan = rasmf.plan_directory(self.settings, source_dir,
+                                    sorted(os.listdir(source_dir)))
+
+        hashes = rasmf.HashCache(os.path.join(self.in_dir, 'hashes.sqlite'))
+        skip = self.settings._replace(duplicates='skip')
+        remaining, clean_up_list = rasmf.dedupe_plan(skip, plan, hashes)
+        self.assertEqual(remaining, plan[2:])
+        self.assertEqual(clean_up_list, [])
+        self.assertEqual(len(os.listdir(source_dir)), 3)
+
+        hardlink = self.settings._replace(duplicates='hardlink')
+        remaining, clean_up_list = rasmf.dedupe_plan(hardlink, plan, hashes)
+        self.assertEqual(remaining, plan[2:])
+        self.assertEqual(clean_up_list, ['Show.One-S01', 'Show.One-S01'])
+        self.assertEqual(os.listdir(source_dir), ['Show One-S01E03.mkv'])
+        self.assertTrue(os.path.samefile(
+            os.path.join(season_dir, 'Show.One-S01E02.mkv'),
+            os.path.join(season_dir, 'Show.One-S01E02.proper.mkv')))
+        hashes.close()
+
+        # Library files are not hashed again in the next run
+        hashes = rasmf.HashCache(os.path.join(self.in_dir, 'hashes.sqlite'))
+        with mock.patch('rasmf.dedupe.partial_hash',
+                        return_value='') as hashed:
+            self.assertIsNone(rasmf.find_duplicate(plan[2], hashes))
+        self.assertEqual(hashed.call_count, 1)
+        hashes.close()
+
+        # A library directory is listed once while unchanged, and only the
+        # files of the size of the source are stat'ed
+        write(os.path.join(season_dir, 'Show.One-S01E04.mkv'), b'four')
+        os.utime(season_dir, (1000, 1000))
+        hashes = rasmf.HashCache(os.path.join(self.in_dir, 'hashes.sqlite'))
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir, \
+                mock.patch('os.stat', wraps=os.stat) as stat:
+            for _ in range(2):
+                self.assertIsNone(rasmf.find_duplicate(plan[2], hashes))
+        self.assertEqual(scandir.call_count, 1)
+        stated = [call[0][0] for call in stat.call_args_list]
+        self.assertIn(os.path.join(season_dir, 'Show.One-S01E01.mkv'),
+                      stated)
+        self.assertNotIn(os.path.join(season_dir, 'Show.One-S01E04.mkv'),
+                         stated)
+        hashes.close()
+
+    def test_dedupe_sampled_match(self):
+        self.make_incoming_files([('Show.One-S01', 'Show One-S01E01.mkv')])
+        source = os.path.join(self.in_dir, 'Show.One-S01',
+                              'Show One-S01E01.mkv')
+        season_dir = os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01')
+        os.makedirs(season_dir)
+        library_file = os.path.join(season_dir, 'Show.One-S01E01.proper.mkv')
+
+        # Same size, differing by one byte outside the sampled blocks
+        size = 10 * 1024 * 1024
+        for path, byte in [(source, b'a'), (library_file, b'b')]:
+            with open(path, 'wb') as fo:
+                fo.truncate(size)
+                fo.seek(5 * 1024 * 1024 + 12345)
+                fo.write(byte)
+        self.assertEqual(rasmf.partial_hash(source),
+                         rasmf.partial_hash(library_file))
+
+        plan = rasmf.build_plan(self.settings)
+        hashes = rasmf.HashCache(os.path.join(self.in_dir, 'hashes.sqlite'))
+        try:
+            # Skipping changes nothing, so the sampled hash is enough
+            skip = self.settings._replace(duplicates='skip')
+            self.assertEqual(rasmf.dedupe_plan(skip, plan, hashes),
+                             ([], []))
+
+            hardlink = self.settings._replace(duplicates='hardlink')
+            self.assertEqual(rasmf.dedupe_plan(hardlink, plan, hashes),
+                             (plan, []))
+        finally:
+            hashes.close()
+        self.assertTrue(os.path.exists(source))
+        self.assertFalse(os.path.samefile(source, library_file))
+
+    def test_pooled_build_plan(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01', 'Show One-S01E02.mkv'),
+            ('Show.One-S01.Repack', 'Show One-S01E01.mkv'),
+            ('Some.Movie.2010', 'some movie 2010.avi'),
+            ('Some.Movie.2010', 'some movie 2010.nfo'),
+            ('', 'home video.mkv'),
+            ('', 'Other Movie (1999).mp4'),
+        ])
+        plan = rasmf.build_plan(self.settings)
+
+        # Batches of two files over two processes give the same plan
+        pooled = self.settings._replace(classify_processes=2)
+        with mock.patch('rasmf.plan.CLASSIFY_BATCH_SIZE', 2):
+            self.assertEqual(rasmf.build_plan(pooled), plan)
+
+            # Cached classifications are taken from the scan index
+            index = rasmf.open_scan_index(pooled)
+            self.assertEqual(rasmf.build_plan(pooled, index), plan)
+            index.close()
+            with mock.patch('rasmf.plan.classify_files') as classify_files:
+                index = rasmf.open_scan_index(pooled)
+                self.assertEqual(rasmf.build_plan(pooled, index), plan)
+                index.close()
+            self.assertFalse(classify_files.called)
+
+    def test_library_index(self):
+        settings = self.settings._replace(library_index=True)
+        season_dir = os.path.join(self.tv_dir, 'Me.And.My.Dog.2019',
+                                  'Me.And.My.Dog.2019-S01')
+        os.makedirs(season_dir)
+        with open(os.path.join(season_dir,
+                               'Me.And.My.Dog.2019-S01E01.mkv'), 'w'):
+            pass
+        self.make_incoming_files([
+            ('Me.and.My.Dog-S01', 'me.and.my.dog.s01e01.mkv'),
+            ('Me.and.My.Dog-S01', 'me.and.my.dog.s01e02.mkv'),
+            ('Me.and.My.Dog-S02', 'me.and.my.dog.s02e01.mkv'),
+        ])
+
+        # S01E01 is already in the library, so it is not moved over it
+        library = rasmf.open_library(settings)
+        with self.assertLogs('rasmf', 'WARNING') as logs:
+            plan = rasmf.build_plan(settings, library=library)
+        library.close()
+        self.assertIn('Already in library', logs.output[0])
+        self.assertEqual(sorted(operation.target for operation in plan), [
+            os.path.join(season_dir, 'Me.And.My.Dog.2019.S01E02.mkv'),
+            os.path.join(self.tv_dir, 'Me.And.My.Dog.2019',
+                         'Me.And.My.Dog.2019-S02',
+                         'Me.And.My.Dog.2019.S02E01.mkv'),
+        ])
+
+        # Unchanged library directories are not listed again
+        with mock.patch('os.listdir') as listdir:
+            library = rasmf.open_library(settings)
+            self.assertEqual(rasmf.build_plan(settings, library=library),
+                             plan)
+            library.close()
+        self.assertFalse(listdir.called)
+
+        # Unless the dedupe stage is to check it for a duplicate
+        dedupe = settings._replace(duplicates='skip')
+        library = rasmf.open_library(dedupe)
+        self.assertIn(
+            os.path.join(season_dir, 'Me.And.My.Dog.2019-S01E01.mkv'),
+            [operation.target for operation
+             in rasmf.build_plan(dedupe, library=library)])
+        library.close()
+
+        self.assertEqual(rasmf.show_key('Me.and.My.Dog (2019)'),
+                         rasmf.show_key('Me.And.My.Dog'))
+        self.assertIsNone(rasmf.open_library(self.settings))
+
+    def test_sidecars(self):
+        settings = self.settings._replace(sidecars=True)
+        movie_dir = 'Some.Movie.2010.Release'
+        season_dir = 'Show.One-S01'
+        self.make_incoming_files([
+            (movie_dir, 'some movie 2010 release.avi'),
+            (movie_dir, 'release.nfo'),
+            (os.path.join(movie_dir, 'Subs'), 'English.srt'),
+            (os.path.join(movie_dir, 'Subs'), 'French.srt'),
+            (season_dir, 'Show One-S01E01.mkv'),
+            (season_dir, 'Show One-S01E01.en.forced.srt'),
+            (season_dir, 'Show One-S01E02.mkv'),
+            (season_dir, 'show one-s01e02.SRT'),
+            (season_dir, 'unrelated.sub'),
+        ])
+
+        plan = rasmf.build_plan(settings)
+        show_dir = os.path.join(self.tv_dir, 'Show.One', 'Show.One-S01')
+        self.assertEqual(sorted(target for operation in plan
+                                for _, target in operation.sidecars), [
+            os.path.join(self.movie_dir, 'Some.Movie.2010.English.srt'),
+            os.path.join(self.movie_dir, 'Some.Movie.2010.French.srt'),
+            os.path.join(self.movie_dir, 'Some.Movie.2010.nfo'),
+            os.path.join(show_dir, 'Show.One-S01E01.en.forced.srt'),
+            os.path.join(show_dir, 'Show.One-S01E02.srt'),
+        ])
+        self.assertEqual(
+            rasmf.build_plan(settings._replace(classify_processes=2)), plan)
+        self.assertEqual(rasmf.build_plan(self.settings),
+                         [operation._replace(sidecars=())
+                          for operation in plan])
+
+        # Groups are stored together and the release directories cleaned up,
+        # but for the one holding a sidecar that is not in a group
+        tree = rasmf.ScanTree()
+        rasmf.run_pipeline(rasmf.scan_stage(settings, tree=tree),
+                           rasmf.pipeline_stages(settings, tree=tree))
+        for operation in plan:
+            for _, target in operation.sidecars:
+                self.assertTrue(os.path.exists(target))
+        self.assertFalse(os.path.exists(os.path.join(self.in_dir,
+                                                     movie_dir)))
+        self.assertEqual(os.listdir(os.path.join(self.in_dir, season_dir)),
+                         ['unrelated.sub'])
+
+    def test_sidecar_store_failure(self):
+        settings = self.settings._replace(sidecars=True)
+        release_dir = os.path.join(self.in_dir, 'Some.Movie.2010')
+        self.make_incoming_files([
+            ('Some.Movie.2010', 'some movie 2010.mkv'),
+            ('Some.Movie.2010', 'some movie 2010.srt'),
+        ])
+        tree = rasmf.ScanTree()
+        plan = rasmf.build_plan(settings, tree=tree)
+        store_file = rasmf.store_file
+
+        def failing_store(source, target, *args, **kwargs):
+            if source.endswith('.srt'):
+                raise OSError(errno.EACCES, 'Permission denied')
+            return store_file(source, target, *args, **kwargs)
+
+        with mock.patch('rasmf.transfer.store_file', failing_store):
+            clean_up_list = rasmf.execute_plan(settings, plan, tree)
+        # The subtitle left behind stays in the tree and keeps its release
+        self.assertEqual(tree.directories[release_dir][1],
+                         {'some movie 2010.srt'})
+        rasmf.clean_up(settings, clean_up_list, tree)
+        self.assertEqual(os.listdir(release_dir), ['some movie 2010.srt'])
+
+    def test_partial_hash(self):
+        size = 8 * rasmf.HASH_BLOCK_SIZE
+        paths = [os.path.join(self.in_dir, name) for name in 'ab']
+        for path in paths:
+            with open(path, 'wb') as fo:
+                fo.truncate(size)
+        # A byte between the sampled blocks only shows in the full hash
+        with open(paths[1], 'r+b') as fo:
+            fo.seek(size // 2)
+            fo.write(b'x')
+
+        self.assertEqual(rasmf.partial_hash(paths[0]),
+                         rasmf.partial_hash(paths[1]))
+        self.assertNotEqual(rasmf.full_hash(paths[0]),
+                            rasmf.full_hash(paths[1]))
+
+    def test_async_sweep(self):
+        self.make_incoming_files(
+            [('Show.One-S01', 'Show One-S01E0{}.mkv'.format(n))
+             for n in range(1, 7)] +
+            [('', 'Movie {} (201{}).mkv'.format(n, n)) for n in range(6)] +
+            [(os.path.join('Show.One-S01', 'Subs'), 'show.one.srt')])
+        settings = self.settings._replace(async_limit=5,
+                                          async_destination_limit=2)
+
+        # Count the moves in flight for each destination
+        lock = threading.Lock()
+        in_flight = {'tv': 0, 'movie': 0}
+        most = {'tv': 0, 'movie': 0, 'all': 0}
+        move_operation = rasmf.move_operation
+
+        def slow_move(operation, *args):
+            with lock:
+                in_flight[operation.media_type] += 1
+                most[operation.media_type] = max(
+                    most[operation.media_type],
+                    in_flight[operation.media_type])
+                most['all'] = max(most['all'], sum(in_flight.values()))
+            time.sleep(0.05)
+            try:
+                return move_operation(operation, *args)
+            finally:
+                with lock:
+                    in_flight[operation.media_type] -= 1
+
+        with mock.patch('rasmf.transfer.move_operation', slow_move):
+            plan = asyncio.run(rasmf.async_sweep(settings))
+
+        self.assertEqual(len(plan), 12)
+        self.assertEqual(most, {'tv': 2, 'movie': 2, 'all': 4})
+        self.assertFalse(os.path.exists(
+            os.path.join(self.in_dir, 'Show.One-S01')))
+        self.assertEqual(sorted(os.listdir(self.movie_dir)), sorted(
+            'Movie.{}.201{}.mkv'.format(n, n) for n in range(6)))
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.tv_dir, 'Show.One', 'Show.One-S01'))), 6)
+
+    def test_async_build_plan(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01', 'Show One-S01E02.mkv'),
+            ('Some.Movie.2010', 'some movie 2010.avi'),
+        ])
+        settings = self.settings._replace(library_index=True)
+        stat = os.stat
+        loop_stats = []
+
+        def recording_stat(path, *args, **kwargs):
+            if threading.current_thread() is threading.main_thread():
+                loop_stats.append(path)
+            return stat(path, *args, **kwargs)
+
+        async def build():
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+            library = rasmf.open_library(settings)
+            try:
+                return await rasmf.async_build_plan(
+                    settings, executor=executor, limit=asyncio.Semaphore(2),
+                    library=library)
+            finally:
+                library.close()
+                executor.shutdown()
+
+        with mock.patch('os.stat', recording_stat):
+            plan = asyncio.run(build())
+        # Nothing is stat'ed on the event loop thread, the library folders
+        # included
+        self.assertEqual(loop_stats, [])
+        self.assertEqual(plan, rasmf.build_plan(self.settings))
+
+    def test_settle_tracker(self):
+        now = [0.0]
+        tracker = rasmf.SettleTracker(10, clock=lambda: now[0])
+        self.make_incoming_files([('', 'Growing-S01E01.mkv')])
+        path = os.path.join(self.in_dir, 'Growing-S01E01.mkv')
+
+        tracker.touch(path)
+        self.assertEqual(tracker.settled(), [])
+
+        # The file grows, so it has to settle again
+        now[0] = 8.0
+        with open(path, 'a') as fo:
+            fo.write('more')
+        self.assertEqual(tracker.settled(), [])
+        now[0] = 16.0
+        self.assertEqual(tracker.settled(), [])
+
+        now[0] = 18.0
+        self.assertEqual(tracker.settled(), [path])
+        self.assertEqual(tracker.pending, {})
+
+    def test_watch_polling(self):
+        settings = self.settings._replace(settle_seconds=0)
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.Two-S01', 'Show Two-S01E01.mkv'),
+            ('Show.Two-S01', 'Show Two-S01E02.mkv.part'),
+        ])
+        watcher = rasmf.PollingWatcher(self.in_dir, settle_seconds=0)
+        # Everything but the partial download settles straight away
+        def settled():
+            ready = [path for path in watcher.tracker.pending
+                     if not path.endswith('.part')]
+            for path in ready:
+                watcher.tracker.discard(path)
+            return ready
+        watcher.tracker.settled = settled
+
+        rasmf.watch(settings, watcher, poll_seconds=0, max_polls=1)
+
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tv_dir, 'Show.One', 'Show.One-S01', 'Show.One-S01E01.mkv')))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tv_dir, 'Show.Two', 'Show.Two-S01', 'Show.Two-S01E01.mkv')))
+        # Show.Two-S01 still has a file being written so it is kept
+        self.assertEqual(os.listdir(self.in_dir), ['Show.Two-S01'])
+
+    def test_watch_sidecars(self):
+        settings = self.settings._replace(settle_seconds=0, sidecars=True)
+        self.make_incoming_files([
+            ('Some.Movie.2010', 'some movie 2010.mkv'),
+            ('Some.Movie.2010', 'some movie 2010.en.srt'),
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01', 'Show One-S01E02.mkv'),
+            ('Show.One-S01', 'extras.nfo'),
+        ])
+        watcher = rasmf.PollingWatcher(self.in_dir, settle_seconds=0)
+        # Files settle on the second poll
+        rasmf.watch(settings, watcher, poll_seconds=0, max_polls=2)
+
+        self.assertEqual(sorted(os.listdir(self.movie_dir)), [
+            'Some.Movie.2010.en.srt', 'Some.Movie.2010.mkv'])
+        # The season pack has two videos so extras.nfo is not grouped, and
+        # its release directory is kept rather than the nfo deleted
+        self.assertEqual(sorted(os.listdir(self.in_dir)), ['Show.One-S01'])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.in_dir, 'Show.One-S01', 'extras.nfo')))
+
+    def test_watch_sigterm(self):
+        settings = self.settings._replace(settle_seconds=0,
+                                          library_index=True)
+        self.make_incoming_files([('Show.One-S01', 'Show One-S01E01.mkv')])
+        watcher = rasmf.PollingWatcher(self.in_dir, settle_seconds=0)
+        poll = watcher.poll
+        polls = []
+
+        def scripted_poll(timeout):
+            polls.append(timeout)
+            if len(polls) == 3:
+                # Another program adds a show once the index has been used
+                os.makedirs(os.path.join(self.tv_dir, 'Show.Two.2020'))
+                self.make_incoming_files([
+                    ('Show.Two-S01', 'Show Two-S01E01.mkv')])
+            elif len(polls) == 5:
+                os.kill(os.getpid(), signal.SIGTERM)
+            return poll(timeout)
+        watcher.poll = scripted_poll
+
+        handler = signal.getsignal(signal.SIGTERM)
+        with self.assertRaises(SystemExit):
+            rasmf.watch(settings, watcher, poll_seconds=0, flush_seconds=0)
+        self.assertIs(signal.getsignal(signal.SIGTERM), handler)
+
+        # The flushed library index sees the new show folder
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tv_dir, 'Show.Two.2020', 'Show.Two.2020-S01',
+            'Show.Two.2020-S01E01.mkv')))
+        library = rasmf.open_library(settings)
+        self.assertIn(self.tv_dir, library.directories)
+        library.close()
+
+    @unittest.skipUnless(platform.system() == 'Linux', 'requires inotify')
+    def test_inotify_watcher(self):
+        os.makedirs(os.path.join(self.in_dir, 'Show.One-S01'))
+        watcher = rasmf.InotifyWatcher(self.in_dir, settle_seconds=3600)
+        try:
+            watcher.start()
+            self.make_incoming_files([('Show.One-S01', 'Show One-S01E01.mkv')])
+            observed = []
+            for attempt in range(10):
+                observed.extend(watcher.poll(0.1))
+                if observed:
+                    break
+        finally:
+            watcher.close()
+
+        self.assertEqual(observed, [os.path.join(
+            self.in_dir, 'Show.One-S01', 'Show One-S01E01.mkv')])
+
+    def test_traced(self):
+        @rasmf.traced
+        def traced_function(value):
+            return value * 2
+
+        logger = logging.getLogger('rasmf')
+        with self.assertLogs(logger, logging.DEBUG) as logs:
+            self.assertEqual(traced_function(2), 4)
+        self.assertEqual(logs.records[0].getMessage(),
+                         '{0} traced_function {0}'.format('=' * 20))
+
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            with mock.patch.object(logger, 'debug') as debug:
+                self.assertEqual(traced_function(3), 6)
+        finally:
+            logger.setLevel(level)
+        self.assertFalse(debug.called)
+
     def test_clean_up_tv(self):
         """
         """
@@ -336,7 +1524,7 @@ class TestRASMF(unittest.TestCase):
                 with open(os.path.join(abs_path, filename), 'w') as fo:
                     fo.write(path_1 + filename)
 
-        rasmf.clean_up(self.config, test_list)
+        rasmf.clean_up(self.settings, test_list)
 
         for incoming in os.listdir(self.in_dir):
             logger.debug("Observed: {}".format(incoming))
@@ -349,6 +1537,59 @@ class TestRASMF(unittest.TestCase):
         logger.debug("expected: {}".format(expected))
         self.assertEqual(observed, expected)
 
+    def test_clean_up_scan_tree(self):
+        self.make_incoming_files([
+            ('Show.One-S01', 'Show One-S01E01.mkv'),
+            ('Show.One-S01', 'show.one.nfo'),
+            (os.path.join('Show.One-S01', 'Sample'), 'sample.txt.sfv'),
+            ('Show.Two-S01', 'Show Two-S01E01.mkv'),
+            ('Show.Two-S01', 'Show Two-S01 Extras.pdf'),
+        ])
+        os.makedirs(os.path.join(self.in_dir, 'Show.One-S01', 'Subs'))
+
+        tree = rasmf.ScanTree()
+        plan = rasmf.build_plan(self.settings, tree=tree)
+        clean_up_list = rasmf.execute_plan(self.settings, plan, tree)
+
+        # The directories are not walked again
+        with mock.patch.object(os, 'walk') as walk, \
+                mock.patch.object(os, 'scandir') as scandir:
+            rasmf.clean_up(self.settings, clean_up_list, tree)
+        self.assertFalse(walk.called)
+        self.assertFalse(scandir.called)
+
+        # Show.Two-S01 still holds a known file type
+        self.assertEqual(os.listdir(self.in_dir), ['Show.Two-S01'])
+        self.assertEqual(
+            os.listdir(os.path.join(self.in_dir, 'Show.Two-S01')),
+            ['Show Two-S01 Extras.pdf'])
+
+    def test_benchmark(self):
+        base_dir = os.path.dirname(self.in_dir)
+        kinds = benchmark_rasmf.generate_tree(self.in_dir, 100,
+                                              video_size=1024)
+        self.assertGreaterEqual(sum(kinds.values()), 100)
+
+        settings = benchmark_rasmf.benchmark_settings(base_dir)
+        results = benchmark_rasmf.run_benchmark(settings)
+
+        self.assertEqual(list(results),
+                         ['walk', 'classify', 'move', 'clean_up'])
+        self.assertEqual(results['classify']['operations'],
+                         kinds['tv'] + kinds['movie'])
+        self.assertEqual(results['move']['syscalls']['rename'],
+                         kinds['tv'] + kinds['movie'])
+        self.assertGreater(results['clean_up']['directories'], 0)
+        self.assertNotIn('peak_traced_kib', results['walk'])
+
+        # Each phase reports its own traced peak
+        benchmark_rasmf.generate_tree(self.in_dir, 100, video_size=1024)
+        results = benchmark_rasmf.run_benchmark(settings, trace_memory=True)
+        self.assertFalse(benchmark_rasmf.tracemalloc.is_tracing())
+        for phase in results.values():
+            self.assertIn('peak_traced_kib', phase)
+        self.assertGreater(results['classify']['bytes_per_operation'], 0)
+
     def tearDown(self):
         shutil.rmtree(self.media_dir)
         os.remove(self.test_config_fn)